@@ -0,0 +1,320 @@
+#fmusic benchmarks
+#builds synthetic libraries of different sizes and measures query latency
+#usage: python benchmark.py [sizes...]
+
+import fmusic_core as fcore
+import fmusic_spectrogram as fspectrogram
+
+import tracemalloc
+import tempfile
+import random
+import time
+import sys
+import os
+
+
+GENRES = ["Rock", "Pop", "Jazz", "Electronic", "Hip-Hop", "Classical", "Metal", "Unknown"]
+
+
+def build_library(file_path: str, num_songs: int, art_size: int = 4096) -> fcore.DataBase:
+    #fills a fresh database with num_songs fake songs
+    #every album gets its own cover in the art store, like a real library
+
+    db = fcore.DataBase(file_path)
+    rng = random.Random(42)
+
+    #pseudo words so names, artists and albums have a realistic term distribution
+    syllables = ["ka", "lo", "mi", "ra", "ton", "bel", "sun", "dre", "vo", "na", "ix", "gar", "pol", "te", "shu"]
+    words = list({"".join(rng.choices(syllables, k=rng.randint(1, 3))) for _ in range(20000)})
+
+    def phrase(max_words: int) -> str:
+        return " ".join(rng.choices(words, k=rng.randint(1, max_words))).title()
+
+    artists = [phrase(2) for _ in range(max(num_songs // 50, 10))]
+
+    rows = []
+    for idx in range(1, num_songs + 1):
+        artist = rng.choice(artists)
+        album = phrase(3)
+        name = f"{phrase(4)} {idx}"
+        art_hash = db.add_art(album.encode() + os.urandom(art_size), commit=False)
+        rows.append((
+            idx,
+            name,
+            os.path.join(fcore.MUSIC_DIR, artist, album, F"{name}.mp3"),
+            rng.randint(60, 200),
+            rng.randint(90, 600),
+            rng.choice([128, 192, 256, 320, 1000]),
+            rng.choice(GENRES),
+            artist,
+            album,
+            art_hash
+        ))
+
+    rows = [row + (fcore.get_search_path(row[2]),) for row in rows]
+    db.cursor.executemany(F"INSERT INTO songs ({fcore.SONG_COLUMNS}, search_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    db.conn.commit()
+    return db
+
+
+def time_it(func, repeat: int = 20) -> float:
+    #returns the median runtime of func in milliseconds
+    timings = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - t_start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def python_filter(db: fcore.DataBase, **restraints) -> list[fcore.SongEntry]:
+    #the old get_songs strategy: load every song and filter in python
+    songs = db.get_all_songs()
+    for key, value in restraints.items():
+        if type(value) == tuple:
+            songs = [song for song in songs if value[0] <= song.__dict__[key] <= value[1]]
+        else:
+            songs = [song for song in songs if song.__dict__[key] == value]
+    return songs[:10]
+
+
+def bench_get_songs(sizes: list[int]) -> None:
+    queries = {
+        "bpm range": {"bpm": (120, 125)},
+        "genre + bpm": {"genre": "Jazz", "bpm": (90, 110)},
+    }
+
+    print("get_songs latency (median ms)")
+    print(f"{'songs':>8} {'query':>14} {'sql':>10} {'python':>10}")
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = build_library(os.path.join(tmp_dir, "bench.db"), size)
+
+            queries["artist"] = {"artist": db.get_song_by_id(42).artist}
+
+            for query_name, restraints in queries.items():
+                sql_ms = time_it(lambda: db.get_songs(limit=10, **restraints))
+                python_ms = time_it(lambda: python_filter(db, **restraints), repeat=3)
+                print(f"{size:>8} {query_name:>14} {sql_ms:>10.3f} {python_ms:>10.3f}")
+
+            db.close()
+
+
+def like_search(db: fcore.DataBase, q: str) -> list[fcore.SongEntry]:
+    #the old full_text_search strategy: LIKE '%q%' over every column
+    cmd = F"SELECT {fcore.SONG_COLUMNS} FROM songs WHERE " + " OR ".join([F"{column} LIKE ?" for column in ["name", "abs_path", "bpm", "length", "kbps", "genre", "artist", "album"]])
+    cursor = db.read_cursor()
+    cursor.execute(cmd, [F"%{q}%"] * 8)
+    return [fcore.SongEntry(*song) for song in cursor.fetchall()]
+
+
+def bench_full_text_search(sizes: list[int]) -> None:
+    queries = ["ka", "jazz", "music", "mp3", "dre sun", "1234"]
+
+    print("full_text_search latency (median ms)")
+    print(f"{'songs':>8} {'query':>14} {'fts5':>10} {'like':>10}")
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = build_library(os.path.join(tmp_dir, "bench.db"), size)
+
+            for q in queries:
+                fts_ms = time_it(lambda: db.full_text_search(q, limit=100))
+                like_ms = time_it(lambda: like_search(db, q), repeat=3)
+                print(f"{size:>8} {q:>14} {fts_ms:>10.3f} {like_ms:>10.3f}")
+
+            db.close()
+
+
+def bench_playlist(size: int, tracks: list[int]) -> None:
+    #get_playlist with one join vs the old stringified id list + one query per track
+    print(f"get_playlist latency with {size} songs (median ms)")
+    print(f"{'tracks':>8} {'join':>10} {'n+1':>10}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = build_library(os.path.join(tmp_dir, "bench.db"), size)
+        rng = random.Random(42)
+
+        for num_tracks in tracks:
+            song_ids = [rng.randint(1, size) for _ in range(num_tracks)]
+            playlist = fcore.PlaylistEntry(None, f"bench {num_tracks}", None, [fcore.SongEntry(song_id, *[None] * 8) for song_id in song_ids])
+            db.add_playlist(playlist)
+
+            old_songs = str(song_ids)
+            def old_get_playlist():
+                return [db.get_song_by_id(int(song_id)) for song_id in fcore.list_str_to_list(old_songs)]
+
+            join_ms = time_it(lambda: db.get_playlist(playlist.id))
+            old_ms = time_it(old_get_playlist, repeat=5)
+            print(f"{num_tracks:>8} {join_ms:>10.3f} {old_ms:>10.3f}")
+
+        db.close()
+
+
+def bench_concurrent_reads(size: int, threads: list[int], queries_per_thread: int = 200) -> None:
+    #full text searches from several threads at once, each thread reads on its own connection
+    #while one writer keeps committing favorites
+    from concurrent.futures import ThreadPoolExecutor
+
+    print(f"concurrent full_text_search on {size} songs (queries / second)")
+    print(f"{'threads':>8} {'reads':>10} {'with writer':>12}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = build_library(os.path.join(tmp_dir, "bench.db"), size)
+        words = [song.artist.split()[0] for song in db.get_all_songs(limit=100)]
+
+        def reader(seed: int) -> int:
+            rng = random.Random(seed)
+            for _ in range(queries_per_thread):
+                db.full_text_search(rng.choice(words), limit=20)
+            return queries_per_thread
+
+        def run(num_threads: int, with_writer: bool) -> float:
+            stop = [False]
+            def writer():
+                song_id = 1
+                while not stop[0]:
+                    db.add_to_favorite(song_id)
+                    db.remove_from_favorite(song_id)
+                    song_id = song_id % size + 1
+
+            with ThreadPoolExecutor(num_threads + 1) as pool:
+                writer_job = pool.submit(writer) if with_writer else None
+                t_start = time.perf_counter()
+                done = sum(pool.map(reader, range(num_threads)))
+                seconds = time.perf_counter() - t_start
+                stop[0] = True
+                if writer_job is not None:
+                    writer_job.result()
+            return done / seconds
+
+        for num_threads in threads:
+            print(f"{num_threads:>8} {run(num_threads, False):>10.0f} {run(num_threads, True):>12.0f}")
+
+        db.close()
+
+
+def bench_event_loop(size: int, requests: int = 50) -> None:
+    #latency of a cheap endpoint while a heavy one keeps running, in the same event loop
+    #a blocking db call in an async route shows up as a p99 as long as the heavy request
+    import asyncio
+    import httpx
+
+    print(f"/api/get_num_songs latency with {size} songs (ms)")
+    print(f"{'load':>28} {'p50':>8} {'p99':>8}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, "bench.db")
+        build_library(file_path, size).close()
+
+        fcore.DataBase.file_path = file_path
+        import main
+        main.setup()
+
+        async def run(heavy: bool) -> list[float]:
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                stop = False
+
+                async def heavy_load():
+                    while not stop:
+                        await client.get("/api/get_option_frequency", params={"column_name": "artist"})
+                        #the in-process transport never waits on a socket, give the other tasks a turn
+                        await asyncio.sleep(0)
+
+                load = [asyncio.create_task(heavy_load()) for _ in range(2 if heavy else 0)]
+
+                #open loop: a request is due every 10 ms and its latency counts from when it was due,
+                #so time spent waiting for a blocked event loop is included
+                latencies = []
+                t_start = time.perf_counter()
+                for idx in range(requests):
+                    due = t_start + idx * 0.01
+                    await asyncio.sleep(max(due - time.perf_counter(), 0))
+                    await client.get("/api/get_num_songs")
+                    latencies.append((time.perf_counter() - due) * 1000)
+
+                stop = True
+                await asyncio.gather(*load)
+                return sorted(latencies)
+
+        for heavy in [False, True]:
+            latencies = asyncio.run(run(heavy))
+            name = "2x get_option_frequency" if heavy else "idle"
+            print(f"{name:>28} {latencies[len(latencies) // 2]:>8.2f} {latencies[int(len(latencies) * 0.99)]:>8.2f}")
+
+        main.db.close()
+
+
+def old_spectrogram(audio_path: str, img_path: str) -> None:
+    #the old calculate_spectrogram: full decode + resample, melspectrogram, matplotlib figure
+    import librosa
+    import numpy as np
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    audio, sr = librosa.load(audio_path)
+    S = librosa.feature.melspectrogram(y=audio, sr=sr)
+    S_dB = librosa.power_to_db(S, ref=np.max)
+
+    fig = plt.figure(figsize=(8,1))
+    ax = fig.add_subplot(111)
+    ax.axis("off")
+    ax.imshow(S_dB, origin="lower", aspect="auto", cmap="magma")
+    fig.savefig(img_path, format="png", bbox_inches="tight", pad_inches=0)
+    plt.close(fig)
+
+
+def write_test_track(file_path: str, minutes: float, sr: int = 44100) -> None:
+    #stereo noise + sweeping tone, written in chunks so the benchmark itself stays small
+    import numpy as np
+    import soundfile as sf
+
+    rng = np.random.default_rng(42)
+    with sf.SoundFile(file_path, "w", samplerate=sr, channels=2, subtype="PCM_16") as f:
+        for start in range(0, int(minutes * 60 * sr), sr * 10):
+            t = (start + np.arange(sr * 10)) / sr
+            tone = 0.3 * np.sin(2 * np.pi * (200 + 50 * np.sin(t / 7)) * t)
+            noise = 0.05 * rng.standard_normal(len(t))
+            f.write(np.stack([tone + noise, tone - noise], axis=1).astype(np.float32))
+
+
+def measure(func) -> tuple[float, float]:
+    #returns (seconds, peak traced memory in MB)
+    #tracing slows numpy heavy code down, so time and memory come from separate runs
+    #the first run also warms up the lazy imports
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    tracemalloc.stop()
+
+    t_start = time.perf_counter()
+    func()
+    return time.perf_counter() - t_start, peak
+
+
+def bench_spectrogram(minutes: list[float]) -> None:
+    print("spectrogram rendering (seconds / peak MB)")
+    print(f"{'minutes':>8} {'streaming':>18} {'librosa+mpl':>18}")
+
+    for length in minutes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            audio_path = os.path.join(tmp_dir, "track.wav")
+            write_test_track(audio_path, length)
+
+            new_s, new_mb = measure(lambda: fspectrogram.render_spectrogram(audio_path, os.path.join(tmp_dir, "new.png")))
+            old_s, old_mb = measure(lambda: old_spectrogram(audio_path, os.path.join(tmp_dir, "old.png")))
+            print(f"{length:>8} {new_s:>8.2f}s {new_mb:>7.1f}MB {old_s:>8.2f}s {old_mb:>7.1f}MB")
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    bench_get_songs(sizes)
+    bench_full_text_search(sizes)
+    bench_playlist(sizes[-1], [100, 2000])
+    bench_concurrent_reads(sizes[-1], [1, 2, 4, 8])
+    bench_event_loop(sizes[-1])
+    bench_spectrogram([4, 60])
@@ -0,0 +1,184 @@
+#fmusic Analysis
+#tempo, key, loudness and duration of a song from its audio, most files have no (or a wrong) TBPM tag
+#
+#the file is decoded once, block by block, to mono float32 at SAMPLE_RATE (see fmusic_audio) and every analysis
+#reads the same blocks: the loudness meter filters them, tempo and key share one STFT of them.
+#only one value per STFT frame (onset strength) or per 100 ms (loudness) is kept, so memory does not
+#grow with the decoded track. update_index.py --analyze runs analyze() in worker processes
+#and stores the results in the songs table (tempo, musical_key, loudness, duration)
+
+import numpy as np
+import scipy.signal
+import librosa
+
+import fmusic_audio as faudio
+
+
+SAMPLE_RATE = 22050
+N_FFT = 2048
+HOP_LENGTH = 512
+TOP_DB = 80 #mel bins more than this below the loudest one so far do not count as onsets
+TEMPO_WINDOW_SECONDS = 8.0 #longest beat period the tempogram looks for, as librosa.feature.tempo(ac_size)
+TEMPOGRAM_CHUNK = 1024 #tempogram columns computed at once
+
+KEY_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+#Krumhansl-Kessler profiles, how strongly each pitch class belongs to a major / minor key on C
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+#integrated loudness as in ITU-R BS.1770 / EBU R128, which ReplayGain 2.0 is based on
+BLOCK_SECONDS = 0.4
+STEPS_PER_BLOCK = 4 #the blocks overlap by 75 %, a new one starts every 100 ms
+ABSOLUTE_GATE = -70.0 #LUFS
+RELATIVE_GATE = -10.0 #LU below the loudness of the blocks above the absolute gate
+
+
+def estimate_tempo(onsets: np.ndarray) -> float:
+    #bpm from the onset strength envelope, None if there are no onsets (silence)
+    if not onsets.any():
+        return None
+
+    #librosa.feature.tempo on the mean autocorrelation tempogram, summed up TEMPOGRAM_CHUNK columns at a time
+    #the whole tempogram has win_length values per frame, far more than the decoded audio of a long mix
+    win_length = librosa.time_to_frames(TEMPO_WINDOW_SECONDS, sr=SAMPLE_RATE, hop_length=HOP_LENGTH).item()
+    #the centering of librosa.feature.tempogram(center=True)
+    padded = np.pad(onsets, win_length // 2, mode="linear_ramp", end_values=0)
+
+    tempogram = np.zeros(win_length)
+    for start in range(0, len(onsets), TEMPOGRAM_CHUNK):
+        stop = min(start + TEMPOGRAM_CHUNK, len(onsets))
+        chunk = padded[start:stop + win_length - 1]
+        tempogram += librosa.feature.tempogram(onset_envelope=chunk, win_length=win_length, center=False).sum(axis=1)
+
+    tempogram = (tempogram / len(onsets))[:, None]
+    return float(librosa.feature.tempo(tg=tempogram, sr=SAMPLE_RATE, hop_length=HOP_LENGTH)[0])
+
+def estimate_key(chroma: np.ndarray) -> str:
+    #e.g. "A minor", the key profile that correlates best with the chroma summed over all frames, None for silence
+    if not chroma.any() or np.ptp(chroma) == 0:
+        return None
+
+    best_score, best_key = -np.inf, None
+    for mode, profile in [("major", MAJOR_PROFILE), ("minor", MINOR_PROFILE)]:
+        for tonic in range(12):
+            score = np.corrcoef(np.roll(profile, tonic), chroma)[0, 1]
+            if score > best_score:
+                best_score, best_key = score, F"{KEY_NAMES[tonic]} {mode}"
+    return best_key
+
+
+def k_weighting(sr: int) -> list[tuple[np.ndarray, np.ndarray]]:
+    #the two BS.1770 pre-filters (high shelf, high pass) as (b, a), for any sample rate (as in libebur128)
+    f0, gain, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = np.tan(np.pi * f0 / sr)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = (
+        np.array([(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0]),
+        np.array([1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    )
+
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = np.tan(np.pi * f0 / sr)
+    a0 = 1 + k / q + k * k
+    high_pass = (
+        np.array([1.0, -2.0, 1.0]),
+        np.array([1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    )
+    return [shelf, high_pass]
+
+class LoudnessMeter:
+    #integrated loudness of a stream of blocks, LUFS of the mono downmix
+    #a song with the same signal on both channels measures about 3 dB lower than BS.1770 on the stereo file
+    #the K-weighted signal is summed up per 100 ms step, a gating block is STEPS_PER_BLOCK steps
+    #
+    #usage:
+    #   meter = LoudnessMeter()
+    #   for block in stream: meter.add(block)
+    #   meter.loudness()
+
+    def __init__(self, sr: int = SAMPLE_RATE) -> None:
+        self.step = int(BLOCK_SECONDS * sr / STEPS_PER_BLOCK)
+        #[(b, a, filter state)], the state carries the filters over from one block to the next
+        self.filters = [(b, a, np.zeros(max(len(a), len(b)) - 1)) for b, a in k_weighting(sr)]
+        self.steps = [] #arrays of summed squares, one value per step
+        self.carry = np.zeros(0) #squares of the samples after the last full step
+
+    def add(self, block: np.ndarray) -> None:
+        filtered = block
+        for idx, (b, a, state) in enumerate(self.filters):
+            filtered, state = scipy.signal.lfilter(b, a, filtered, zi=state)
+            self.filters[idx] = (b, a, state)
+
+        squares = np.concatenate([self.carry, filtered * filtered])
+        n = len(squares) // self.step
+        self.steps.append(squares[:n * self.step].reshape(n, self.step).sum(axis=1))
+        self.carry = squares[n * self.step:]
+
+    def loudness(self) -> float:
+        #None if the song is shorter than one block or silent
+        steps = np.concatenate([np.zeros(0)] + self.steps)
+        if len(steps) < STEPS_PER_BLOCK:
+            return None
+        power = np.convolve(steps, np.ones(STEPS_PER_BLOCK), "valid") / (self.step * STEPS_PER_BLOCK)
+
+        with np.errstate(divide="ignore"):
+            loudness = -0.691 + 10 * np.log10(np.maximum(power, 0))
+
+        gated = power[loudness > ABSOLUTE_GATE]
+        if len(gated) == 0:
+            return None
+        relative_gate = -0.691 + 10 * np.log10(gated.mean()) + RELATIVE_GATE
+
+        gated = power[(loudness > ABSOLUTE_GATE) & (loudness > relative_gate)]
+        return float(-0.691 + 10 * np.log10(gated.mean()))
+
+
+def analyze(path: str) -> dict:
+    #{"tempo": bpm, "musical_key": "A minor", "loudness": LUFS, "duration": seconds}
+    #a value is None if it could not be estimated (silence, shorter than a loudness block)
+    stream = faudio.AudioStream(path, sr=SAMPLE_RATE)
+    meter = LoudnessMeter()
+    samples = 0
+
+    def blocks():
+        nonlocal samples
+        for block in stream:
+            samples += len(block)
+            meter.add(block)
+            yield block
+
+    window = np.hanning(N_FFT + 1)[:-1].astype(np.float32)
+    mel_basis = librosa.filters.mel(sr=SAMPLE_RATE, n_fft=N_FFT).astype(np.float32)
+    #A440 tuning, estimating it would need the whole spectrogram
+    chroma_basis = librosa.filters.chroma(sr=SAMPLE_RATE, n_fft=N_FFT).astype(np.float32)
+
+    onsets = [] #mean rise of the mel bins in dB per frame, as librosa.onset.onset_strength
+    chroma = np.zeros(12) #sum of the chroma of every frame, each normalized to its loudest pitch class
+    last_db = None
+    max_db = -np.inf
+
+    #less than one STFT frame yields no frames, so neither tempo nor key
+    for frames in faudio.iter_frames(blocks(), N_FFT, HOP_LENGTH):
+        power = np.abs(np.fft.rfft(frames * window, axis=1)) ** 2 #(n, N_FFT // 2 + 1)
+
+        db = librosa.power_to_db(power @ mel_basis.T, top_db=None)
+        #the clipping of power_to_db(top_db), relative to the loudest bin up to here instead of the whole song
+        max_db = max(max_db, db.max())
+        db = np.maximum(db, max_db - TOP_DB)
+        previous = db[:1] if last_db is None else last_db
+        onsets.append(np.maximum(np.diff(np.concatenate([previous, db]), axis=0), 0).mean(axis=1))
+        last_db = db[-1:]
+
+        frame_chroma = power @ chroma_basis.T
+        peak = frame_chroma.max(axis=1, keepdims=True)
+        chroma += (frame_chroma / np.where(peak > 0, peak, 1)).sum(axis=0)
+
+    onsets = np.concatenate([np.zeros(0, dtype=np.float32)] + onsets)
+    return {
+        "tempo": estimate_tempo(onsets),
+        "musical_key": estimate_key(chroma),
+        "loudness": meter.loudness(),
+        "duration": samples / SAMPLE_RATE,
+    }
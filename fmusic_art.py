@@ -0,0 +1,85 @@
+#fmusic Art
+#thumbnail pyramid for album art, cached on disk with LRU eviction
+
+import PIL.Image as Image
+
+import fmusic_cache as fcache
+
+import io
+
+
+THUMBNAIL_SIZES = [64, 256, 512]
+
+#mime type and PIL save options per output format
+FORMATS = {
+    "webp": ("image/webp", {"format": "WEBP", "quality": 80, "method": 4}),
+    "jpeg": ("image/jpeg", {"format": "JPEG", "quality": 85, "optimize": True, "progressive": True}),
+}
+
+
+def pick_size(size: int) -> int:
+    #smallest pyramid level that is at least size px, the largest level otherwise
+    for level in THUMBNAIL_SIZES:
+        if level >= size:
+            return level
+    return THUMBNAIL_SIZES[-1]
+
+def pick_format(accept: str) -> str:
+    #webp for clients that announce it, jpeg for everyone else
+    if "image/webp" in (accept or ""):
+        return "webp"
+    return "jpeg"
+
+
+class ThumbnailCache:
+    #thumbnails are stored as {cache_dir}/{art_hash}_{size}.{fmt}
+    #the cache is capped at max_bytes, the least recently used files are deleted first
+
+    def __init__(self, cache_dir: str = "./temp/thumbnails", max_bytes: int = 256 * 1024 * 1024) -> None:
+        self.files = fcache.DiskLRU(cache_dir, max_bytes)
+
+    def file_name(self, art_hash: str, size: int, fmt: str) -> str:
+        return f"{art_hash}_{size}.{fmt}"
+
+    def get(self, art_hash: str, size: int, fmt: str, load_source) -> tuple[str, bytes]:
+        #returns (mime, data) of the thumbnail
+        #load_source() is only called on a cache miss and has to return the original image bytes
+
+        size = pick_size(size)
+        name = self.file_name(art_hash, size, fmt)
+        mime = FORMATS[fmt][0]
+
+        path = self.files.lookup(name)
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    return mime, f.read()
+            except FileNotFoundError:
+                #removed behind our back, generate it again
+                pass
+
+        thumbnails = self.generate(art_hash, load_source(), [fmt])
+        return mime, thumbnails[(size, fmt)]
+
+    def generate(self, art_hash: str, data: bytes, formats: list[str] = ["webp", "jpeg"]) -> dict:
+        #renders every pyramid level of an image and stores them in the cache
+        #each level is downscaled from the next larger one, so the full image is only resized once
+        #returns {(size, fmt): bytes}
+
+        img = Image.open(io.BytesIO(data))
+        img = img.convert("RGB")
+
+        thumbnails = {}
+        for size in sorted(THUMBNAIL_SIZES, reverse=True):
+            img = img.copy()
+            img.thumbnail((size, size), Image.LANCZOS)
+
+            for fmt in formats:
+                buf = io.BytesIO()
+                img.save(buf, **FORMATS[fmt][1])
+                thumbnails[(size, fmt)] = buf.getvalue()
+
+        for (size, fmt), thumbnail in thumbnails.items():
+            self.files.write(self.file_name(art_hash, size, fmt), thumbnail)
+
+        return thumbnails
@@ -0,0 +1,116 @@
+#fmusic Audio
+#streaming audio decoding, blocks of mono float32 samples with bounded memory
+
+import numpy as np
+import soundfile as sf
+
+import threading
+import os
+
+
+#samples per block handed to the consumers
+BLOCK_FRAMES = 65536
+
+
+class AudioStream:
+    #decodes a file block by block as mono float32
+    #soundfile (libsndfile) handles wav, flac, ogg and mp3, everything else is decoded by audioread (ffmpeg / gstreamer)
+    #with sr set, the blocks are resampled on the fly with soxr
+    #
+    #usage:
+    #   stream = AudioStream(path)
+    #   stream.sr, stream.frames
+    #   for block in stream: ...
+
+    def __init__(self, path: str, sr: int = None, block_frames: int = BLOCK_FRAMES) -> None:
+        self.path = path
+        self.block_frames = block_frames
+
+        try:
+            info = sf.info(path)
+            self.backend = "soundfile"
+            self.native_sr = info.samplerate
+            native_frames = info.frames
+        except (sf.LibsndfileError, RuntimeError):
+            import audioread
+            with audioread.audio_open(path) as f:
+                self.backend = "audioread"
+                self.native_sr = f.samplerate
+                native_frames = int(f.duration * f.samplerate)
+
+        self.sr = sr or self.native_sr
+
+        #number of samples after resampling, an estimate for audioread (duration from the header)
+        self.frames = int(native_frames * self.sr / self.native_sr)
+
+    @property
+    def duration(self) -> float:
+        return self.frames / self.sr
+
+    def native_blocks(self):
+        if self.backend == "soundfile":
+            with sf.SoundFile(self.path) as f:
+                #a matrix-vector product is much faster than mean(axis=1) over interleaved channels
+                downmix = np.full(f.channels, 1 / f.channels, dtype=np.float32)
+                for block in f.blocks(blocksize=self.block_frames, dtype="float32", always_2d=True):
+                    yield block @ downmix
+        else:
+            import audioread
+            with audioread.audio_open(self.path) as f:
+                #16 bit interleaved pcm, a buffer can end in the middle of a frame
+                frame_bytes = 2 * f.channels
+                leftover = b""
+                for buf in f:
+                    buf = leftover + bytes(buf)
+                    usable = len(buf) - len(buf) % frame_bytes
+                    leftover = buf[usable:]
+
+                    block = np.frombuffer(buf[:usable], dtype=np.int16).astype(np.float32) / 32768
+                    yield block.reshape(-1, f.channels) @ np.full(f.channels, 1 / f.channels, dtype=np.float32)
+
+    def __iter__(self):
+        if self.sr == self.native_sr:
+            yield from self.native_blocks()
+            return
+
+        import soxr
+        resampler = soxr.ResampleStream(self.native_sr, self.sr, 1, dtype="float32")
+        for block in self.native_blocks():
+            yield resampler.resample_chunk(block, last=False)
+        yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+
+def iter_frames(stream: AudioStream, frame_length: int, hop_length: int):
+    #cuts a stream into frames starting every hop_length samples without holding more than one block in memory
+    #hop_length may be larger than frame_length, the samples in between are skipped
+    #yields arrays of shape (n, frame_length), the frames of consecutive calls follow each other
+    carry = np.zeros(0, dtype=np.float32)
+    skip = 0 #samples of the next block that lie before the next frame
+
+    for block in stream:
+        if skip >= len(block):
+            skip -= len(block)
+            continue
+
+        buf = np.concatenate([carry, block[skip:]])
+        skip = 0
+
+        n = (len(buf) - frame_length) // hop_length + 1
+        if n <= 0:
+            carry = buf
+            continue
+
+        yield np.lib.stride_tricks.sliding_window_view(buf, frame_length)[::hop_length][:n]
+
+        next_start = n * hop_length
+        carry = buf[next_start:]
+        skip = max(next_start - len(buf), 0)
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    #readers never see a half written file, concurrent writers of the same file do not corrupt it
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,120 @@
+#fmusic Cache
+#a directory of cached files capped at a byte budget, the least recently used files are deleted first
+#used by the thumbnail and the transcode cache
+
+from collections import OrderedDict
+
+import threading
+import os
+
+
+def tmp_owner_running(tmp_name: str) -> bool:
+    #whether the process in a tmp_path() name is alive, names without a pid count as left over
+    try:
+        pid = int(tmp_name.rsplit(".", 3)[1])
+    except (ValueError, IndexError):
+        return False
+
+    if os.name == "nt":
+        #os.kill would terminate the process, the file is kept open by its writer and cannot be removed instead
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        #running as another user
+        return True
+    return True
+
+
+class DiskLRU:
+    #usage:
+    #   files = DiskLRU("./temp/thumbnails", 256 * 1024 * 1024)
+    #   path = files.lookup(name) #None on a miss
+    #   files.write(name, data) or files.add(name, tmp_path) with tmp_path = files.tmp_path(name)
+
+    def __init__(self, cache_dir: str, max_bytes: int) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        #file name -> size in bytes, oldest first
+        #the mtime of a file is its last use, so the order survives restarts
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                #left over from a crash, unless the process that writes it is still running
+                #(another server, update_index.py, a job worker)
+                if not tmp_owner_running(entry.name):
+                    try:
+                        os.remove(entry.path)
+                    except (FileNotFoundError, PermissionError):
+                        #windows: still open in another process
+                        pass
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, name)
+
+    def tmp_path(self, name: str) -> str:
+        #where a file is written before add() moves it into the cache, unique per process and thread
+        return f"{self.path(name)}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def lookup(self, name: str) -> str:
+        #path of a cached file, marked as just used, None on a miss
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            #removed behind our back
+            with self.lock:
+                self.total_bytes -= self.entries.pop(name, 0)
+            return None
+        return path
+
+    def add(self, name: str, tmp_path: str) -> None:
+        #moves a finished file into the cache and deletes old files until the cache fits max_bytes again
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, self.path(name))
+
+        with self.lock:
+            self.total_bytes -= self.entries.pop(name, 0)
+            self.entries[name] = size
+            self.total_bytes += size
+
+        self.evict()
+
+    def write(self, name: str, data: bytes) -> None:
+        tmp_path = self.tmp_path(name)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        self.add(name, tmp_path)
+
+    def evict(self) -> None:
+        with self.lock:
+            while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+                name, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                try:
+                    os.remove(self.path(name))
+                except FileNotFoundError:
+                    pass
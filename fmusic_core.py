@@ -6,17 +6,26 @@ from mutagen.flac import FLAC
 from mutagen.oggvorbis import OggVorbis
 from mutagen.mp4 import MP4 as M4A
 from mutagen.wave import WAVE
+from mutagen.flac import Picture
 
-import librosa
 import numpy as np
-import matplotlib.pyplot as plt
-import PIL.Image as Image
 
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+import fmusic_spectrogram as fspectrogram
+import fmusic_waveform as fwaveform
 
 import sqlite3
+import threading
+import asyncio
+import contextlib
+import functools
+import hashlib
+import base64
+import json
 import os
-import io
+import re
 import time
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -24,6 +33,16 @@ os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 MUSIC_DIR = "D:/Music"
 
+#columns of the songs table in the order of the SongEntry fields
+#album art is not stored in songs, only the hash of its entry in the album_art table
+SONG_COLUMNS = "id, name, abs_path, bpm, length, kbps, genre, artist, album, art_hash"
+#same columns prefixed with the table name, for joins with tables that have an id column too
+SONG_COLUMNS_QUALIFIED = ", ".join([F"songs.{column}" for column in SONG_COLUMNS.split(", ")])
+
+#default and largest number of songs in one page of a paginated query
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 
 def list_str_to_list(list_str: str) -> list:
     return list_str[1:-1].split(", ")
@@ -55,6 +74,17 @@ def cast_to_int(value: any) -> int:
     except ValueError:
         return 0
 
+def encode_cursor(key: tuple) -> str:
+    #opaque token for the sort key of the last song of a page, the next page starts after it
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> list:
+    #raises ValueError for anything encode_cursor did not make
+    key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    if type(key) != list:
+        raise ValueError(F"Invalid cursor {cursor}")
+    return key
+
 def is_music(file_path: str) -> bool:
     file_extension = file_path.split(".")[-1]
     return file_extension in ["mp3", "wav", "flac", "m4a", "ogg"]
@@ -70,7 +100,8 @@ class SongEntry:
     genre:str
     artist:str
     album:str
-    album_art:bytes
+    art_hash:str = None #key into the album_art table
+    album_art:bytes = None #raw image, only set between get_metadata and add_song
     
     def __str__(self) -> str:
         return f"{self.name} by {self.artist} from {self.album} ({self.genre})"
@@ -111,13 +142,87 @@ class PlaylistEntry:
         }
 
 
+@dataclass
+class SongPage:
+    #one page of a paginated query
+    #next is the cursor of the following page (None on the last page),
+    #total the number of songs over all pages (None if it was not counted)
+    songs:list[SongEntry]
+    total:int
+    next:str
+    
+    def to_json(self) -> dict:
+        return {
+            "songs": [song.to_json() for song in self.songs],
+            "total": self.total,
+            "next": self.next
+        }
+
+
+def writes(method):
+    #runs a DataBase method while holding the write lock, only one thread writes at a time
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.write_lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
 class DataBase:
+    #one write connection (self.conn / self.cursor) shared by all threads behind self.write_lock,
+    #and one read-only connection per thread (read_cursor), so reads run in parallel and
+    #never share a cursor with another thread
+    #the database is in WAL mode, readers see the last commit while a write is in progress
+    
     file_path: str = "./music.db"
     
-    def __init__(self) -> None:
-        self.conn = sqlite3.connect(self.file_path, check_same_thread=False)
+    #columns that can be used as restraints in get_songs / dynamic_playlist
+    filter_columns: list[str] = ["id", "bpm", "length", "kbps", "genre", "artist", "album", "name", "tempo", "musical_key", "loudness", "duration"]
+    
+    #columns that get a B-tree index for the range and equality filters
+    indexed_columns: list[str] = ["bpm", "length", "kbps", "genre", "artist", "album", "tempo", "musical_key", "loudness", "duration"]
+    
+    #columns with materialized value counts in facet_counts, for the filter options
+    facet_columns: list[str] = ["bpm", "length", "kbps", "genre", "artist", "album"]
+    
+    #columns covered by the songs_fts full text index
+    #the weights are passed to bm25(), so a hit in the name ranks higher than one in the path
+    #search_path is abs_path relative to MUSIC_DIR without the extension (see get_search_path),
+    #the library root and the extension would otherwise match every song
+    fts_columns: list[str] = ["name", "artist", "album", "genre", "search_path"]
+    fts_weights: list[float] = [10.0, 5.0, 4.0, 2.0, 1.0]
+    
+    #applied to every connection
+    #synchronous=NORMAL is safe in WAL mode (a power loss can only lose the last commits, never corrupt the db)
+    pragmas: dict = {
+        "synchronous": "NORMAL",
+        "cache_size": -16384, #KiB, per connection
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    }
+    
+    def __init__(self, file_path: str = None) -> None:
+        if file_path is not None:
+            self.file_path = file_path
+        
+        self.write_lock = threading.RLock()
+        self.local = threading.local()
+        
+        #song ids of all favorites, loaded on first use and dropped whenever favorites change
+        self.favorite_ids = None
+        self.favorites_lock = threading.Lock()
+        #PRAGMA data_version of version_conn when favorite_ids was loaded, see get_favorite_ids
+        self.favorites_version = None
+        
+        self.conn = self.connect(check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
         self.cursor = self.conn.cursor()
         
+        #only asked for its data_version (behind favorites_lock), which changes with every commit of another connection,
+        #self.conn included, so a lookup never waits for a write in progress
+        self.version_conn = self.connect(check_same_thread=False)
+        self.version_conn.execute("PRAGMA query_only=ON")
+        
         cmd = """
         CREATE TABLE IF NOT EXISTS songs (
             id INTEGER PRIMARY KEY,
@@ -129,17 +234,90 @@ class DataBase:
             genre TEXT,
             artist TEXT,
             album TEXT,
-            album_art BLOB
+            art_hash TEXT
         );
         """
         self.cursor.execute(cmd)
         
+        #content addressed cover store, every distinct image is stored once
+        cmd = """
+        CREATE TABLE IF NOT EXISTS album_art (
+            hash TEXT PRIMARY KEY,
+            mime TEXT,
+            data BLOB
+        );
+        """
+        self.cursor.execute(cmd)
+        
+        self.migrate_album_art()
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_songs_art_hash ON songs (art_hash)")
+        
+        #fingerprint of the file a song was read from, used by incremental rescans
+        self.add_missing_columns("songs", {
+            "file_mtime": "REAL",
+            "file_size": "INTEGER",
+            "file_inode": "INTEGER",
+            "file_hash": "TEXT"
+        })
+        
+        #the part of abs_path that the full text index sees
+        self.add_missing_columns("songs", {"search_path": "TEXT"})
+        self.fill_search_paths()
+        
+        #results of fmusic_analysis, analyzed_mtime is the file_mtime (0 if unknown) the song was analyzed at
+        self.add_missing_columns("songs", {
+            "tempo": "REAL",
+            "musical_key": "TEXT",
+            "loudness": "REAL",
+            "duration": "REAL",
+            "analyzed_mtime": "REAL"
+        })
+        
         cmd = """
         CREATE TABLE IF NOT EXISTS playlists (
             id INTEGER PRIMARY KEY,
             name TEXT UNIQUE NOT NULL,
-            playlist_art BLOB,
-            songs TEXT
+            playlist_art BLOB
+        );
+        """
+        self.cursor.execute(cmd)
+        
+        #one row per track of a playlist, ordered by position
+        #positions are REAL so a track can be moved between two others by taking the midpoint,
+        #without renumbering the rest of the playlist
+        cmd = """
+        CREATE TABLE IF NOT EXISTS playlist_songs (
+            id INTEGER PRIMARY KEY,
+            playlist_id INTEGER NOT NULL,
+            position REAL NOT NULL,
+            song_id INTEGER NOT NULL
+        );
+        """
+        self.cursor.execute(cmd)
+        self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_playlist_songs_position ON playlist_songs (playlist_id, position)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_playlist_songs_song_id ON playlist_songs (song_id)")
+        
+        self.migrate_playlist_songs()
+        
+        #a deleted song leaves every playlist, however it is deleted (delete_song, update_index.py, a sqlite shell)
+        cmd = """
+        CREATE TRIGGER IF NOT EXISTS songs_playlist_songs_delete AFTER DELETE ON songs BEGIN
+            DELETE FROM playlist_songs WHERE song_id=old.id;
+        END;
+        """
+        self.cursor.execute(cmd)
+        #tracks of songs deleted before the trigger existed, or migrated from ids that had no song
+        self.cursor.execute("DELETE FROM playlist_songs WHERE song_id NOT IN (SELECT id FROM songs)")
+        
+        #files that were parsed but could not be added (their name is taken by another song),
+        #with the fingerprint they had then, so an incremental rescan does not parse them again
+        cmd = """
+        CREATE TABLE IF NOT EXISTS skipped_files (
+            abs_path TEXT PRIMARY KEY,
+            file_mtime REAL,
+            file_size INTEGER,
+            file_inode INTEGER,
+            file_hash TEXT
         );
         """
         self.cursor.execute(cmd)
@@ -152,86 +330,401 @@ class DataBase:
         """
         self.cursor.execute(cmd)
         
+        for column in self.indexed_columns:
+            cmd = F"CREATE INDEX IF NOT EXISTS idx_songs_{column} ON songs ({column})"
+            self.cursor.execute(cmd)
+        
+        self.has_fts = self.create_fts_index()
+        self.create_facet_counts()
+        
+        self.conn.commit()
+    
+    def connect(self, **kwargs) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.file_path, timeout=30, **kwargs)
+        for key, value in self.pragmas.items():
+            conn.execute(F"PRAGMA {key}={value}")
+        return conn
+    
+    def read_cursor(self) -> sqlite3.Cursor:
+        #a new cursor on the read connection of the calling thread
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.connect()
+            conn.execute("PRAGMA query_only=ON")
+            self.local.conn = conn
+        return conn.cursor()
+    
+    def close(self) -> None:
+        #closes the write connection and the read connection of the calling thread
+        #read connections of other threads are closed when their thread ends
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+        self.version_conn.close()
+        self.conn.close()
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        #groups writes with commit=False into one transaction
+        #commits at the end of the block, rolls back if it raises
+        with self.write_lock:
+            try:
+                yield self
+            except BaseException:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+            #the block may have deleted favorite songs
+            self.invalidate_favorites()
+    
+    @contextlib.contextmanager
+    def savepoint(self):
+        #like transaction, but for methods called with commit=False inside the caller's transaction
+        #rolls back only the writes of the block if it raises, does not commit otherwise
+        with self.write_lock:
+            if not self.conn.in_transaction:
+                #RELEASE of the outermost savepoint would commit
+                self.conn.execute("BEGIN")
+            self.conn.execute("SAVEPOINT block")
+            try:
+                yield self
+            except BaseException:
+                self.conn.execute("ROLLBACK TO block")
+                self.conn.execute("RELEASE block")
+                raise
+            self.conn.execute("RELEASE block")
+    
+    def atomic(self, commit: bool = True):
+        #all writes of the block or none, as a transaction of its own or as part of the caller's one
+        return self.transaction() if commit else self.savepoint()
+    
+    def add_missing_columns(self, table_name: str, columns: dict) -> None:
+        #adds every {column: type} that the table does not have yet
+        self.cursor.execute(F"PRAGMA table_info({table_name})")
+        existing = [row[1] for row in self.cursor.fetchall()]
+        
+        for column, column_type in columns.items():
+            if column not in existing:
+                self.cursor.execute(F"ALTER TABLE {table_name} ADD COLUMN {column} {column_type}")
+    
+    def fill_search_paths(self) -> None:
+        #songs from before search_path existed
+        self.cursor.execute("SELECT id, abs_path FROM songs WHERE search_path IS NULL")
+        rows = [(get_search_path(abs_path), song_id) for song_id, abs_path in self.cursor.fetchall()]
+        self.cursor.executemany("UPDATE songs SET search_path=? WHERE id=?", rows)
+    
+    def migrate_album_art(self) -> None:
+        #older databases kept the raw cover blob in songs.album_art
+        #move every blob into the album_art table and replace it with its hash
+        
+        self.cursor.execute("PRAGMA table_info(songs)")
+        columns = [row[1] for row in self.cursor.fetchall()]
+        
+        if "album_art" not in columns:
+            return
+        
+        print("Moving album art into the album_art table")
+        
+        if "art_hash" not in columns:
+            self.cursor.execute("ALTER TABLE songs ADD COLUMN art_hash TEXT")
+        
+        read_cursor = self.conn.cursor()
+        read_cursor.execute("SELECT id, album_art FROM songs WHERE album_art IS NOT NULL")
+        
+        while True:
+            rows = read_cursor.fetchmany(100)
+            if len(rows) == 0:
+                break
+            
+            for song_id, album_art in rows:
+                art_hash = self.add_art(album_art, commit=False)
+                self.cursor.execute("UPDATE songs SET art_hash=? WHERE id=?", (art_hash, song_id))
+        
+        try:
+            self.cursor.execute("ALTER TABLE songs DROP COLUMN album_art")
+        except sqlite3.OperationalError:
+            #sqlite < 3.35 can not drop columns, at least free the blobs
+            self.cursor.execute("UPDATE songs SET album_art=NULL")
+        
+        self.conn.commit()
+    
+    def migrate_playlist_songs(self) -> None:
+        #older databases kept the song ids of a playlist as a string "[1, 2, 3]" in playlists.songs
+        #move them into playlist_songs and drop the column
+        
+        self.cursor.execute("PRAGMA table_info(playlists)")
+        columns = [row[1] for row in self.cursor.fetchall()]
+        
+        if "songs" not in columns:
+            return
+        
+        self.cursor.execute("SELECT id, songs FROM playlists WHERE songs IS NOT NULL")
+        rows = self.cursor.fetchall()
+        
+        if len(rows) > 0:
+            print("Moving playlist songs into the playlist_songs table")
+        
+        for playlist_id, songs in rows:
+            song_ids = [int(song_id) for song_id in list_str_to_list(songs) if is_int(song_id)]
+            cmd = "INSERT INTO playlist_songs (playlist_id, position, song_id) VALUES (?, ?, ?)"
+            self.cursor.executemany(cmd, [(playlist_id, position, song_id) for position, song_id in enumerate(song_ids, 1)])
+        
+        try:
+            self.cursor.execute("ALTER TABLE playlists DROP COLUMN songs")
+        except sqlite3.OperationalError:
+            #sqlite < 3.35 can not drop columns
+            self.cursor.execute("UPDATE playlists SET songs=NULL")
+        
         self.conn.commit()
+    
+    def create_fts_index(self) -> bool:
+        #external content FTS5 table over the text columns of songs
+        #triggers keep it in sync with every insert / update / delete on songs
+        #returns False if the sqlite build has no FTS5, full_text_search then falls back to LIKE
+        
+        cmd = "SELECT name FROM sqlite_master WHERE type='table' AND name='songs_fts'"
+        self.cursor.execute(cmd)
+        is_new = self.cursor.fetchone() is None
+        
+        if not is_new:
+            #older databases indexed other columns (the full abs_path), the table and its triggers are made again
+            self.cursor.execute("PRAGMA table_info(songs_fts)")
+            if [row[1] for row in self.cursor.fetchall()] != self.fts_columns:
+                for trigger in ["songs_fts_insert", "songs_fts_delete", "songs_fts_update"]:
+                    self.cursor.execute(F"DROP TRIGGER IF EXISTS {trigger}")
+                self.cursor.execute("DROP TABLE songs_fts")
+                is_new = True
+        
+        columns = ", ".join(self.fts_columns)
+        new_columns = ", ".join([F"new.{column}" for column in self.fts_columns])
+        old_columns = ", ".join([F"old.{column}" for column in self.fts_columns])
+        
+        cmd = F"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(
+            {columns},
+            content='songs',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        );
+        """
+        try:
+            self.cursor.execute(cmd)
+        except sqlite3.OperationalError:
+            #no FTS5 compiled into this sqlite
+            return False
+        
+        cmd = F"""
+        CREATE TRIGGER IF NOT EXISTS songs_fts_insert AFTER INSERT ON songs BEGIN
+            INSERT INTO songs_fts (rowid, {columns}) VALUES (new.id, {new_columns});
+        END;
+        """
+        self.cursor.execute(cmd)
+        
+        cmd = F"""
+        CREATE TRIGGER IF NOT EXISTS songs_fts_delete AFTER DELETE ON songs BEGIN
+            INSERT INTO songs_fts (songs_fts, rowid, {columns}) VALUES ('delete', old.id, {old_columns});
+        END;
+        """
+        self.cursor.execute(cmd)
+        
+        cmd = F"""
+        CREATE TRIGGER IF NOT EXISTS songs_fts_update AFTER UPDATE OF {columns} ON songs BEGIN
+            INSERT INTO songs_fts (songs_fts, rowid, {columns}) VALUES ('delete', old.id, {old_columns});
+            INSERT INTO songs_fts (rowid, {columns}) VALUES (new.id, {new_columns});
+        END;
+        """
+        self.cursor.execute(cmd)
+        
+        if is_new:
+            #index songs that were added before the fts table existed
+            self.cursor.execute("INSERT INTO songs_fts (songs_fts) VALUES ('rebuild')")
+        
+        return True
+    
+    def create_facet_counts(self) -> None:
+        #(facet, value) -> number of songs with that value in the facet column, NULL values are not counted
+        #triggers add and subtract the rows of every insert / update / delete on songs,
+        #so the counts stay right for writes from other processes (update_index.py) too
+        
+        cmd = "SELECT name FROM sqlite_master WHERE type='table' AND name='facet_counts'"
+        self.cursor.execute(cmd)
+        is_new = self.cursor.fetchone() is None
+        
+        #value has no type, so numbers stay numbers and text stays text
+        cmd = """
+        CREATE TABLE IF NOT EXISTS facet_counts (
+            facet TEXT NOT NULL,
+            value NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (facet, value)
+        ) WITHOUT ROWID;
+        """
+        self.cursor.execute(cmd)
+        
+        def add(column: str, row: str) -> str:
+            return F"""
+            INSERT INTO facet_counts (facet, value, count) SELECT '{column}', {row}.{column}, 1 WHERE {row}.{column} IS NOT NULL
+            ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+            """
+        
+        def subtract(column: str, row: str) -> str:
+            return F"""
+            UPDATE facet_counts SET count = count - 1 WHERE facet = '{column}' AND value = {row}.{column};
+            DELETE FROM facet_counts WHERE facet = '{column}' AND value = {row}.{column} AND count <= 0;
+            """
+        
+        cmd = F"""
+        CREATE TRIGGER IF NOT EXISTS songs_facets_insert AFTER INSERT ON songs BEGIN
+            {"".join([add(column, "new") for column in self.facet_columns])}
+        END;
+        """
+        self.cursor.execute(cmd)
+        
+        cmd = F"""
+        CREATE TRIGGER IF NOT EXISTS songs_facets_delete AFTER DELETE ON songs BEGIN
+            {"".join([subtract(column, "old") for column in self.facet_columns])}
+        END;
+        """
+        self.cursor.execute(cmd)
+        
+        #one trigger per column, so an update only touches the counts of the columns it changed
+        for column in self.facet_columns:
+            cmd = F"""
+            CREATE TRIGGER IF NOT EXISTS songs_facets_update_{column} AFTER UPDATE OF {column} ON songs
+            WHEN old.{column} IS NOT new.{column} BEGIN
+                {subtract(column, "old")}
+                {add(column, "new")}
+            END;
+            """
+            self.cursor.execute(cmd)
+        
+        if is_new:
+            #count songs that were added before the table existed
+            self.rebuild_facet_counts()
+    
+    def rebuild_facet_counts(self) -> None:
+        #one GROUP BY per column, each is a scan of the column index (idx_songs_{column})
+        self.cursor.execute("DELETE FROM facet_counts")
+        for column in self.facet_columns:
+            cmd = F"""
+            INSERT INTO facet_counts (facet, value, count)
+            SELECT '{column}', {column}, COUNT(*) FROM songs WHERE {column} IS NOT NULL GROUP BY {column}
+            """
+            self.cursor.execute(cmd)
+    
+    def get_facets(self, columns: list[str], limit: int = None) -> dict[str, dict]:
+        #{column: {value: count}} for every facet column in columns, most common values first
+        #limit keeps only the most common values of every column
+        columns = [column for column in columns if column in self.facet_columns]
+        
+        facets = {}
+        cursor = self.read_cursor()
+        for column in columns:
+            cmd = "SELECT value, count FROM facet_counts WHERE facet=? ORDER BY count DESC, value LIMIT ?"
+            cursor.execute(cmd, (column, limit if limit is not None else -1))
+            facets[column] = dict(cursor.fetchall())
+        return facets
         
     
     def get_num_entries(self, table_name: str = "songs") -> int:
         cmd = F"SELECT MAX(id) FROM {table_name}"
-        self.cursor.execute(cmd)
-        return self.cursor.fetchone()[0]
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        return cursor.fetchone()[0]
 
-    def get_songs(self, mode: str = "AND", limit: int = 10, **restraints) -> list[SongEntry]:
-        options = ["id", "bpm", "length", "kbps", "genre", "artist", "album", "name"]
+    def compile_restraints(self, mode: str = "AND", limit: int = None, **restraints) -> tuple[str, list]:
+        #turns a restraint dict into one parameterized SELECT statement
+        #scalar values are compared with "=", tuples / lists are (min, max) ranges
+        #e.g. mode="AND", bpm=(100, 140), genre="Rock"
+        #  -> "SELECT id, name, ... FROM songs WHERE bpm BETWEEN ? AND ? AND genre = ? LIMIT ?", [100, 140, "Rock", limit]
+        
         mode_options = ["AND", "OR"]
         
-        restraints = {key: value for key, value in restraints.items() if key in options}
         mode = mode.upper()
         if mode not in mode_options:
             raise ValueError(F"Invalid mode {mode}. Must be one of {mode_options}")
         
-        all_songs = self.get_all_songs()
-        songs_out = []
+        clauses = []
+        args = []
         
         for key, value in restraints.items():
-            prev_num = len(all_songs)
-            
-            new_songs = []
-            for song in all_songs:
-                
-                if type(value) == tuple:
-                    if song.__dict__[key] >= value[0] and song.__dict__[key] <= value[1]:
-                        new_songs.append(song)
-                else:
-                    if song.__dict__[key] == value:
-                        new_songs.append(song)
-            
-            if mode == "AND": #limit to songs that match all restraints
-                all_songs = new_songs
-                songs_out = new_songs
-            elif mode == "OR":
-                songs_out += new_songs
-            
-            print(key, prev_num, " -> ", len(all_songs))
-            
+            if key not in self.filter_columns:
+                continue
             
+            if type(value) in [tuple, list]:
+                clauses.append(F"{key} BETWEEN ? AND ?")
+                args += [value[0], value[1]]
+            else:
+                clauses.append(F"{key} = ?")
+                args.append(value)
+        
+        cmd = F"SELECT {SONG_COLUMNS} FROM songs"
+        
+        if len(clauses) > 0:
+            cmd += " WHERE " + F" {mode} ".join(clauses)
+        
         if limit is not None:
-            songs_out = list(set(songs_out))[:limit]
-        else:
-            print("limit is None")
-            songs_out = list(set(songs_out))
+            cmd += " LIMIT ?"
+            args.append(limit)
         
-        return songs_out
+        return cmd, args
+
+    def get_songs(self, mode: str = "AND", limit: int = 10, **restraints) -> list[SongEntry]:
+        restraints = {key: value for key, value in restraints.items() if key in self.filter_columns}
+        
+        if len(restraints) == 0:
+            return []
+        
+        cmd, args = self.compile_restraints(mode, limit, **restraints)
+        cursor = self.read_cursor()
+        cursor.execute(cmd, args)
+        return [SongEntry(*song) for song in cursor.fetchall()]
     
     def get_song_by_id(self, song_id: int) -> SongEntry:
-        cmd = F"SELECT * FROM songs WHERE id={song_id}"
-        self.cursor.execute(cmd)
-        data = self.cursor.fetchone()
+        cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE id={song_id}"
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        data = cursor.fetchone()
         if data is None:
             return None
         else:
             return SongEntry(*data)
     
+    def get_songs_by_ids(self, song_ids: list[int]) -> dict[int, SongEntry]:
+        #{id: SongEntry} in one query, ids without a song are left out
+        if len(song_ids) == 0:
+            return {}
+        cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE id IN ({', '.join(['?'] * len(song_ids))})"
+        cursor = self.read_cursor()
+        cursor.execute(cmd, list(song_ids))
+        return {data[0]: SongEntry(*data) for data in cursor.fetchall()}
+    
     def get_songs_by_id(self, song_id: int, limit: int = 10, upper_limit: int = None) -> list[SongEntry]:
         if upper_limit is None:
-            cmd = F"SELECT * FROM songs WHERE id={song_id} LIMIT {limit}"
+            cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE id={song_id} LIMIT {limit}"
         else:
-            cmd = F"SELECT * FROM songs WHERE id BETWEEN {song_id} AND {upper_limit} LIMIT {limit}"
-        self.cursor.execute(cmd)
-        return [SongEntry(*song) for song in self.cursor.fetchall()]
+            cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE id BETWEEN {song_id} AND {upper_limit} LIMIT {limit}"
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        return [SongEntry(*song) for song in cursor.fetchall()]
     
     def get_song_by_name(self, song_name: str) -> SongEntry:
-        cmd = "SELECT * FROM songs WHERE name=(?)"
-        self.cursor.execute(cmd, (song_name,))
-        data = self.cursor.fetchone()
+        cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE name=(?)"
+        cursor = self.read_cursor()
+        cursor.execute(cmd, (song_name,))
+        data = cursor.fetchone()
         if data is None:
             return None
         else:
             return SongEntry(*data)
     
     def get_song_by_path(self, song_path: str) -> SongEntry:
-        cmd = F"SELECT * FROM songs WHERE abs_path='{song_path}'"
-        self.cursor.execute(cmd)
-        data = self.cursor.fetchone()
+        cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE abs_path='{song_path}'"
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        data = cursor.fetchone()
         if data is None:
             return None
         else:
@@ -239,51 +732,58 @@ class DataBase:
     
     def get_songs_by_bpm(self, song_bpm: int, limit: int = 10, upper_limit: int = None) -> list[SongEntry]:
         if upper_limit is None:
-            cmd = F"SELECT * FROM songs WHERE bpm={song_bpm} LIMIT {limit}"
+            cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE bpm={song_bpm} LIMIT {limit}"
         else:
-            cmd = F"SELECT * FROM songs WHERE bpm BETWEEN {song_bpm} AND {upper_limit} LIMIT {limit}"
-        self.cursor.execute(cmd)
-        return [SongEntry(*song) for song in self.cursor.fetchall()]
+            cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE bpm BETWEEN {song_bpm} AND {upper_limit} LIMIT {limit}"
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        return [SongEntry(*song) for song in cursor.fetchall()]
     
     def get_songs_by_length(self, song_length: int, limit: int = 10, upper_limit: int = None) -> list[SongEntry]:
         if upper_limit is None:
-            cmd = F"SELECT * FROM songs WHERE length={song_length} LIMIT {limit}"
+            cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE length={song_length} LIMIT {limit}"
         else:
-            cmd = F"SELECT * FROM songs WHERE length BETWEEN {song_length} AND {upper_limit} LIMIT {limit}"
-        self.cursor.execute(cmd)
-        return [SongEntry(*song) for song in self.cursor.fetchall()]
+            cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE length BETWEEN {song_length} AND {upper_limit} LIMIT {limit}"
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        return [SongEntry(*song) for song in cursor.fetchall()]
     
     def get_songs_by_kbps(self, song_kbps: int, limit: int = 10, upper_limit: int = None) -> list[SongEntry]:
         if upper_limit is None:
-            cmd = F"SELECT * FROM songs WHERE kbps={song_kbps} LIMIT {limit}"
+            cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE kbps={song_kbps} LIMIT {limit}"
         else:
-            cmd = F"SELECT * FROM songs WHERE kbps BETWEEN {song_kbps} AND {upper_limit} LIMIT {limit}"
-        self.cursor.execute(cmd)
-        return [SongEntry(*song) for song in self.cursor.fetchall()]
+            cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE kbps BETWEEN {song_kbps} AND {upper_limit} LIMIT {limit}"
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        return [SongEntry(*song) for song in cursor.fetchall()]
     
     def get_songs_by_genre(self, song_genre: str, limit: int = 10) -> list[SongEntry]:
-        cmd = F"SELECT * FROM songs WHERE genre='{song_genre}' LIMIT {limit}"
-        self.cursor.execute(cmd)
-        return [SongEntry(*song) for song in self.cursor.fetchall()]
+        cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE genre='{song_genre}' LIMIT {limit}"
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        return [SongEntry(*song) for song in cursor.fetchall()]
     
     def get_songs_by_artist(self, song_artist: str, limit: int = 10) -> list[SongEntry]:
-        cmd = F"SELECT * FROM songs WHERE artist='{song_artist}' LIMIT {limit}"
-        self.cursor.execute(cmd)
-        return [SongEntry(*song) for song in self.cursor.fetchall()]
+        cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE artist='{song_artist}' LIMIT {limit}"
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        return [SongEntry(*song) for song in cursor.fetchall()]
     
     def get_songs_by_album(self, song_album: str, limit: int = 10) -> list[SongEntry]:
-        cmd = F"SELECT * FROM songs WHERE album='{song_album}' LIMIT {limit}"
-        self.cursor.execute(cmd)
-        return [SongEntry(*song) for song in self.cursor.fetchall()]
+        cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE album='{song_album}' LIMIT {limit}"
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        return [SongEntry(*song) for song in cursor.fetchall()]
     
     def get_all_songs(self, limit: int = None) -> list[SongEntry]:
         if limit is not None:
-            cmd = f"SELECT * FROM songs LIMIT {limit}"
+            cmd = f"SELECT {SONG_COLUMNS} FROM songs LIMIT {limit}"
         else:
-            cmd = "SELECT * FROM songs"
+            cmd = F"SELECT {SONG_COLUMNS} FROM songs"
             
-        self.cursor.execute(cmd)
-        return [SongEntry(*song) for song in self.cursor.fetchall()]
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        return [SongEntry(*song) for song in cursor.fetchall()]
     
     def get_random_song(self, recursion_idx: int = 0) -> SongEntry:
         
@@ -293,15 +793,17 @@ class DataBase:
         max_id = self.get_num_entries()
         song_id = np.random.randint(1, max_id)
         
-        cmd = F"SELECT * FROM songs WHERE id={song_id}"
-        self.cursor.execute(cmd)
-        data = self.cursor.fetchone()
+        cmd = F"SELECT {SONG_COLUMNS} FROM songs WHERE id={song_id}"
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        data = cursor.fetchone()
         if data is None:
             return self.get_random_song(recursion_idx + 1)
         else:
             return SongEntry(*data)
     
     
+    @writes
     def add_song(self, song: SongEntry, id_is_auto_increment: bool = True) -> None:
         if id_is_auto_increment:
             try:
@@ -309,54 +811,401 @@ class DataBase:
             except TypeError:
                 #table is empty
                 song.id = 1
-        cmd = "INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-        self.cursor.execute(cmd, (song.id, song.name, song.abs_path, song.bpm, song.length, song.kbps, song.genre, song.artist, song.album, song.album_art))
-        self.conn.commit()
+        
+        #the art row goes away again if the insert fails (name or abs_path taken)
+        with self.transaction():
+            if song.album_art:
+                song.art_hash = self.add_art(song.album_art, commit=False)
+            
+            cmd = F"INSERT INTO songs ({SONG_COLUMNS}, search_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            self.cursor.execute(cmd, (song.id, song.name, song.abs_path, song.bpm, song.length, song.kbps, song.genre, song.artist, song.album, song.art_hash, get_search_path(song.abs_path)))
+    
+    @writes
+    def add_songs(self, songs: list[SongEntry], commit: bool = True) -> list[SongEntry]:
+        #inserts many songs in a single transaction, ids are assigned by sqlite
+        #songs whose name or abs_path is already in the db are skipped
+        #returns the songs that were added, with their ids set
+        
+        cmd = F"INSERT OR IGNORE INTO songs ({SONG_COLUMNS}, search_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        
+        added = []
+        for song in songs:
+            if song.album_art:
+                song.art_hash = get_art_hash(song.album_art)
+            
+            self.cursor.execute(cmd, (None, song.name, song.abs_path, song.bpm, song.length, song.kbps, song.genre, song.artist, song.album, song.art_hash, get_search_path(song.abs_path)))
+            if self.cursor.rowcount == 0:
+                continue
+            
+            song.id = self.cursor.lastrowid
+            if song.album_art:
+                self.add_art(song.album_art, commit=False)
+                song.album_art = None
+            added.append(song)
+        
+        if commit:
+            self.conn.commit()
+        return added
+    
+    @writes
+    def update_song(self, song: SongEntry, commit: bool = True) -> None:
+        #overwrites the metadata of song.id, the id stays the same
+        #nothing is written if the update fails (name or abs_path taken by another song), not even the art
+        old_song = self.get_song_by_id(song.id)
+        
+        with self.atomic(commit):
+            art_hash = song.art_hash
+            if song.album_art:
+                art_hash = self.add_art(song.album_art, commit=False)
+            
+            #a song without a TBPM tag keeps the bpm from the analysis
+            cmd = "UPDATE songs SET name=?, abs_path=?, search_path=?, bpm=COALESCE(NULLIF(?, 0), CAST(ROUND(tempo) AS INTEGER), ?), length=?, kbps=?, genre=?, artist=?, album=?, art_hash=? WHERE id=?"
+            self.cursor.execute(cmd, (song.name, song.abs_path, get_search_path(song.abs_path), song.bpm, song.bpm, song.length, song.kbps, song.genre, song.artist, song.album, art_hash, song.id))
+            
+            if old_song is not None:
+                self.remove_unused_art(old_song.art_hash)
+        
+        song.art_hash = art_hash
+        song.album_art = None
     
-    def delete_song(self, song_id: int) -> None:
+    @writes
+    def delete_song(self, song_id: int, commit: bool = True) -> None:
+        song = self.get_song_by_id(song_id)
+        
         cmd = F"DELETE FROM songs WHERE id={song_id}"
         self.cursor.execute(cmd)
-        self.conn.commit()
+        #playlist_songs rows are deleted by the songs_playlist_songs_delete trigger
+        self.cursor.execute("DELETE FROM favorites WHERE song_id=?", (song_id,))
+        
+        if song is not None:
+            self.remove_unused_art(song.art_hash)
+        
+        if commit:
+            self.conn.commit()
+            self.invalidate_favorites()
+    
+    
+    def get_fingerprints(self, path: str = None) -> dict[str, tuple]:
+        #abs_path -> (id, mtime, size, inode, hash) of every song
+        #or, with path set, only of the song at path and of the songs below it if it is a directory
+        cmd = "SELECT abs_path, id, file_mtime, file_size, file_inode, file_hash FROM songs"
+        cursor = self.read_cursor()
+        
+        if path is None:
+            cursor.execute(cmd)
+        else:
+            directory = path.rstrip(os.sep) + os.sep
+            cmd += " WHERE abs_path=? OR substr(abs_path, 1, ?)=?"
+            cursor.execute(cmd, (path, len(directory), directory))
+        
+        return {row[0]: row[1:] for row in cursor.fetchall()}
+    
+    def get_skipped_files(self, path: str = None) -> dict[str, tuple]:
+        #abs_path -> (mtime, size, inode, hash) of the skipped files, filtered by path like get_fingerprints
+        cmd = "SELECT abs_path, file_mtime, file_size, file_inode, file_hash FROM skipped_files"
+        cursor = self.read_cursor()
+        
+        if path is None:
+            cursor.execute(cmd)
+        else:
+            directory = path.rstrip(os.sep) + os.sep
+            cmd += " WHERE abs_path=? OR substr(abs_path, 1, ?)=?"
+            cursor.execute(cmd, (path, len(directory), directory))
+        
+        return {row[0]: row[1:] for row in cursor.fetchall()}
+    
+    @writes
+    def set_skipped_file(self, path: str, fingerprint: tuple, commit: bool = True) -> None:
+        #fingerprint: (mtime, size, inode, hash), see get_fingerprint
+        cmd = "INSERT OR REPLACE INTO skipped_files (abs_path, file_mtime, file_size, file_inode, file_hash) VALUES (?, ?, ?, ?, ?)"
+        self.cursor.execute(cmd, (path, *fingerprint))
+        if commit:
+            self.conn.commit()
+    
+    @writes
+    def remove_skipped_files(self, paths: list[str] = None, commit: bool = True) -> None:
+        #all skipped files if paths is None, e.g. after a song was deleted and its name is free again
+        if paths is None:
+            self.cursor.execute("DELETE FROM skipped_files")
+        else:
+            self.cursor.executemany("DELETE FROM skipped_files WHERE abs_path=?", [(path,) for path in paths])
+        if commit:
+            self.conn.commit()
+    
+    def get_song_mtimes(self, first_id: int, last_id: int) -> list[tuple[int, float]]:
+        #(id, file_mtime) of the songs with first_id <= id <= last_id in id order, file_mtime may be None
+        cmd = "SELECT id, file_mtime FROM songs WHERE id BETWEEN ? AND ? ORDER BY id"
+        cursor = self.read_cursor()
+        cursor.execute(cmd, (first_id, last_id))
+        return cursor.fetchall()
+    
+    @writes
+    def set_fingerprint(self, song_id: int, fingerprint: tuple, commit: bool = True) -> None:
+        #fingerprint: (mtime, size, inode, hash), see get_fingerprint
+        cmd = "UPDATE songs SET file_mtime=?, file_size=?, file_inode=?, file_hash=? WHERE id=?"
+        self.cursor.execute(cmd, (*fingerprint, song_id))
+        if commit:
+            self.conn.commit()
+    
+    def get_songs_to_analyze(self) -> list[tuple[int, str, float]]:
+        #(id, abs_path, mtime) of the songs that were not analyzed yet or whose file changed since
+        cmd = """
+        SELECT id, abs_path, COALESCE(file_mtime, 0) FROM songs
+        WHERE analyzed_mtime IS NULL OR analyzed_mtime != COALESCE(file_mtime, 0)
+        ORDER BY id
+        """
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        return cursor.fetchall()
+    
+    @writes
+    def set_analysis(self, song_id: int, analysis: dict, mtime: float, commit: bool = True) -> None:
+        #analysis: see fmusic_analysis.analyze, mtime: as returned by get_songs_to_analyze
+        #bpm is filled from the tempo unless it came from a TBPM tag (it is 0 or the rounded old tempo)
+        cmd = """
+        UPDATE songs SET
+            bpm = CASE WHEN ? IS NOT NULL AND (bpm IS NULL OR bpm = 0 OR bpm = CAST(ROUND(tempo) AS INTEGER)) THEN CAST(ROUND(?) AS INTEGER) ELSE bpm END,
+            tempo=?, musical_key=?, loudness=?, duration=?, analyzed_mtime=?
+        WHERE id=?
+        """
+        tempo = analysis["tempo"]
+        self.cursor.execute(cmd, (tempo, tempo, tempo, analysis["musical_key"], analysis["loudness"], analysis["duration"], mtime, song_id))
+        if commit:
+            self.conn.commit()
+    
+    @writes
+    def move_song(self, song_id: int, new_path: str, fingerprint: tuple, commit: bool = True) -> None:
+        #the file of a song was renamed or moved, its metadata is unchanged
+        cmd = "UPDATE songs SET abs_path=?, search_path=? WHERE id=?"
+        self.cursor.execute(cmd, (new_path, get_search_path(new_path), song_id))
+        self.set_fingerprint(song_id, fingerprint, commit)
+    
+    
+    @writes
+    def add_art(self, data: bytes, commit: bool = True) -> str:
+        #stores an image in the album_art table and returns its hash
+        #an image that is already stored is not written again
+        if not data:
+            return None
+        
+        data = bytes(data)
+        art_hash = get_art_hash(data)
+        
+        cmd = "INSERT OR IGNORE INTO album_art VALUES (?, ?, ?)"
+        self.cursor.execute(cmd, (art_hash, get_image_mime(data), data))
+        
+        if commit:
+            self.conn.commit()
+        return art_hash
+    
+    @writes
+    def remove_unused_art(self, art_hash: str) -> None:
+        #drops a cover once no song uses it anymore
+        if art_hash is None:
+            return
+        cmd = "DELETE FROM album_art WHERE hash=? AND NOT EXISTS (SELECT 1 FROM songs WHERE art_hash=?)"
+        self.cursor.execute(cmd, (art_hash, art_hash))
+    
+    def get_art(self, art_hash: str) -> tuple[str, bytes]:
+        #returns (mime, data) or None
+        cmd = "SELECT mime, data FROM album_art WHERE hash=?"
+        cursor = self.read_cursor()
+        cursor.execute(cmd, (art_hash,))
+        return cursor.fetchone()
     
     
     
     def get_playlist(self, playlist_id: int) -> PlaylistEntry:
-        cmd = F"SELECT * FROM playlists WHERE id={playlist_id}"
-        self.cursor.execute(cmd)
-        id, name, playlist_art, songs = self.cursor.fetchone()
+        #returns None if there is no such playlist
+        cmd = "SELECT id, name, playlist_art FROM playlists WHERE id=?"
+        cursor = self.read_cursor()
+        cursor.execute(cmd, (playlist_id,))
+        data = cursor.fetchone()
+        if data is None:
+            return None
+        id, name, playlist_art = data
         
-        songs = list_str_to_list(songs)
-        songs = [self.get_song_by_id(int(song_id)) for song_id in songs]
+        #all tracks in one query, in playlist order
+        cmd = F"""
+        SELECT {SONG_COLUMNS_QUALIFIED} FROM playlist_songs
+        JOIN songs ON songs.id = playlist_songs.song_id
+        WHERE playlist_songs.playlist_id=?
+        ORDER BY playlist_songs.position
+        """
+        cursor.execute(cmd, (playlist_id,))
+        songs = [SongEntry(*song) for song in cursor.fetchall()]
         
         return PlaylistEntry(id, name, playlist_art, songs)
+    
+    def get_playlist_name(self, playlist_id: int) -> str:
+        #returns None if there is no such playlist
+        cursor = self.read_cursor()
+        cursor.execute("SELECT name FROM playlists WHERE id=?", (playlist_id,))
+        data = cursor.fetchone()
+        return data[0] if data is not None else None
+    
+    def get_playlist_page(self, playlist_id: int, limit: int = PAGE_SIZE, after: str = None) -> SongPage:
+        #one page of tracks in playlist order, after is the next cursor of the page before
+        #pages are keyed on position (idx_playlist_songs_position), a page deep into the playlist costs the same as the first
+        cursor = self.read_cursor()
+        cmd = "SELECT COUNT(*) FROM playlist_songs JOIN songs ON songs.id = playlist_songs.song_id WHERE playlist_songs.playlist_id=?"
+        cursor.execute(cmd, (playlist_id,))
+        total = cursor.fetchone()[0]
         
-    def add_playlist(self, playlist: PlaylistEntry) -> None:
+        args = [playlist_id]
+        keyset = ""
+        if after is not None:
+            position, = decode_cursor(after)
+            keyset = "AND playlist_songs.position > ?"
+            args.append(position)
         
-        song_ids = [song.id for song in playlist.songs]
-        song_ids = str(song_ids)
+        cmd = F"""
+        SELECT playlist_songs.position, {SONG_COLUMNS_QUALIFIED} FROM playlist_songs
+        JOIN songs ON songs.id = playlist_songs.song_id
+        WHERE playlist_songs.playlist_id=? {keyset}
+        ORDER BY playlist_songs.position
+        LIMIT ?
+        """
+        songs, next = self.read_page(cmd, args, limit, 1)
+        return SongPage(songs, total, next)
+    
+    @writes
+    def add_playlist(self, playlist: PlaylistEntry) -> None:
+        #playlist.id may be None, it is set to the id sqlite assigns
         
         if playlist.playlist_art is None:
             playlist.playlist_art = b"NULL"
         
-        cmd = "INSERT INTO playlists VALUES (?, ?, ?, ?)"
+        cmd = "INSERT INTO playlists (id, name, playlist_art) VALUES (?, ?, ?)"
         
-        self.cursor.execute(cmd, (playlist.id, playlist.name, playlist.playlist_art, song_ids))
-        self.conn.commit()
+        with self.transaction():
+            self.cursor.execute(cmd, (playlist.id, playlist.name, playlist.playlist_art))
+            playlist.id = self.cursor.lastrowid
+            self.append_to_playlist(playlist.id, [song.id for song in playlist.songs], commit=False)
     
+    @writes
     def delete_playlist(self, playlist_id: int) -> None:
-        cmd = F"DELETE FROM playlists WHERE id={playlist_id}"
-        self.cursor.execute(cmd)
-        self.conn.commit()
+        with self.transaction():
+            self.cursor.execute("DELETE FROM playlist_songs WHERE playlist_id=?", (playlist_id,))
+            self.cursor.execute("DELETE FROM playlists WHERE id=?", (playlist_id,))
     
+    @writes
     def update_playlist(self, playlist: PlaylistEntry) -> None:
-        id = playlist.id
-        cmd = f"UPDATE playlists SET name=?, playlist_art=?, songs=? WHERE id={id}"
+        #replaces name, art and the whole track list
+        #use append_to_playlist / remove_from_playlist / move_in_playlist for single tracks
+        cmd = "UPDATE playlists SET name=?, playlist_art=? WHERE id=?"
         
-        song_ids = [song.id for song in playlist.songs]
-        song_ids = str(song_ids)
+        with self.transaction():
+            self.cursor.execute(cmd, (playlist.name, playlist.playlist_art, playlist.id))
+            self.cursor.execute("DELETE FROM playlist_songs WHERE playlist_id=?", (playlist.id,))
+            self.append_to_playlist(playlist.id, [song.id for song in playlist.songs], commit=False)
+    
+    @writes
+    def append_to_playlist(self, playlist_id: int, song_ids: list[int], commit: bool = True) -> bool:
+        #adds the songs to the end of the playlist
+        #returns False and adds nothing if there is no such playlist or one of the songs does not exist
+        self.cursor.execute("SELECT 1 FROM playlists WHERE id=?", (playlist_id,))
+        if self.cursor.fetchone() is None:
+            return False
         
-        self.cursor.execute(cmd, (playlist.name, playlist.playlist_art, song_ids))
-        self.conn.commit()
+        unique_ids = list(set(song_ids))
+        if len(unique_ids) > 0:
+            self.cursor.execute(F"SELECT COUNT(*) FROM songs WHERE id IN ({', '.join(['?'] * len(unique_ids))})", unique_ids)
+            if self.cursor.fetchone()[0] != len(unique_ids):
+                return False
+        
+        self.cursor.execute("SELECT MAX(position) FROM playlist_songs WHERE playlist_id=?", (playlist_id,))
+        last = self.cursor.fetchone()[0] or 0
+        
+        cmd = "INSERT INTO playlist_songs (playlist_id, position, song_id) VALUES (?, ?, ?)"
+        self.cursor.executemany(cmd, [(playlist_id, last + idx, song_id) for idx, song_id in enumerate(song_ids, 1)])
+        
+        if commit:
+            self.conn.commit()
+        return True
+    
+    @writes
+    def remove_from_playlist(self, playlist_id: int, index: int, commit: bool = True) -> bool:
+        #removes the track at index (0 based), returns False if there is none
+        cmd = """
+        DELETE FROM playlist_songs WHERE id=(
+            SELECT playlist_songs.id FROM playlist_songs
+            JOIN songs ON songs.id = playlist_songs.song_id
+            WHERE playlist_songs.playlist_id=? ORDER BY playlist_songs.position LIMIT 1 OFFSET ?
+        )
+        """
+        self.cursor.execute(cmd, (playlist_id, index))
+        removed = self.cursor.rowcount > 0
+        
+        if commit:
+            self.conn.commit()
+        return removed
+    
+    @writes
+    def move_in_playlist(self, playlist_id: int, index: int, new_index: int, commit: bool = True) -> bool:
+        #moves the track at index so it ends up at new_index (both 0 based)
+        #only the moved row is written, unless the positions around new_index are too close together
+        with self.atomic(commit):
+            cmd = """
+            SELECT playlist_songs.id FROM playlist_songs
+            JOIN songs ON songs.id = playlist_songs.song_id
+            WHERE playlist_songs.playlist_id=? ORDER BY playlist_songs.position LIMIT 1 OFFSET ?
+            """
+            self.cursor.execute(cmd, (playlist_id, index))
+            data = self.cursor.fetchone()
+            if data is None:
+                return False
+            entry_id = data[0]
+            
+            position = self.free_position(playlist_id, new_index, entry_id)
+            if position is None:
+                self.renumber_playlist(playlist_id, commit=False)
+                position = self.free_position(playlist_id, new_index, entry_id)
+            
+            self.cursor.execute("UPDATE playlist_songs SET position=? WHERE id=?", (position, entry_id))
+        return True
+    
+    def free_position(self, playlist_id: int, index: int, entry_id: int) -> float:
+        #a position that puts entry_id at index among the other tracks of the playlist
+        #None if the two neighbours are too close together for a float in between
+        cmd = """
+        SELECT playlist_songs.position FROM playlist_songs
+        JOIN songs ON songs.id = playlist_songs.song_id
+        WHERE playlist_songs.playlist_id=? AND playlist_songs.id!=? ORDER BY playlist_songs.position LIMIT 2 OFFSET ?
+        """
+        self.cursor.execute(cmd, (playlist_id, entry_id, max(index - 1, 0)))
+        positions = [row[0] for row in self.cursor.fetchall()]
+        
+        if index <= 0:
+            return positions[0] - 1 if len(positions) > 0 else 1.0
+        
+        if len(positions) < 2:
+            #new_index is at or past the end
+            self.cursor.execute("SELECT MAX(position) FROM playlist_songs WHERE playlist_id=? AND id!=?", (playlist_id, entry_id))
+            last = self.cursor.fetchone()[0]
+            return last + 1 if last is not None else 1.0
+        
+        before, after = positions
+        position = (before + after) / 2
+        if position in [before, after]:
+            return None
+        return position
+    
+    @writes
+    def renumber_playlist(self, playlist_id: int, commit: bool = True) -> None:
+        #spreads the positions out to 1, 2, 3, ... again
+        #first above every current position, then down by the same offset,
+        #so no two rows share a position in between (unique index), whatever the positions were before
+        #(moves to the front make them zero or negative)
+        with self.atomic(commit):
+            self.cursor.execute("SELECT id FROM playlist_songs WHERE playlist_id=? ORDER BY position", (playlist_id,))
+            entry_ids = [row[0] for row in self.cursor.fetchall()]
+            
+            self.cursor.execute("SELECT MAX(ABS(position)) FROM playlist_songs WHERE playlist_id=?", (playlist_id,))
+            offset = int(self.cursor.fetchone()[0] or 0) + len(entry_ids) + 1
+            
+            self.cursor.executemany("UPDATE playlist_songs SET position=? WHERE id=?", [(offset + position, entry_id) for position, entry_id in enumerate(entry_ids, 1)])
+            self.cursor.execute("UPDATE playlist_songs SET position=position-? WHERE playlist_id=?", (offset, playlist_id))
 
     def dynamic_playlist(self, params:dict) -> PlaylistEntry:
         #params = {
@@ -368,87 +1217,234 @@ class DataBase:
         #   "genre": str,
         #   "artist": str,
         #   "album": str,
-        #   "name": str
+        #   "name": str,
+        #   "tempo": (float, float) or float, "musical_key": str, "loudness": (float, float) or float, "duration": (float, float) or float
         #}
         
         mode = params.get("mode", "AND")
+        limit = params.get("limit", -1) #LIMIT -1 means no limit in sqlite
         
-        #get all songs
-        all_songs = self.get_all_songs()
-        
-        if mode == "OR":
-            songs_out = []
-            for key, value in params.items():
-                for song in all_songs:
-                    if type(value) == tuple:
-                        if song.__dict__[key] >= value[0] and song.__dict__[key] <= value[1]:
-                            songs_out.append(song)
-                    else:
-                        if song.__dict__[key] == value:
-                            songs_out.append(song)
-        else:
-            songs_out = all_songs
-            for key, value in params.items():
-                new_songs = []
-                for song in all_songs:
-                    if type(value) == tuple:
-                        if song.__dict__[key] >= value[0] and song.__dict__[key] <= value[1]:
-                            new_songs.append(song)
-                    else:
-                        if song.__dict__[key] == value:
-                            new_songs.append(song)
-                songs_out = new_songs
-        
-        #limit to params["limit"] songs
-        limit = params.get("limit", -1)
-        songs_out = list(set(songs_out))[:limit]
+        restraints = {key: value for key, value in params.items() if key in self.filter_columns}
+        
+        cmd, args = self.compile_restraints(mode, limit, **restraints)
+        cursor = self.read_cursor()
+        cursor.execute(cmd, args)
+        songs_out = [SongEntry(*song) for song in cursor.fetchall()]
         
         return PlaylistEntry(0, "Dynamic Playlist", None, songs_out)
 
-    def playlist_from_full_text_search(self, q: str) -> PlaylistEntry:
+    def playlist_from_full_text_search(self, q: str, limit: int = 100) -> PlaylistEntry:
         #searches all columns for q
         #returns a list of SongEntry objects
         #that contain q in one of their columns
         
-        songs = self.full_text_search(q)
+        songs = self.full_text_search(q, limit)
         return PlaylistEntry(0, "Search Results", None, songs)
     
     
 
+    @writes
     def add_to_favorite(self, song_id: int) -> None:
-        cmd = "INSERT INTO favorites VALUES (?, ?)"
-        self.cursor.execute(cmd, (None, song_id))
+        #adding a favorite twice keeps the first entry (song_id is unique)
+        cmd = "INSERT OR IGNORE INTO favorites (song_id) VALUES (?)"
+        self.cursor.execute(cmd, (song_id,))
         self.conn.commit()
+        self.invalidate_favorites()
     
+    @writes
     def remove_from_favorite(self, song_id: int) -> None:
-        cmd = F"DELETE FROM favorites WHERE song_id={song_id}"
-        self.cursor.execute(cmd)
+        cmd = "DELETE FROM favorites WHERE song_id=?"
+        self.cursor.execute(cmd, (song_id,))
         self.conn.commit()
+        self.invalidate_favorites()
+    
+    def invalidate_favorites(self) -> None:
+        #called after every commit that changes favorites, the next lookup reloads the set
+        with self.favorites_lock:
+            self.favorite_ids = None
+    
+    def get_favorite_ids(self) -> set[int]:
+        #a load that races with invalidate_favorites is dropped by it, so a stale set is never kept
+        #commits of other connections (update_index.py, another DataBase) do not call invalidate_favorites,
+        #they change the data_version of version_conn instead
+        with self.favorites_lock:
+            data_version = self.version_conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version != self.favorites_version:
+                self.favorite_ids = None
+                self.favorites_version = data_version
+            if self.favorite_ids is None:
+                cursor = self.read_cursor()
+                cursor.execute("SELECT song_id FROM favorites")
+                self.favorite_ids = {row[0] for row in cursor.fetchall()}
+            return self.favorite_ids
     
     def get_favorites(self) -> list[SongEntry]:
-        cmd = "SELECT * FROM favorites"
-        self.cursor.execute(cmd)
-        favorites = [self.get_song_by_id(song_id) for _, song_id in self.cursor.fetchall()]
-        return favorites
+        #in the order they were added
+        cmd = F"""
+        SELECT {SONG_COLUMNS_QUALIFIED} FROM favorites
+        JOIN songs ON songs.id = favorites.song_id
+        ORDER BY favorites.id
+        """
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        return [SongEntry(*song) for song in cursor.fetchall()]
+    
+    def get_favorites_page(self, limit: int = PAGE_SIZE, after: str = None) -> SongPage:
+        #one page of favorites in the order they were added, keyed on favorites.id
+        cmd = "SELECT COUNT(*) FROM favorites JOIN songs ON songs.id = favorites.song_id"
+        cursor = self.read_cursor()
+        cursor.execute(cmd)
+        total = cursor.fetchone()[0]
+        
+        args = []
+        keyset = ""
+        if after is not None:
+            favorite_id, = decode_cursor(after)
+            keyset = "WHERE favorites.id > ?"
+            args.append(favorite_id)
+        
+        cmd = F"""
+        SELECT favorites.id, {SONG_COLUMNS_QUALIFIED} FROM favorites
+        JOIN songs ON songs.id = favorites.song_id
+        {keyset}
+        ORDER BY favorites.id
+        LIMIT ?
+        """
+        songs, next = self.read_page(cmd, args, limit, 1)
+        return SongPage(songs, total, next)
     
     def get_favorite_playlist(self) -> PlaylistEntry:
         favorites = self.get_favorites()
         return PlaylistEntry(0, "Favorites", None, favorites)
     
     def is_favorite(self, song_id: int) -> bool:
-        cmd = "SELECT * FROM favorites WHERE song_id=(?)"
-        self.cursor.execute(cmd, (song_id,))
-        return len(self.cursor.fetchall()) > 0
+        return song_id in self.get_favorite_ids()
+    
+    def are_favorites(self, song_ids: list[int]) -> dict[int, bool]:
+        favorite_ids = self.get_favorite_ids()
+        return {song_id: song_id in favorite_ids for song_id in song_ids}
 
     
-    def full_text_search(self, q: str) -> list[SongEntry]:
-        #searches all columns for q
-        #returns a list of SongEntry objects
-        #that contain q in one of their columns
+    def full_text_search(self, q: str, limit: int = 100) -> list[SongEntry]:
+        #searches name, artist, album, genre and the path (see get_search_path) for q
+        #returns up to limit SongEntry objects, best bm25 match first
+        return self.full_text_search_page(q, limit, count=False).songs
+    
+    def full_text_search_page(self, q: str, limit: int = PAGE_SIZE, after: str = None, count: bool = True) -> SongPage:
+        #one page of the matches for q, best bm25 match first
+        #the last word of q is matched as a prefix ("the beat" finds "The Beatles")
+        #pages are keyed on (score, rowid), so every match shows up exactly once over all pages
         
-        cmd = F"SELECT * FROM songs WHERE name LIKE '%{q}%' OR abs_path LIKE '%{q}%' OR bpm LIKE '%{q}%' OR length LIKE '%{q}%' OR kbps LIKE '%{q}%' OR genre LIKE '%{q}%' OR artist LIKE '%{q}%' OR album LIKE '%{q}%'"
-        self.cursor.execute(cmd)
-        return [SongEntry(*song) for song in self.cursor.fetchall()]
+        words = re.findall(r"\w+", q)
+        if len(words) == 0:
+            return SongPage([], 0, None)
+        
+        if not self.has_fts:
+            return self.like_search_page(words, limit, after, count)
+        
+        #quote every word so fts5 operators in q are matched literally
+        #only the last word is a prefix, the others are complete words (search as you type)
+        match = " ".join([F'"{word}"' for word in words[:-1]] + [F'"{words[-1]}"*'])
+        weights = ", ".join([str(weight) for weight in self.fts_weights])
+        
+        args = [match]
+        keyset = ""
+        if after is not None:
+            score, rowid = decode_cursor(after)
+            keyset = "WHERE score > ? OR (score = ? AND rowid > ?)"
+            args += [score, score, rowid]
+        
+        #rank inside the fts table first, so only the hits of this page are joined against songs
+        cmd = F"""
+        SELECT hits.score, hits.rowid, {SONG_COLUMNS} FROM (
+            SELECT rowid, score FROM (
+                SELECT rowid, bm25(songs_fts, {weights}) AS score FROM songs_fts
+                WHERE songs_fts MATCH ?
+            )
+            {keyset}
+            ORDER BY score, rowid
+            LIMIT ?
+        ) AS hits
+        JOIN songs ON songs.id = hits.rowid
+        ORDER BY hits.score, hits.rowid
+        """
+        songs, next = self.read_page(cmd, args, limit, 2)
+        
+        total = None
+        if count:
+            cursor = self.read_cursor()
+            cursor.execute("SELECT COUNT(*) FROM songs_fts WHERE songs_fts MATCH ?", (match,))
+            total = cursor.fetchone()[0]
+        
+        return SongPage(songs, total, next)
+    
+    def like_search_page(self, words: list[str], limit: int = PAGE_SIZE, after: str = None, count: bool = True) -> SongPage:
+        #fallback for sqlite builds without FTS5, in id order
+        #every word has to appear in one of the fts columns
+        
+        clauses = []
+        args = []
+        for word in words:
+            clauses.append("(" + " OR ".join([F"{column} LIKE ?" for column in self.fts_columns]) + ")")
+            args += [F"%{word}%"] * len(self.fts_columns)
+        where = " AND ".join(clauses)
+        
+        total = None
+        if count:
+            cursor = self.read_cursor()
+            cursor.execute("SELECT COUNT(*) FROM songs WHERE " + where, args)
+            total = cursor.fetchone()[0]
+        
+        if after is not None:
+            song_id, = decode_cursor(after)
+            where += " AND id > ?"
+            args = args + [song_id]
+        
+        cmd = F"SELECT id, {SONG_COLUMNS} FROM songs WHERE {where} ORDER BY id LIMIT ?"
+        songs, next = self.read_page(cmd, args, limit, 1)
+        return SongPage(songs, total, next)
+    
+    def read_page(self, cmd: str, args: list, limit: int, key_size: int) -> tuple[list[SongEntry], str]:
+        #cmd selects the sort key (key_size columns) followed by the song columns and ends with LIMIT ?
+        #one row more than limit is read to know if there is a next page
+        cursor = self.read_cursor()
+        cursor.execute(cmd, args + [limit + 1])
+        rows = cursor.fetchall()
+        
+        songs = [SongEntry(*row[key_size:]) for row in rows[:limit]]
+        next = encode_cursor(rows[limit - 1][:key_size]) if len(rows) > limit else None
+        return songs, next
+
+class AsyncDataBase:
+    #awaitable mirror of DataBase for async routes
+    #every method call runs on a dedicated thread pool, so sqlite and the python work around it
+    #never block the event loop, and each pool thread reads on its own connection
+    #
+    #usage:
+    #   adb = AsyncDataBase(db)
+    #   song = await adb.get_song_by_id(1)
+    #   result = await adb.run(func, *args) #any other blocking work
+    
+    def __init__(self, db: DataBase, workers: int = 8) -> None:
+        self.db = db
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="fmusic-db")
+    
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+    
+    def __getattr__(self, name: str):
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+        
+        async def call(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+        return call
+    
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
 
 def dict_to_SongEntry(data: dict) -> SongEntry:
     return SongEntry(
@@ -461,10 +1457,99 @@ def dict_to_SongEntry(data: dict) -> SongEntry:
         data["genre"],
         data["artist"],
         data["album"],
-        data["album_art"]
+        album_art=data["album_art"]
     )
 
 
+def get_art_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def get_image_mime(data: bytes) -> str:
+    #sniff the image type from the magic bytes
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    elif data.startswith(b"\x89PNG"):
+        return "image/png"
+    elif data.startswith(b"GIF8"):
+        return "image/gif"
+    elif data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    elif data.startswith(b"BM"):
+        return "image/bmp"
+    else:
+        return "application/octet-stream"
+
+
+def get_album_art(audio) -> bytes:
+    #returns the first embedded cover of a mutagen file or b""
+    tags = audio.tags
+    
+    #ID3 (mp3, wav): frames are keyed "APIC:<description>"
+    if hasattr(tags, "getall"):
+        frames = tags.getall("APIC")
+        if len(frames) > 0:
+            return bytes(frames[0].data)
+    
+    #FLAC
+    if len(getattr(audio, "pictures", [])) > 0:
+        return bytes(audio.pictures[0].data)
+    
+    if tags is None:
+        return b""
+    
+    #m4a
+    if "covr" in tags:
+        return bytes(tags["covr"][0])
+    
+    #ogg vorbis
+    if "metadata_block_picture" in tags:
+        picture = Picture(base64.b64decode(tags["metadata_block_picture"][0]))
+        return bytes(picture.data)
+    
+    return b""
+
+
+def get_search_path(abs_path: str) -> str:
+    #abs_path relative to MUSIC_DIR without the extension, only the file name for files outside of it
+    #e.g. "D:/Music/Artist/Album/01 Song.mp3" -> "Artist/Album/01 Song"
+    music_dir = os.path.abspath(MUSIC_DIR)
+    path = os.path.abspath(abs_path)
+    try:
+        inside = os.path.commonpath([music_dir, path]) == music_dir
+    except ValueError:
+        #different drives on windows
+        inside = False
+    
+    relative = os.path.relpath(path, music_dir) if inside else os.path.basename(path)
+    return os.path.splitext(relative)[0]
+
+def get_fingerprint(abs_path: str, with_hash: bool = False) -> tuple:
+    #(mtime, size, inode, hash) of a file
+    #mtime and size detect edits, inode and the partial hash detect renames
+    #the hash covers the size and the first and last 64 KiB, so it is cheap even for large files
+    stat = os.stat(abs_path)
+    
+    file_hash = None
+    if with_hash:
+        block_size = 64 * 1024
+        hasher = hashlib.sha1(str(stat.st_size).encode())
+        with open(abs_path, "rb") as f:
+            hasher.update(f.read(block_size))
+            if stat.st_size > block_size:
+                f.seek(max(block_size, stat.st_size - block_size))
+                hasher.update(f.read(block_size))
+        file_hash = hasher.hexdigest()
+    
+    return (stat.st_mtime, stat.st_size, stat.st_ino, file_hash)
+
+
+def get_spectrogram_path(song_id: int) -> str:
+    return f"./temp/{song_id}.png"
+
+def get_waveform_path(song_id: int) -> str:
+    return f"./temp/{song_id}.waveform.dat"
+
+
 def get_metadata(abs_path) -> dict:
     #use mutagen to get metadata
     
@@ -523,8 +1608,7 @@ def get_metadata(abs_path) -> dict:
 
         
     try:
-        album_art = info_dict["APIC"].data
-        album_art = bytes(album_art)
+        album_art = get_album_art(audio)
     except:
         album_art = b""
     
@@ -558,45 +1642,19 @@ def get_metadata(abs_path) -> dict:
     }
 
 def calculate_spectrogram(song:SongEntry) -> os.PathLike:
-    img_path = f"./temp/{song.id}.png"
+    img_path = get_spectrogram_path(song.id)
     
     if os.path.exists(img_path):
         return img_path
     
-    audio, sr = librosa.load(song.abs_path)
-    
-    #calculate spectrogram
-    S = librosa.feature.melspectrogram(y=audio, sr=sr)
-    S_dB = librosa.power_to_db(S, ref=np.max)
-    
-    #plot spectrogram
-    fig = plt.figure(figsize=(8,1))
-    ax = fig.add_subplot(111)
-    ax.axis("off")
-    ax.imshow(S_dB, origin="lower", aspect="auto", cmap="magma")
-    
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png", bbox_inches="tight", pad_inches=0)
-    buf.seek(0)
-    
-    #close fig
-    plt.close(fig)
-    
-    
-    #convert to numpy array
-    img = Image.open(buf)
-    img = np.array(img)
-    
-    r1, g1, b1 = 255, 255, 255 # Original value
-    r2, g2, b2 = 0, 0, 0 # Value that we want to replace it with
-    red, green, blue = img[:,:,0], img[:,:,1], img[:,:,2]
-    mask = (red == r1) & (green == g1) & (blue == b1)
-    img[:,:,:3][mask] = [r2, g2, b2]
-    
-    img = Image.fromarray(img)
-    
-    #save spectrogram
-    img_path = f"./temp/{song.id}.png"
-    img.save(img_path)
-    
-    return img_path
\ No newline at end of file
+    #streaming mel spectrogram, see fmusic_spectrogram
+    return fspectrogram.render_spectrogram(song.abs_path, img_path)
+
+def calculate_waveform(song:SongEntry) -> os.PathLike:
+    waveform_path = get_waveform_path(song.id)
+
+    if os.path.exists(waveform_path):
+        return waveform_path
+
+    #min/max peaks at several zoom levels, see fmusic_waveform
+    return fwaveform.render_waveform(song.abs_path, waveform_path)
@@ -0,0 +1,165 @@
+#fmusic HTTP
+#file responses with conditional requests (ETag / Last-Modified -> 304) and byte ranges (Range / If-Range -> 206)
+#
+#the body is handed to the server with the ASGI zero copy extension if the server offers it
+#(http.response.zerocopysend, the server calls os.sendfile), otherwise it is read in chunks on a worker thread
+
+from fastapi.requests import Request
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+import mimetypes
+import os
+import re
+
+
+CHUNK_SIZE = 256 * 1024
+
+
+def content_disposition(filename: str, default: str = "download") -> str:
+    #attachment header for a file name from a client: filename= only keeps [\w.-] (other characters
+    #would end the quoted string or the header), the full name is sent as RFC 5987 filename*
+    #control characters and path separators are replaced in both, a name of only dots becomes default
+    name = re.sub(r"[\x00-\x1f\x7f/\\]", "_", filename).strip(". ") or default
+    ascii_name = re.sub(r"[^\w.\-]", "_", name, flags=re.ASCII)
+    return F"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(name, safe='')}"
+
+def file_etag(stat: os.stat_result) -> str:
+    #changes whenever the file is replaced or modified
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+def etag_matches(etag: str, header: str) -> bool:
+    #If-None-Match uses weak comparison
+    if header.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+def not_modified_since(stat: os.stat_result, header: str) -> bool:
+    try:
+        return int(stat.st_mtime) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+def parse_range(header: str, file_size: int):
+    #returns (start, end) with end exclusive, None if the header should be ignored,
+    #or raises ValueError if the range can not be satisfied
+    #only single ranges are served, a server may ignore a multi range request and send the whole file
+    unit, _, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+
+    first, _, last = ranges.strip().partition("-")
+    if first == "":
+        #suffix range: the last n bytes
+        if not last.strip().isdigit():
+            #malformed, ignore it
+            return None
+        length = int(last)
+        #"bytes=-0" and any suffix of an empty file select no bytes
+        if length == 0 or file_size == 0:
+            raise ValueError()
+        return max(file_size - length, 0), file_size
+
+    if not first.isdigit() or not (last.isdigit() or last == ""):
+        #malformed, ignore it
+        return None
+    start = int(first)
+    end = int(last) + 1 if last != "" else file_size
+    if last != "" and end <= start:
+        #last-byte-pos before first-byte-pos is invalid syntax (RFC 9110 14.1.1), ignored like any other
+        return None
+
+    if start >= file_size:
+        raise ValueError()
+    return start, min(end, file_size)
+
+def if_range_matches(header: str, etag: str, stat: os.stat_result) -> bool:
+    #If-Range uses strong comparison, a date only matches the exact Last-Modified
+    header = header.strip()
+    if header.startswith('"') or header.startswith("W/"):
+        return header == etag
+    try:
+        return int(stat.st_mtime) == parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+class FileRangeResponse(Response):
+    #sends bytes start..end of a file, the status and headers are decided by file_response
+
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict, media_type: str) -> None:
+        self.path = path
+        self.start = start
+        self.end = end
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        #Response sets content-length 0 for the empty body
+        self.headers["content-length"] = str(end - start)
+
+    async def __call__(self, scope, receive, send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+
+        count = self.end - self.start
+        if scope["method"] == "HEAD" or count == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        with open(self.path, "rb") as f:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": f, "offset": self.start, "count": count, "more_body": False})
+                return
+
+            await run_in_threadpool(f.seek, self.start)
+            remaining = count
+            while remaining > 0:
+                chunk = await run_in_threadpool(f.read, min(CHUNK_SIZE, remaining))
+                if len(chunk) == 0:
+                    #the file was truncated while it was sent
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def file_response(request: Request, path: str, media_type: str = None, cache_control: str = "no-cache") -> Response:
+    #200 / 206 / 304 / 416 for a file on disk
+    #no-cache: the client keeps its copy but revalidates it, which costs a 304 instead of the file
+    stat = os.stat(path)
+    file_size = stat.st_size
+    etag = file_etag(stat)
+    media_type = media_type or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": cache_control
+    }
+
+    #If-None-Match takes precedence over If-Modified-Since
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        if etag_matches(etag, if_none_match):
+            return Response(status_code=304, headers=headers)
+    elif if_modified_since is not None and not_modified_since(stat, if_modified_since):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header is not None and (if_range is None or if_range_matches(if_range, etag, stat)):
+        try:
+            byte_range = parse_range(range_header, file_size)
+        except ValueError:
+            headers["Content-Range"] = f"bytes */{file_size}"
+            return Response(status_code=416, headers=headers)
+
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{file_size}"
+            return FileRangeResponse(path, start, end, 206, headers, media_type)
+
+    return FileRangeResponse(path, 0, file_size, 200, headers, media_type)
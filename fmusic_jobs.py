@@ -0,0 +1,66 @@
+#fmusic Jobs
+#background work for the server, run in a process pool so requests never wait for it
+#jobs are single-flight: while a job for a key is queued or running, submitting the same key returns that job
+
+from concurrent.futures import ProcessPoolExecutor, Future
+import multiprocessing
+import threading
+import time
+import os
+
+
+class JobQueue:
+    #usage:
+    #   jobs = JobQueue()
+    #   future = jobs.submit(("spectrogram", song_id), fcore.calculate_spectrogram, song)
+    #   future.done(), future.result()
+    #
+    #a failed job is remembered for retry_failed_after seconds, so clients that poll
+    #for a broken file get the error instead of starting the job again and again
+
+    def __init__(self, workers: int = None, retry_failed_after: float = 300) -> None:
+        self.workers = workers or os.cpu_count()
+        self.retry_failed_after = retry_failed_after
+
+        self.lock = threading.Lock()
+        self.pool = None #created on first use, so importing the server does not start processes
+        self.running = {} #key -> Future
+        self.failed = {} #key -> (time, Future)
+
+    def submit(self, key, func, *args) -> Future:
+        with self.lock:
+            future = self.running.get(key)
+            if future is not None:
+                return future
+
+            failed_at, future = self.failed.get(key, (0, None))
+            if time.monotonic() - failed_at < self.retry_failed_after:
+                return future
+            self.failed.pop(key, None)
+
+            if self.pool is None:
+                #by now the server has threads and open sqlite connections, a forked child could inherit a held lock
+                #forkserver starts the workers from a clean process (spawn on windows, which has no forkserver)
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(method))
+
+            future = self.pool.submit(func, *args)
+            self.running[key] = future
+
+        #outside the lock, the callback runs immediately if the job is already done
+        future.add_done_callback(lambda future: self.finish(key, future))
+        return future
+
+    def finish(self, key, future: Future) -> None:
+        with self.lock:
+            if self.running.get(key) is future:
+                del self.running[key]
+            if not future.cancelled() and future.exception() is not None:
+                self.failed[key] = (time.monotonic(), future)
+
+    def shutdown(self) -> None:
+        with self.lock:
+            pool = self.pool
+            self.pool = None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
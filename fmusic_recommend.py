@@ -0,0 +1,142 @@
+#fmusic Recommend
+#similar songs by cosine similarity of their audio embeddings, without a vector database
+#
+#the frame embeddings of a song (YAMNet, one vector per 0.48 s) are mean pooled into one L2 normalized vector,
+#all vectors are rows of one float32 file, row i is song id i (rows of songs without an embedding are zero).
+#the server memory maps the file and scores every song with one matrix vector product,
+#brute force is a few milliseconds per 10k songs and exact, so there is no approximate index to keep in sync
+
+import numpy as np
+
+import threading
+import os
+
+
+EMBEDDING_SIZE = 1024
+
+#YAMNet takes 16 kHz mono and returns one frame embedding per 0.96 s patch, the patches start every 0.48 s
+SAMPLE_RATE = 16000
+PATCH_HOP = 7680
+#0.96 s of 10 ms stft frames plus the rest of the last 25 ms stft window
+PATCH_LENGTH = 15600
+
+
+def pool_embeddings(frames: np.ndarray) -> np.ndarray:
+    #(n, EMBEDDING_SIZE) frame embeddings -> one unit vector, None if there are no frames
+    frames = np.asarray(frames, dtype=np.float32).reshape(-1, EMBEDDING_SIZE)
+    if len(frames) == 0:
+        return None
+    vector = frames.mean(axis=0)
+    norm = np.linalg.norm(vector)
+    if norm == 0 or not np.isfinite(norm):
+        return None
+    return (vector / norm).astype(np.float32)
+
+
+def pack_waveforms(waveforms: list[np.ndarray]) -> tuple[np.ndarray, list[tuple[int, int]]]:
+    #concatenates the waveforms of several songs into one model input, returns (waveform, [(first patch, patches)] per song)
+    #a song gets as many patches as YAMNet makes of it on its own (it pads the end to a whole patch)
+    #and the next song starts on the first hop after its last patch, so no patch reaches into another song
+    patches = [1 + -(-max(len(waveform) - PATCH_LENGTH, 0) // PATCH_HOP) for waveform in waveforms]
+    strides = [-(-((count - 1) * PATCH_HOP + PATCH_LENGTH) // PATCH_HOP) for count in patches]
+    packed = np.zeros(sum(strides) * PATCH_HOP, dtype=np.float32)
+
+    spans = []
+    start = 0
+    for waveform, count, stride in zip(waveforms, patches, strides):
+        packed[start * PATCH_HOP:start * PATCH_HOP + len(waveform)] = waveform
+        spans.append((start, count))
+        start += stride
+    return packed, spans
+
+
+class EmbeddingIndex:
+    #update_index.py writes rows with set / remove while the server reads them with similar,
+    #the server picks up new rows on its next query
+
+    def __init__(self, path: str = "./temp/embeddings.f32") -> None:
+        self.path = path
+        self.row_size = EMBEDDING_SIZE * 4
+        self.lock = threading.Lock()
+
+        #memory map and mask of the rows that have a vector, for the file as it was at (size, mtime)
+        self.state = None
+        self.state_key = None
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if not os.path.exists(self.path):
+            open(self.path, "wb").close()
+
+    def set(self, song_id: int, frames: np.ndarray) -> bool:
+        #pools frames into the row of song_id, returns False if there was nothing to pool
+        return self.set_many({song_id: frames}) == 1
+
+    def set_many(self, frames: dict[int, np.ndarray]) -> int:
+        #{song_id: frames} in one go, returns the number of songs that got a vector
+        rows = []
+        for song_id, song_frames in frames.items():
+            vector = pool_embeddings(song_frames)
+            rows.append((song_id, vector.tobytes() if vector is not None else bytes(self.row_size)))
+        self.write_rows(rows)
+        return sum([any(data) for _, data in rows])
+
+    def remove(self, song_id: int) -> None:
+        if song_id * self.row_size < os.path.getsize(self.path):
+            self.write_rows([(song_id, bytes(self.row_size))])
+
+    def write_rows(self, rows: list[tuple[int, bytes]]) -> None:
+        #pwrite past the end grows the file, the rows in between are zero
+        fd = os.open(self.path, os.O_WRONLY)
+        try:
+            for song_id, data in rows:
+                os.pwrite(fd, data, song_id * self.row_size)
+        finally:
+            os.close(fd)
+
+    def missing(self, song_ids: list[int]) -> list[int]:
+        #the ids without a vector, from one read of the whole file
+        with self.lock:
+            #not the cached mask, a row written in the same mtime tick would be missed
+            self.state_key = None
+        _, valid = self.load()
+        return [song_id for song_id in song_ids if song_id >= len(valid) or not valid[song_id]]
+
+    def load(self) -> tuple[np.ndarray, np.ndarray]:
+        #(matrix, valid), mapped again when the file was written since the last call
+        stat = os.stat(self.path)
+        key = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if self.state_key == key:
+                return self.state
+
+        rows = stat.st_size // self.row_size
+        if rows == 0:
+            matrix = np.zeros((0, EMBEDDING_SIZE), dtype=np.float32)
+        else:
+            matrix = np.memmap(self.path, dtype=np.float32, mode="r", shape=(rows, EMBEDDING_SIZE))
+        #squared norms without an (n, EMBEDDING_SIZE) temporary, 1 for every stored vector and 0 for empty rows
+        valid = np.einsum("ij,ij->i", matrix, matrix) > 0.5
+
+        with self.lock:
+            self.state = (matrix, valid)
+            self.state_key = key
+        return self.state
+
+    def similar(self, song_id: int, k: int = 10) -> list[tuple[int, float]]:
+        #the k songs closest to song_id as (song_id, cosine similarity), best first
+        #None if song_id has no embedding
+        matrix, valid = self.load()
+        if song_id >= len(matrix) or not valid[song_id]:
+            return None
+
+        scores = matrix @ np.array(matrix[song_id])
+        scores[~valid] = -np.inf
+        scores[song_id] = -np.inf
+
+        k = min(k, int(valid.sum()) - 1)
+        if k <= 0:
+            return []
+
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top]
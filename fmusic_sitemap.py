@@ -0,0 +1,111 @@
+#fmusic Sitemap
+#sitemap.xml is a sitemap index of fixed size shards, sitemap_{n}.xml has the songs with ids
+#n * SHARD_SIZE + 1 to (n + 1) * SHARD_SIZE, sitemap_pages.xml the pages that are not songs
+#
+#every shard starts with a digest of its content, generate() only rewrites the shards whose digest changed,
+#so adding a few songs touches the last shard (and the index). the files are written line by line,
+#lastmod is the mtime of the song file (songs.file_mtime)
+
+from xml.sax.saxutils import escape
+import hashlib
+import time
+import os
+
+
+BASE_URL = "https://fmusic.linushorn.dev"
+
+#ids per shard, a sitemap may have at most 50000 urls
+SHARD_SIZE = 10000
+
+#url -> file its lastmod is taken from
+PAGES = {
+    "/": "./static/index.html",
+    "/manifest.json": "./static/manifest.json",
+    "/robots.txt": "./static/robots.txt",
+    "/license.txt": "./static/license.txt",
+}
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+DIGEST_PREFIX = "<!-- fmusic "
+DIGEST_SUFFIX = " -->\n"
+
+
+def shard_name(shard) -> str:
+    return F"sitemap_{shard}.xml"
+
+def w3c_datetime(mtime: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(mtime))
+
+def get_digest(lines: list[str]) -> str:
+    return hashlib.sha1("\n".join(lines).encode()).hexdigest()
+
+def read_digest(path: str) -> str:
+    #the digest a file was written with, None if there is no such file
+    try:
+        with open(path, "r") as f:
+            f.readline()
+            line = f.readline()
+    except FileNotFoundError:
+        return None
+    if not line.startswith(DIGEST_PREFIX):
+        return None
+    return line[len(DIGEST_PREFIX):-len(DIGEST_SUFFIX)]
+
+def write_sitemap(path: str, tag: str, item_tag: str, entries, digest: str) -> None:
+    #entries are (url, mtime or None), written as they come to a temporary file that replaces path
+    tmp_path = F"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(XML_HEADER)
+        f.write(DIGEST_PREFIX + digest + DIGEST_SUFFIX)
+        f.write(F'<{tag} xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for url, mtime in entries:
+            f.write(F"  <{item_tag}><loc>{escape(url)}</loc>")
+            if mtime is not None:
+                f.write(F"<lastmod>{w3c_datetime(mtime)}</lastmod>")
+            f.write(F"</{item_tag}>\n")
+        f.write(F"</{tag}>\n")
+    os.replace(tmp_path, path)
+
+
+def update(path: str, tag: str, item_tag: str, entries: list) -> bool:
+    #writes the sitemap if its content changed, returns True if it did
+    digest = get_digest([F"{url} {mtime}" for url, mtime in entries])
+    if read_digest(path) == digest:
+        return False
+    write_sitemap(path, tag, item_tag, entries, digest)
+    return True
+
+def generate(db, out_dir: str = "./static") -> list[str]:
+    #brings sitemap.xml and its shards up to date, returns the names of the files that were written
+    written = []
+    #(name, lastmod) for the index
+    shards = []
+
+    pages = [(BASE_URL + url, os.path.getmtime(path) if os.path.exists(path) else None) for url, path in PAGES.items()]
+    if update(os.path.join(out_dir, shard_name("pages")), "urlset", "url", pages):
+        written.append(shard_name("pages"))
+    shards.append((shard_name("pages"), max([mtime for _, mtime in pages if mtime is not None], default=None)))
+
+    max_id = db.get_num_entries() or 0
+    shard_count = (max_id + SHARD_SIZE - 1) // SHARD_SIZE
+    for shard in range(shard_count):
+        rows = db.get_song_mtimes(shard * SHARD_SIZE + 1, (shard + 1) * SHARD_SIZE)
+        songs = [(F"{BASE_URL}/song/{song_id}", mtime) for song_id, mtime in rows]
+
+        name = shard_name(shard)
+        if update(os.path.join(out_dir, name), "urlset", "url", songs):
+            written.append(name)
+        shards.append((name, max([mtime for _, mtime in songs if mtime is not None], default=None)))
+
+    #shards past the last id, left over after songs were deleted
+    for entry in os.scandir(out_dir):
+        number = entry.name.removeprefix("sitemap_").removesuffix(".xml")
+        if entry.name.startswith("sitemap_") and entry.name.endswith(".xml") and number.isdigit() and int(number) >= shard_count:
+            os.remove(entry.path)
+            written.append(entry.name)
+
+    index = [(F"{BASE_URL}/{name}", mtime) for name, mtime in shards]
+    if update(os.path.join(out_dir, "sitemap.xml"), "sitemapindex", "sitemap", index):
+        written.append("sitemap.xml")
+
+    return written
@@ -0,0 +1,99 @@
+#fmusic Spectrogram
+#mel spectrogram images computed from a streaming decode
+#memory is bounded by the output image, not by the length of the track
+
+import numpy as np
+import PIL.Image as Image
+import librosa
+
+import fmusic_audio as faudio
+
+import io
+
+
+WIDTH = 800
+N_MELS = 128
+N_FFT = 2048
+HOP_LENGTH = 512
+FMAX = 11025 #the old librosa path analysed at 22.05 kHz, keep the same frequency range
+TOP_DB = 80
+
+#a column never averages more stft frames than this, long tracks use a larger hop instead
+#so an hour-long mix costs about as much fft work as a short song
+FRAMES_PER_COLUMN = 16
+
+#magma colormap sampled at 17 evenly spaced points, interpolated to a 256 entry lookup table
+MAGMA = [
+    (0, 0, 4), (10, 8, 34), (29, 17, 71), (54, 16, 107), (81, 18, 124), (106, 28, 129),
+    (131, 38, 129), (156, 46, 127), (183, 55, 121), (208, 65, 111), (231, 82, 99),
+    (245, 107, 92), (252, 137, 97), (254, 167, 114), (254, 196, 136), (253, 226, 163),
+    (252, 253, 191)
+]
+
+def build_lut(anchors: list[tuple]) -> np.ndarray:
+    anchors = np.array(anchors, dtype=np.float64)
+    positions = np.linspace(0, 1, len(anchors))
+    x = np.linspace(0, 1, 256)
+    lut = np.stack([np.interp(x, positions, anchors[:, channel]) for channel in range(3)], axis=1)
+    return np.round(lut).astype(np.uint8)
+
+LUT = build_lut(MAGMA)
+
+
+def compute_mel_columns(stream: faudio.AudioStream, width: int = WIDTH, n_mels: int = N_MELS) -> np.ndarray:
+    #mean mel power per image column, shape (n_mels, width)
+    #every stft frame is mapped to its column as soon as it is computed, nothing else is kept
+
+    hop_length = max(HOP_LENGTH, stream.frames // (width * FRAMES_PER_COLUMN))
+    total_frames = max(1 + (stream.frames - N_FFT) // hop_length, 1)
+    width = min(width, total_frames)
+
+    mel_basis = librosa.filters.mel(sr=stream.sr, n_fft=N_FFT, n_mels=n_mels, fmax=min(FMAX, stream.sr / 2)).astype(np.float32)
+    window = np.hanning(N_FFT + 1)[:-1].astype(np.float32)
+
+    columns = np.zeros((width, n_mels), dtype=np.float64)
+    counts = np.zeros(width, dtype=np.int64)
+
+    frame_idx = 0
+    for frames in faudio.iter_frames(stream, N_FFT, hop_length):
+        n = len(frames)
+
+        power = np.abs(np.fft.rfft(frames * window, axis=1)) ** 2
+        mel = power.astype(np.float32) @ mel_basis.T #(n, n_mels)
+
+        #column of every frame, non decreasing, so each column is one contiguous run
+        cols = np.minimum((frame_idx + np.arange(n)) * width // total_frames, width - 1)
+        starts = np.flatnonzero(np.r_[True, cols[1:] != cols[:-1]])
+
+        columns[cols[starts]] += np.add.reduceat(mel, starts, axis=0)
+        counts[cols[starts]] += np.diff(np.r_[starts, n])
+
+        frame_idx += n
+
+    return (columns / np.maximum(counts, 1)[:, None]).T
+
+def power_to_image(mel: np.ndarray) -> Image.Image:
+    #dB relative to the loudest bin, clipped to TOP_DB, low frequencies at the bottom
+    S_dB = 10 * np.log10(np.maximum(mel, 1e-10))
+    S_dB = np.maximum(S_dB - S_dB.max(), -TOP_DB)
+
+    idx = ((S_dB + TOP_DB) * (255 / TOP_DB)).astype(np.uint8)
+    return Image.fromarray(LUT[idx[::-1]])
+
+
+def render_spectrogram(audio_path: str, img_path: str, width: int = WIDTH) -> str:
+    #writes the spectrogram of audio_path as png to img_path
+    stream = faudio.AudioStream(audio_path)
+    img = power_to_image(compute_mel_columns(stream, width))
+
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=True)
+    faudio.write_atomic(img_path, buf.getvalue())
+    return img_path
+
+def render_placeholder(width: int = WIDTH, height: int = N_MELS) -> bytes:
+    #png in the background colour of the colormap, shown while the real image is calculated
+    img = Image.new("RGB", (width, height), tuple(int(c) for c in LUT[0]))
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
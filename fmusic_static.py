@@ -0,0 +1,195 @@
+#fmusic Static
+#the files in ./static with precompressed variants, content hash urls and conditional requests
+#
+#every compressible file is compressed once into {cache_dir}/{name}.{hash}.gz (and .br if brotli is installed),
+#the cached variants survive restarts and the one to send is picked from Accept-Encoding
+#url(name) is /static/{name}?v={hash}: a request with the current hash may be cached for a year (immutable),
+#a changed file gets a new url. anything else is revalidated with ETag / Last-Modified (304)
+
+try:
+    import brotli
+except ImportError:
+    #optional, without it only gzip variants are made
+    brotli = None
+
+from fastapi.requests import Request
+from fastapi.responses import Response, JSONResponse
+
+import fmusic_http as fhttp
+
+from dataclasses import dataclass
+import mimetypes
+import threading
+import hashlib
+import gzip
+import os
+import re
+
+
+COMPRESSIBLE = [
+    "text/html", "text/css", "text/plain", "text/xml", "text/javascript",
+    "application/javascript", "application/json", "application/manifest+json", "application/xml", "image/svg+xml"
+]
+#smaller files are not worth a variant, and a variant has to save at least this fraction
+MIN_SIZE = 1024
+MIN_SAVING = 0.1
+#quality 11 is very slow on large files and not smaller than 9 for the sitemap
+BROTLI_QUALITY = 11
+BROTLI_QUALITY_LARGE = 9
+BROTLI_LARGE_SIZE = 256 * 1024
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+#best first
+ENCODINGS = ["br", "gzip"]
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        quality = BROTLI_QUALITY if len(data) <= BROTLI_LARGE_SIZE else BROTLI_QUALITY_LARGE
+        return brotli.compress(data, quality=quality)
+    #mtime=0 so the same file always gives the same bytes
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+def pick_encoding(accept_encoding: str, available: list[str]) -> str:
+    #the best of available the client accepts, None for the uncompressed file
+    #"br;q=0" and "*;q=0" exclude an encoding, q values are not compared otherwise
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        match = re.search(r"q=([0-9.]+)", params)
+        if match is not None:
+            try:
+                q = float(match.group(1))
+            except ValueError:
+                q = 0.0
+        accepted[name.strip()] = q
+
+    for encoding in ENCODINGS:
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+@dataclass
+class Asset:
+    path:str
+    mtime_ns:int
+    size:int
+    hash:str
+    media_type:str
+    variants:dict #encoding -> path of the compressed file
+
+
+class StaticFiles:
+
+    def __init__(self, static_dir: str = "./static", cache_dir: str = "./temp/static") -> None:
+        self.static_dir = static_dir
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.assets = {}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        for entry in os.scandir(self.static_dir):
+            if entry.is_file():
+                self.get(entry.name)
+
+    def get(self, name: str) -> Asset:
+        #None if there is no such file, a file that changed since it was loaded is loaded again
+        if name != os.path.basename(name) or name.startswith("."):
+            return None
+
+        path = os.path.join(self.static_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        with self.lock:
+            asset = self.assets.get(name)
+        if asset is not None and asset.mtime_ns == stat.st_mtime_ns and asset.size == stat.st_size:
+            return asset
+
+        #outside the lock, compressing a large file does not hold up the other files
+        asset = self.load(name, path, stat)
+        with self.lock:
+            self.assets[name] = asset
+        return asset
+
+    def load(self, name: str, path: str, stat: os.stat_result) -> Asset:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path, "rb") as f:
+            data = f.read()
+
+        content_hash = hashlib.sha1(data).hexdigest()[:12]
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+        variants = {}
+        if media_type in COMPRESSIBLE and len(data) >= MIN_SIZE:
+            for encoding in ENCODINGS:
+                if encoding == "br" and brotli is None:
+                    continue
+                variant_path = os.path.join(self.cache_dir, F"{name}.{content_hash}{SUFFIXES[encoding]}")
+                if not os.path.exists(variant_path):
+                    compressed = compress(data, encoding)
+                    if len(compressed) > len(data) * (1 - MIN_SAVING):
+                        continue
+                    tmp_path = F"{variant_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(compressed)
+                    os.replace(tmp_path, variant_path)
+                variants[encoding] = variant_path
+
+        self.remove_old_variants(name, content_hash)
+        return Asset(path, stat.st_mtime_ns, stat.st_size, content_hash, media_type, variants)
+
+    def remove_old_variants(self, name: str, content_hash: str) -> None:
+        #variants of earlier versions of the file
+        prefix = F"{name}."
+        for entry in os.scandir(self.cache_dir):
+            rest = entry.name[len(prefix):]
+            if entry.name.startswith(prefix) and not rest.startswith(F"{content_hash}.") and re.fullmatch(r"[0-9a-f]{12}\.(gz|br)", rest):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def url(self, name: str) -> str:
+        asset = self.get(name)
+        if asset is None:
+            return F"/static/{name}"
+        return F"/static/{name}?v={asset.hash}"
+
+    def fingerprint(self, source: str) -> str:
+        #replaces every /static/{name} of a known file in source with url(name)
+        return re.sub(r"/static/([\w.\-]+)", lambda match: self.url(match.group(1)), source)
+
+    def response(self, request: Request, name: str) -> Response:
+        asset = self.get(name)
+        if asset is None:
+            return JSONResponse({"error": "File not found"}, status_code=404)
+
+        if request.query_params.get("v") == asset.hash:
+            cache_control = IMMUTABLE
+        else:
+            cache_control = "no-cache"
+
+        encoding = pick_encoding(request.headers.get("accept-encoding", ""), list(asset.variants))
+        path = asset.variants[encoding] if encoding is not None else asset.path
+
+        try:
+            response = fhttp.file_response(request, path, asset.media_type, cache_control)
+        except FileNotFoundError:
+            #the file or its variant was deleted since it was loaded
+            with self.lock:
+                self.assets.pop(name, None)
+            return self.response(request, name)
+
+        if len(asset.variants) > 0:
+            response.headers["Vary"] = "Accept-Encoding"
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+        return response
@@ -0,0 +1,82 @@
+#fmusic Templates
+#pages from ./static with placeholders in them, read once and split around the placeholders,
+#so rendering a page is one join of the pieces and the values instead of a file read and a str.replace per placeholder
+#
+#FMUSIC_DEV=1 checks the file on every render and reloads it when it changed
+
+import orjson
+
+import html
+import os
+import re
+
+
+DEV = os.environ.get("FMUSIC_DEV", "0") == "1"
+
+
+def text(value: any) -> str:
+    #a value that is shown as text in the page
+    return html.escape(str(value))
+
+def script_json(data: any) -> bytes:
+    #data inlined into a <script>, "</" would end the script tag
+    return orjson.dumps(data).replace(b"</", b"<\\/")
+
+
+class Template:
+    #placeholders maps the keyword render() takes to the literal placeholder in the file,
+    #e.g. {"song_id": "song_id_placeholder"}, a placeholder may appear any number of times
+    #transform is applied to the file before it is split (e.g. StaticFiles.fingerprint)
+
+    def __init__(self, path: str, placeholders: dict[str, str] = None, transform = None) -> None:
+        self.path = path
+        self.placeholders = placeholders or {}
+        self.transform = transform
+        #placeholder -> keyword
+        self.names = {placeholder: name for name, placeholder in self.placeholders.items()}
+        self.load()
+
+    def load(self) -> None:
+        self.mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path, "r") as f:
+            source = f.read()
+        if self.transform is not None:
+            source = self.transform(source)
+
+        #pieces[0] value[0] pieces[1] value[1] ... pieces[n]
+        if len(self.placeholders) > 0:
+            pattern = "(" + "|".join([re.escape(placeholder) for placeholder in self.placeholders.values()]) + ")"
+            parts = re.split(pattern, source)
+        else:
+            parts = [source]
+
+        #one attribute, so a render during a reload sees either the old or the new template
+        self.parts = ([part.encode() for part in parts[0::2]], [self.names[placeholder] for placeholder in parts[1::2]])
+
+    def render(self, **values) -> bytes:
+        #values are str (inserted as they are, see text()) or bytes (see script_json())
+        if DEV and os.stat(self.path).st_mtime_ns != self.mtime:
+            self.load()
+
+        pieces, keys = self.parts
+        out = [pieces[0]]
+        for key, piece in zip(keys, pieces[1:]):
+            value = values[key]
+            out.append(value if type(value) == bytes else value.encode())
+            out.append(piece)
+        return b"".join(out)
+
+
+class TemplateCache:
+    #templates by path, for routes that pick the file from the url
+
+    def __init__(self, placeholders: dict[str, str] = None) -> None:
+        self.placeholders = placeholders
+        self.templates = {}
+
+    def get(self, path: str) -> Template:
+        template = self.templates.get(path)
+        if template is None:
+            template = Template(path, self.placeholders)
+            self.templates[path] = template
+        return template
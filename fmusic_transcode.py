@@ -0,0 +1,140 @@
+#fmusic Transcode
+#streams songs as opus or mp3 for clients on slow links, transcoded by a local ffmpeg
+#the output is sent while ffmpeg is still running and the finished file is kept in an LRU disk cache
+
+from fastapi.responses import Response, StreamingResponse
+
+import fmusic_cache as fcache
+
+import asyncio
+import threading
+import hashlib
+import shutil
+import os
+
+
+FFMPEG = os.environ.get("FMUSIC_FFMPEG", "ffmpeg")
+
+CHUNK_SIZE = 64 * 1024
+
+#format -> (mime, ffmpeg output options, default kbps)
+PROFILES = {
+    "opus": ("audio/ogg", ["-c:a", "libopus", "-vbr", "on", "-f", "ogg"], 96),
+    "mp3": ("audio/mpeg", ["-c:a", "libmp3lame", "-f", "mp3"], 192),
+}
+
+MIN_BITRATE = 32
+MAX_BITRATE = 320
+
+
+def has_ffmpeg() -> bool:
+    return shutil.which(FFMPEG) is not None
+
+def pick_bitrate(fmt: str, bitrate: int = None) -> int:
+    if bitrate is None:
+        return PROFILES[fmt][2]
+    return min(max(bitrate, MIN_BITRATE), MAX_BITRATE)
+
+def ffmpeg_command(abs_path: str, fmt: str, bitrate: int) -> list[str]:
+    #first audio stream only (no cover art video stream), tags are kept
+    return [
+        FFMPEG, "-nostdin", "-v", "error",
+        "-i", abs_path,
+        "-map", "0:a:0", "-map_metadata", "0",
+        "-b:a", f"{bitrate}k",
+        *PROFILES[fmt][1],
+        "pipe:1"
+    ]
+
+
+class TranscodeCache:
+    #transcodes are stored as {cache_dir}/{song_id}_{source}_{bitrate}.{fmt}
+    #source is a hash of the mtime and size of the original file, an edited file gets new transcodes
+    #the cache is capped at max_bytes, the least recently used files are deleted first (see fmusic_cache)
+
+    def __init__(self, cache_dir: str = "./temp/transcodes", max_bytes: int = 2 * 1024 * 1024 * 1024) -> None:
+        self.files = fcache.DiskLRU(cache_dir, max_bytes)
+        self.lock = threading.Lock()
+        #names that are being transcoded into the cache right now
+        self.running = set()
+
+    def file_name(self, song_id: int, abs_path: str, fmt: str, bitrate: int) -> str:
+        stat = os.stat(abs_path)
+        source = hashlib.sha1(f"{stat.st_mtime_ns}-{stat.st_size}".encode()).hexdigest()[:12]
+        return f"{song_id}_{source}_{bitrate}.{fmt}"
+
+    def lookup(self, name: str) -> str:
+        #path of a finished transcode, None on a miss
+        return self.files.lookup(name)
+
+    def stream(self, abs_path: str, name: str, fmt: str, bitrate: int) -> StreamingResponse:
+        #starts ffmpeg and sends its output as it is produced
+        #the first request for a name also writes the output to the cache,
+        #concurrent requests for the same name get their own ffmpeg but do not write
+        tmp_path = self.files.tmp_path(name)
+
+        async def body():
+            with self.lock:
+                write_cache = name not in self.running
+                if write_cache:
+                    self.running.add(name)
+
+            f = None
+            process = None
+            finished = False
+            try:
+                if write_cache:
+                    f = open(tmp_path, "wb")
+                process = await asyncio.create_subprocess_exec(
+                    *ffmpeg_command(abs_path, fmt, bitrate),
+                    stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+                )
+                while True:
+                    chunk = await process.stdout.read(CHUNK_SIZE)
+                    if len(chunk) == 0:
+                        break
+                    if f is not None:
+                        f.write(chunk)
+                    yield chunk
+
+                finished = await process.wait() == 0
+            finally:
+                #also runs when the client disconnects, the partial output is thrown away
+                try:
+                    if process is not None and process.returncode is None:
+                        process.kill()
+                        await process.wait()
+
+                    if f is not None:
+                        self.store(name, f, finished)
+                finally:
+                    #whatever failed above, the next request for the name writes the cache again
+                    if write_cache:
+                        with self.lock:
+                            self.running.discard(name)
+
+        #the length is unknown until ffmpeg is done, so no ranges for a running transcode
+        return StreamingResponse(body(), media_type=PROFILES[fmt][0], headers=self.stream_headers())
+
+    def store(self, name: str, f, finished: bool) -> None:
+        #closes the output file, moves a finished transcode into the cache and throws away an unfinished one
+        #a full disk only costs the cache entry, the response has been sent already
+        tmp_path = f.name
+        try:
+            f.close()
+            if finished:
+                self.files.add(name, tmp_path)
+                return
+        except OSError as e:
+            print(f"Could not cache the transcode {name}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    def stream_headers(self) -> dict:
+        return {"Accept-Ranges": "none", "Cache-Control": "no-store"}
+
+    def head(self, fmt: str) -> Response:
+        #the headers stream() would send, without starting ffmpeg
+        return Response(status_code=200, media_type=PROFILES[fmt][0], headers=self.stream_headers())
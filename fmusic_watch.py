@@ -0,0 +1,206 @@
+#fmusic Watch
+#keeps the database in sync with the music directory while running
+#uses inotify on linux and falls back to polling the directory everywhere else
+
+import ctypes
+import ctypes.util
+import threading
+import select
+import struct
+import time
+import os
+
+import fmusic_core as fcore
+
+
+#inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII") #wd, mask, cookie, len
+
+
+class InotifyWatcher:
+    #one inotify watch per directory below root, new directories are watched as they appear
+    #IN_CLOSE_WRITE instead of IN_MODIFY, so a file that is still being copied is only reported once
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self, root: str) -> None:
+        self.root = os.path.abspath(root)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self.watches = {} #wd -> directory
+        self.add_tree(self.root)
+
+    def add_tree(self, directory: str) -> None:
+        for root, dirs, files in os.walk(directory):
+            self.add_watch(root)
+
+    def add_watch(self, directory: str) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.mask)
+        if wd < 0:
+            #ENOSPC: fs.inotify.max_user_watches is too low for this library
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"Could not watch {directory}: {os.strerror(errno)}")
+        self.watches[wd] = directory
+
+    def read(self, timeout: float) -> list[str]:
+        #waits up to timeout seconds and returns the paths that changed
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                #events were dropped, check the whole library
+                paths.append(self.root)
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+
+            if mask & IN_IGNORED:
+                #the directory is gone, the kernel removed the watch
+                del self.watches[wd]
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+
+            paths.append(path)
+
+        return paths
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    #compares (mtime, size) of every music file with the previous walk
+
+    def __init__(self, root: str, interval: float = 30) -> None:
+        self.root = os.path.abspath(root)
+        self.interval = interval
+        self.snapshot = self.scan()
+        self.next_scan = time.monotonic() + self.interval
+
+    def scan(self) -> dict:
+        snapshot = {}
+        for root, dirs, files in os.walk(self.root):
+            for file in files:
+                if not fcore.is_music(file):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                snapshot[path] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def read(self, timeout: float) -> list[str]:
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+
+        time.sleep(max(wait, 0))
+        self.next_scan = time.monotonic() + self.interval
+
+        snapshot = self.scan()
+        changed = [path for path, stat in snapshot.items() if self.snapshot.get(path) != stat]
+        removed = [path for path in self.snapshot if path not in snapshot]
+        self.snapshot = snapshot
+        return changed + removed
+
+    def close(self) -> None:
+        pass
+
+
+def create_watcher(root: str, poll_interval: float = 30):
+    #inotify if the platform has it, polling otherwise
+    try:
+        return InotifyWatcher(root)
+    except (OSError, AttributeError) as e:
+        #AttributeError: libc without inotify_init1 (macOS, windows)
+        print(f"inotify is not available ({e}), polling {root} every {poll_interval}s")
+        return PollingWatcher(root, poll_interval)
+
+
+class LibraryWatcher(threading.Thread):
+    #collects changed paths and hands them to sync(paths) in bursts
+    #a burst is flushed once nothing changed for debounce seconds,
+    #or after max_delay seconds so a long copy still shows up while it is running
+
+    def __init__(self, root: str, sync, debounce: float = 2, max_delay: float = 30, poll_interval: float = 30) -> None:
+        super().__init__(name="fmusic-watcher", daemon=True)
+        self.root = root
+        self.sync = sync
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+
+    def run(self) -> None:
+        watcher = create_watcher(self.root, self.poll_interval)
+
+        pending = set()
+        first_event = 0
+        last_event = 0
+
+        try:
+            while not self.stop_event.is_set():
+                paths = watcher.read(timeout=0.5)
+
+                now = time.monotonic()
+                if len(paths) > 0:
+                    if len(pending) == 0:
+                        first_event = now
+                    last_event = now
+                    pending.update(paths)
+
+                if len(pending) == 0:
+                    continue
+
+                if now - last_event >= self.debounce or now - first_event >= self.max_delay:
+                    burst = sorted(pending)
+                    pending = set()
+                    try:
+                        self.sync(burst)
+                    except Exception as e:
+                        print(f"Could not sync {len(burst)} changed paths: {e}")
+        finally:
+            watcher.close()
+
+    def stop(self) -> None:
+        self.stop_event.set()
@@ -0,0 +1,111 @@
+#fmusic Waveform
+#min/max peaks at several zoom levels, computed in one streaming pass over the audio
+#
+#every level is stored in the audiowaveform binary format (version 2, see
+#https://github.com/bbc/audiowaveform/blob/master/doc/DataFormat.md):
+#   int32 version, uint32 flags (bit 0: 8 bit samples), int32 sample_rate,
+#   int32 samples_per_pixel, uint32 length, int32 channels, then length (min, max) pairs
+#the sidecar file is all levels written one after another (16 bit, finest first),
+#so every level is a valid .dat file on its own and can be sliced out of the memory map
+
+import numpy as np
+
+import fmusic_audio as faudio
+
+import struct
+
+
+#samples per pixel of the stored levels, every level is 4x coarser than the one before
+LEVELS = [256, 1024, 4096, 16384, 65536]
+
+HEADER = struct.Struct("<iIiiIi")
+VERSION = 2
+FLAG_8_BIT = 1
+
+
+def compute_peaks(stream: faudio.AudioStream, samples_per_pixel: int = LEVELS[0]) -> np.ndarray:
+    #(min, max) of every samples_per_pixel samples, shape (n, 2), int16
+    peaks = []
+    carry = np.zeros(0, dtype=np.float32)
+
+    for block in stream:
+        buf = np.concatenate([carry, block])
+        usable = len(buf) - len(buf) % samples_per_pixel
+        carry = buf[usable:]
+
+        pixels = buf[:usable].reshape(-1, samples_per_pixel)
+        peaks.append(np.stack([pixels.min(axis=1), pixels.max(axis=1)], axis=1))
+
+    if len(carry) > 0:
+        peaks.append(np.array([[carry.min(), carry.max()]], dtype=np.float32))
+
+    if len(peaks) == 0:
+        return np.zeros((0, 2), dtype=np.int16)
+
+    peaks = np.concatenate(peaks)
+    return np.round(np.clip(peaks, -1, 1) * 32767).astype(np.int16)
+
+def downsample_peaks(peaks: np.ndarray, factor: int) -> np.ndarray:
+    #merges factor neighbouring pixels, the last pixel may cover fewer
+    starts = np.arange(0, len(peaks), factor)
+    if len(starts) == 0:
+        return peaks
+    return np.stack([np.minimum.reduceat(peaks[:, 0], starts), np.maximum.reduceat(peaks[:, 1], starts)], axis=1)
+
+
+def encode_level(peaks: np.ndarray, sample_rate: int, samples_per_pixel: int, bits: int = 16) -> bytes:
+    if bits == 8:
+        #the high byte of the 16 bit value, same as audiowaveform -b 8
+        data = (peaks >> 8).astype(np.int8)
+        flags = FLAG_8_BIT
+    else:
+        data = peaks.astype("<i2")
+        flags = 0
+    return HEADER.pack(VERSION, flags, sample_rate, samples_per_pixel, len(peaks), 1) + data.tobytes()
+
+def render_waveform(audio_path: str, waveform_path: str) -> str:
+    #writes the peaks of every level of audio_path to waveform_path
+    stream = faudio.AudioStream(audio_path)
+    peaks = compute_peaks(stream, LEVELS[0])
+
+    data = [encode_level(peaks, stream.sr, LEVELS[0])]
+    for finer, coarser in zip(LEVELS, LEVELS[1:]):
+        peaks = downsample_peaks(peaks, coarser // finer)
+        data.append(encode_level(peaks, stream.sr, coarser))
+
+    faudio.write_atomic(waveform_path, b"".join(data))
+    return waveform_path
+
+
+def read_levels(waveform_path: str) -> list[tuple[int, int, np.ndarray]]:
+    #[(sample_rate, samples_per_pixel, peaks)] of a sidecar file, peaks are views into a memory map
+    mm = np.memmap(waveform_path, dtype=np.uint8, mode="r")
+
+    levels = []
+    offset = 0
+    while offset + HEADER.size <= len(mm):
+        version, flags, sample_rate, samples_per_pixel, length, channels = HEADER.unpack_from(mm, offset)
+        offset += HEADER.size
+
+        dtype = np.int8 if flags & FLAG_8_BIT else np.dtype("<i2")
+        size = length * channels * 2 * np.dtype(dtype).itemsize
+        peaks = mm[offset:offset + size].view(dtype).reshape(length, 2 * channels)
+        offset += size
+
+        levels.append((sample_rate, samples_per_pixel, peaks))
+    return levels
+
+def pick_level(levels: list, width: int = None, samples_per_pixel: int = None) -> tuple:
+    #with samples_per_pixel: the coarsest level that is at least that detailed
+    #with width: the coarsest level that still has width pixels, the client only has to shrink it
+    #falls back to the finest level
+    if samples_per_pixel is not None:
+        candidates = [level for level in levels if level[1] <= samples_per_pixel]
+    elif width is not None:
+        candidates = [level for level in levels if len(level[2]) >= width]
+    else:
+        candidates = []
+
+    if len(candidates) == 0:
+        return levels[0]
+    return candidates[-1]
@@ -0,0 +1,239 @@
+#fmusic Zip
+#zip archives of songs that are streamed straight from the audio files, without a copy on disk or in memory
+#
+#every entry is stored (audio is compressed already) and written as ZIP64 with a data descriptor,
+#so the local header does not need the CRC and a file is only read once, while it is sent.
+#the layout (offsets, total length) only depends on the names, sizes and mtimes of the files,
+#which makes the archive byte for byte the same for the same songs: it has a Content-Length,
+#an ETag and can be resumed with Range requests
+#
+#the CRCs are computed while the data is sent and kept per (path, size, mtime) for the last MAX_CRCS files,
+#a range that needs the CRC of a file it does not contain (descriptor, central directory) reads that file
+
+from fastapi.requests import Request
+from fastapi.responses import Response, StreamingResponse
+
+import fmusic_http as fhttp
+
+from collections import OrderedDict
+
+import threading
+import hashlib
+import struct
+import time
+import zlib
+import os
+
+
+CHUNK_SIZE = 256 * 1024
+#files whose CRC is remembered, about 200 bytes each
+MAX_CRCS = 100000
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+DATA_DESCRIPTOR = struct.Struct("<IIQQ")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP64_EXTRA_LOCAL = struct.Struct("<HHQQ")
+ZIP64_EXTRA_CENTRAL = struct.Struct("<HHQQQ")
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+END = struct.Struct("<IHHHHIIH")
+
+VERSION = 45 #zip64
+#data descriptor, utf-8 names
+FLAGS = 0x08 | 0x800
+#made on unix, rw-r--r--
+VERSION_MADE_BY = (3 << 8) | VERSION
+EXTERNAL_ATTR = 0o100644 << 16
+
+
+def dos_time(mtime: float) -> tuple[int, int]:
+    #(time, date), zip can not store dates before 1980
+    t = time.localtime(max(mtime, 315532800))
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ZipEntry:
+
+    def __init__(self, name: str, path: str) -> None:
+        stat = os.stat(path)
+        self.name = name.encode()
+        self.path = path
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.time, self.date = dos_time(stat.st_mtime)
+        self.offset = 0 #of the local header, set by ZipLayout
+
+    def local_header(self) -> bytes:
+        #crc and sizes are in the data descriptor, the zip64 extra field only says that they are 8 bytes there
+        extra = ZIP64_EXTRA_LOCAL.pack(1, 16, 0, 0)
+        header = LOCAL_HEADER.pack(
+            0x04034b50, VERSION, FLAGS, 0, self.time, self.date,
+            0, 0xFFFFFFFF, 0xFFFFFFFF, len(self.name), len(extra)
+        )
+        return header + self.name + extra
+
+    def data_descriptor(self, crc: int) -> bytes:
+        return DATA_DESCRIPTOR.pack(0x08074b50, crc, self.size, self.size)
+
+    def central_header(self, crc: int) -> bytes:
+        extra = ZIP64_EXTRA_CENTRAL.pack(1, 24, self.size, self.size, self.offset)
+        header = CENTRAL_HEADER.pack(
+            0x02014b50, VERSION_MADE_BY, VERSION, FLAGS, 0, self.time, self.date,
+            crc, 0xFFFFFFFF, 0xFFFFFFFF, len(self.name), len(extra), 0, 0, 0, EXTERNAL_ATTR, 0xFFFFFFFF
+        )
+        return header + self.name + extra
+
+
+class ZipLayout:
+    #the archive as a list of segments (start, end, kind, entry) that cover it without gaps
+    #kind is "header", "data", "descriptor", "central" or "end"
+
+    def __init__(self, files: list[tuple[str, str]]) -> None:
+        #files are (name in the archive, path on disk), names have to be unique
+        self.entries = [ZipEntry(name, path) for name, path in files]
+        self.segments = []
+
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            offset = self.add(offset, len(entry.local_header()), "header", entry)
+            offset = self.add(offset, entry.size, "data", entry)
+            offset = self.add(offset, DATA_DESCRIPTOR.size, "descriptor", entry)
+
+        self.central_offset = offset
+        self.central_size = sum([CENTRAL_HEADER.size + len(entry.name) + ZIP64_EXTRA_CENTRAL.size for entry in self.entries])
+        offset = self.add(offset, self.central_size, "central", None)
+        offset = self.add(offset, ZIP64_END.size + ZIP64_LOCATOR.size + END.size, "end", None)
+        self.size = offset
+
+        key = "\n".join([F"{entry.name.hex()} {entry.size} {entry.mtime_ns}" for entry in self.entries])
+        self.etag = '"zip-' + hashlib.sha1(key.encode()).hexdigest()[:20] + '"'
+
+    def add(self, offset: int, length: int, kind: str, entry: ZipEntry) -> int:
+        if length > 0:
+            self.segments.append((offset, offset + length, kind, entry))
+        return offset + length
+
+    def end_records(self) -> bytes:
+        count = len(self.entries)
+        zip64_end_offset = self.central_offset + self.central_size
+        return (
+            ZIP64_END.pack(0x06064b50, ZIP64_END.size - 12, VERSION_MADE_BY, VERSION, 0, 0, count, count, self.central_size, self.central_offset)
+            + ZIP64_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1)
+            + END.pack(0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF), 0xFFFFFFFF, 0xFFFFFFFF, 0)
+        )
+
+
+class ZipExporter:
+    #streams ZipLayouts and remembers the CRCs of the files it has read
+
+    def __init__(self, max_crcs: int = MAX_CRCS) -> None:
+        self.lock = threading.Lock()
+        #path -> (size, mtime_ns, crc32), least recently used first
+        #one entry per path, a changed file replaces the CRC of its old version
+        self.crcs = OrderedDict()
+        self.max_crcs = max_crcs
+
+    def crc(self, entry: ZipEntry) -> int:
+        with self.lock:
+            size, mtime_ns, crc = self.crcs.get(entry.path, (None, None, None))
+            if (size, mtime_ns) == (entry.size, entry.mtime_ns):
+                self.crcs.move_to_end(entry.path)
+                return crc
+
+        crc = 0
+        with open(entry.path, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if len(chunk) == 0:
+                    break
+                crc = zlib.crc32(chunk, crc)
+        self.store_crc(entry, crc)
+        return crc
+
+    def store_crc(self, entry: ZipEntry, crc: int) -> None:
+        with self.lock:
+            self.crcs[entry.path] = (entry.size, entry.mtime_ns, crc)
+            self.crcs.move_to_end(entry.path)
+            while len(self.crcs) > self.max_crcs:
+                self.crcs.popitem(last=False)
+
+    def read_data(self, entry: ZipEntry, start: int, end: int):
+        #bytes start..end of the file, the CRC is kept if the whole file is read
+        crc = 0 if start == 0 else None
+        remaining = end - start
+        with open(entry.path, "rb") as f:
+            f.seek(start)
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if len(chunk) == 0:
+                    #the layout promised more bytes than the file has now
+                    raise IOError(F"{entry.path} changed while it was exported")
+                remaining -= len(chunk)
+                if crc is not None:
+                    crc = zlib.crc32(chunk, crc)
+                yield chunk
+
+        if crc is not None and end == entry.size:
+            self.store_crc(entry, crc)
+
+    def central_directory(self, layout: ZipLayout):
+        for entry in layout.entries:
+            yield entry.central_header(self.crc(entry))
+
+    def iter_range(self, layout: ZipLayout, start: int, end: int):
+        #bytes start..end of the archive, end exclusive
+        for seg_start, seg_end, kind, entry in layout.segments:
+            if seg_end <= start or seg_start >= end:
+                continue
+            lo = max(start, seg_start) - seg_start
+            hi = min(end, seg_end) - seg_start
+
+            if kind == "data":
+                yield from self.read_data(entry, lo, hi)
+                continue
+
+            if kind == "header":
+                data = entry.local_header()
+            elif kind == "descriptor":
+                data = entry.data_descriptor(self.crc(entry))
+            elif kind == "central":
+                data = b"".join(self.central_directory(layout))
+            else:
+                data = layout.end_records()
+            yield data[lo:hi]
+
+    def response(self, request: Request, layout: ZipLayout, filename: str) -> Response:
+        #200 / 206 / 304 / 416 like fmusic_http.file_response, If-Range only with the ETag
+        headers = {
+            "ETag": layout.etag,
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "no-cache",
+            "Content-Disposition": fhttp.content_disposition(filename, "export.zip")
+        }
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None and fhttp.etag_matches(layout.etag, if_none_match):
+            return Response(status_code=304, headers=headers)
+
+        start, end, status_code = 0, layout.size, 200
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header is not None and (if_range is None or if_range.strip() == layout.etag):
+            try:
+                byte_range = fhttp.parse_range(range_header, layout.size)
+            except ValueError:
+                headers["Content-Range"] = F"bytes */{layout.size}"
+                return Response(status_code=416, headers=headers)
+
+            if byte_range is not None:
+                start, end = byte_range
+                status_code = 206
+                headers["Content-Range"] = F"bytes {start}-{end - 1}/{layout.size}"
+
+        headers["Content-Length"] = str(end - start)
+        if request.method == "HEAD":
+            return Response(status_code=status_code, headers=headers, media_type="application/zip")
+
+        #a sync generator, starlette runs it on a worker thread
+        return StreamingResponse(self.iter_range(layout, start, end), status_code=status_code, headers=headers, media_type="application/zip")
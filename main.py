@@ -1,89 +1,162 @@
 from fastapi import FastAPI
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse, Response
 from fastapi.requests import Request
 import uvicorn
 
 import fmusic_core as fcore
+import fmusic_art as fart
+import fmusic_watch as fwatch
+import fmusic_jobs as fjobs
+import fmusic_spectrogram as fspectrogram
+import fmusic_waveform as fwaveform
+import fmusic_http as fhttp
+import fmusic_transcode as ftranscode
+import fmusic_templates as ftemplates
+import fmusic_static as fstatic
+import fmusic_zip as fzip
+import fmusic_sitemap as fsitemap
+import fmusic_recommend as frecommend
+import update_index as uindex
 
 import os
-import random
 import datetime
-from tqdm import tqdm
-import zipfile
-import time
+import urllib.parse
+import hashlib
 
-db = fcore.DataBase()
 app = FastAPI()
+jobs = fjobs.JobQueue()
+exporter = fzip.ZipExporter()
 
 MUSIC_DIR = fcore.MUSIC_DIR
 
+#/dynamic/{file_path}/song/{song_id}
+DYNAMIC_SONG_FILES = ftemplates.TemplateCache({"song_data": '"song_data_placeholder"'})
+
+#songs the playlist player gets with the page, it fetches the rest in windows of this size while it is used
+PLAYER_WINDOW = 200
+
+#set by setup() when the server starts, not on import:
+#the job workers (forkserver / spawn) run this file again as __mp_main__, and must not open the database,
+#scan the disk caches (deleting the .tmp files the server is writing) or precompress ./static
+db: fcore.DataBase = None
+adb: fcore.AsyncDataBase = None #for async routes, see AsyncDataBase
+thumbnails: fart.ThumbnailCache = None
+transcodes: ftranscode.TranscodeCache = None
+embeddings: frecommend.EmbeddingIndex = None #written by update_index.py
+static_files: fstatic.StaticFiles = None
+SPECTROGRAM_PLACEHOLDER: bytes = None
+INDEX_PAGE: ftemplates.Template = None
+UPLOAD_PAGE: ftemplates.Template = None
+SONG_PLAYER_PAGE: ftemplates.Template = None
+PLAYLIST_PLAYER_PAGE: ftemplates.Template = None
+
+
+@app.on_event("startup")
+def setup():
+    #benchmark.py calls it directly, an in-process client does not send the startup event
+    global db, adb, thumbnails, transcodes, embeddings, static_files, SPECTROGRAM_PLACEHOLDER
+    global INDEX_PAGE, UPLOAD_PAGE, SONG_PLAYER_PAGE, PLAYLIST_PLAYER_PAGE
+    if db is not None:
+        return
+    
+    db = fcore.DataBase()
+    adb = fcore.AsyncDataBase(db)
+    thumbnails = fart.ThumbnailCache()
+    transcodes = ftranscode.TranscodeCache()
+    embeddings = frecommend.EmbeddingIndex()
+    
+    SPECTROGRAM_PLACEHOLDER = fspectrogram.render_placeholder()
+    
+    #./static with compressed variants and content hash urls, precompressed at startup (see fmusic_static)
+    static_files = fstatic.StaticFiles()
+    
+    #pages, read once at startup (see fmusic_templates)
+    #links to /static/ files in them get the content hash url
+    INDEX_PAGE = ftemplates.Template("./static/index.html", transform=static_files.fingerprint)
+    UPLOAD_PAGE = ftemplates.Template("./static/uploadForm.html", transform=static_files.fingerprint)
+    SONG_PLAYER_PAGE = ftemplates.Template("./static/song_player.html", {
+        "song_id": "song_id_placeholder",
+        "song_name": "song_name_placeholder",
+        "song_artist": "song_artist_placeholder",
+        "song_length": "song_length_fancy_placeholder",
+    }, static_files.fingerprint)
+    PLAYLIST_PLAYER_PAGE = ftemplates.Template("./static/playlist_player.html", {"playlist_data": '"playlist_data_placeholder"'}, static_files.fingerprint)
+
+
+#FMUSIC_WATCH=1 keeps the database in sync with MUSIC_DIR while the server runs
+#(same as running "update_index.py --watch" next to it)
+@app.on_event("startup")
+def start_library_watcher():
+    if os.environ.get("FMUSIC_WATCH", "0") == "1":
+        #the watcher writes through the server's DataBase, so the server has a single writer
+        uindex.db = db
+        app.state.watcher = fwatch.LibraryWatcher(MUSIC_DIR, lambda paths: uindex.sync_paths(paths, MUSIC_DIR))
+        app.state.watcher.start()
+
+@app.on_event("shutdown")
+def stop_library_watcher():
+    if hasattr(app.state, "watcher"):
+        app.state.watcher.stop()
+
+@app.on_event("shutdown")
+def stop_jobs():
+    jobs.shutdown()
+    adb.close()
+
 
 #html + frontend
 @app.get("/")
 async def index():
-    with open("./static/index.html", "r") as f:
-        html = f.read()
+    return HTMLResponse(INDEX_PAGE.render())
+
+def song_player_response(song: fcore.SongEntry) -> HTMLResponse:
+    html = SONG_PLAYER_PAGE.render(
+        song_id=str(song.id),
+        song_name=ftemplates.text(song.name),
+        song_artist=ftemplates.text(song.artist),
+        song_length=str(datetime.timedelta(seconds=fcore.cast_to_int(song.length))), #mm:ss
+    )
     return HTMLResponse(html)
 
 @app.get("/song/random")
 async def random_song_player():
-    song_id = random.randint(1, db.get_num_entries())
-    
-    with open("./static/song_player.html", "r") as f:
-        html = f.read()
-    
-    html = html.replace(
-        "song_id_placeholder",
-        str(song_id)
-    )
-    
-    return HTMLResponse(html)
+    return song_player_response(await adb.get_random_song())
 
 @app.get("/song/{song_id}")
 async def song_player(song_id: int):
-    
-    with open("./static/song_player.html", "r") as f:
-        html = f.read()
-        
-    song = db.get_song_by_id(song_id)
-        
-    replacements = {
-        "song_id_placeholder": song_id,
-        "song_name_placeholder": song.name,
-        "song_artist_placeholder": song.artist,
-        "song_length_fancy_placeholder": str(datetime.timedelta(seconds=song.length)), #mm:ss
-    }
-    
-    for key, value in replacements.items():
-        html = html.replace(key, str(value))
-    
-    return HTMLResponse(html)
+    song = await adb.get_song_by_id(song_id)
+    if song is None:
+        return JSONResponse({"error": "Song not found"}, status_code=404)
+    return song_player_response(song)
 
 @app.get("/upload")
 async def upload_page():
-    with open("./static/uploadForm.html", "r") as f:
-        html = f.read()
-    return HTMLResponse(html)
+    return HTMLResponse(UPLOAD_PAGE.render())
+
 
 
+def page_limit(limit: int) -> int:
+    return min(max(limit, 1), fcore.MAX_PAGE_SIZE)
+
+def playlist_player_response(playlist_id: int, name: str, page: fcore.SongPage, source: str = None) -> HTMLResponse:
+    #inlines the first page into playlist_player.html
+    #source is the api url the player fetches the following pages from (with limit and after)
+    data = {"id": playlist_id, "name": name, **page.to_json(), "source": source}
+    return HTMLResponse(PLAYLIST_PLAYER_PAGE.render(playlist_data=ftemplates.script_json(data)))
 
 @app.get("/playlist/{playlist_id}")
 async def playlist_player(playlist_id: int):
     if playlist_id == 0:
         #playlist_id 0 is reserved for favorites
-        playlist = db.get_favorite_playlist()
-    else:
-        playlist = db.get_playlist(playlist_id)
-
-    with open("./static/playlist_player.html", "r") as f:
-        html = f.read()
+        page = await adb.get_favorites_page(PLAYER_WINDOW)
+        return playlist_player_response(0, "Favorites", page, "/api/favorites")
     
-    html = html.replace(
-        '"playlist_data_placeholder"',
-        str(playlist.to_json())
-    )
+    name = await adb.get_playlist_name(playlist_id)
+    if name is None:
+        return JSONResponse({"error": "Playlist not found"}, status_code=404)
     
-    return HTMLResponse(html)
+    page = await adb.get_playlist_page(playlist_id, PLAYER_WINDOW)
+    return playlist_player_response(playlist_id, name, page, F"/api/playlist/{playlist_id}/songs")
 
 
 #dynamically generated playlist
@@ -97,94 +170,76 @@ async def dynamic_playlist(**params):
     
     new_params = fcore.save_eval(params)
     print(new_params, type(new_params))
-
-    #inject songs into playlist_player.html
-    with open("./static/playlist_player.html", "r") as f:
-        html = f.read()
-    
-    playlist = db.dynamic_playlist(new_params)
     
-    html = html.replace(
-        '"playlist_data_placeholder"',
-        str(playlist.to_json())
-    )
+    #the params carry their own limit, so the whole playlist is one page
+    playlist = await adb.dynamic_playlist(new_params)
+    page = fcore.SongPage(playlist.songs, len(playlist.songs), None)
     
-    return HTMLResponse(html)
+    return playlist_player_response(playlist.id, playlist.name, page)
 
 
 @app.get("/dynamic_playlist_full_text_search")
-async def dynamic_playlist_full_text_search(q: str):
+async def dynamic_playlist_full_text_search(q: str, limit: int = PLAYER_WINDOW):
     #url = /dynamic_playlist_full_text_search?q=hello
+    #limit is the size of the first page, the player loads the other matches while it is used
     
-    #inject songs into playlist_player.html
-    with open("./static/playlist_player.html", "r") as f:
-        html = f.read()
-
-    playlist = db.playlist_from_full_text_search(q)
-    
-    html = html.replace(
-        '"playlist_data_placeholder"',
-        str(playlist.to_json())
-    )
-    
-    return HTMLResponse(html)
+    page = await adb.full_text_search_page(q, page_limit(limit))
+    return playlist_player_response(0, "Search Results", page, "/api/full_search?q=" + urllib.parse.quote(q))
 
 
 
 
 #static files
 @app.get("/static/{file_path}")
-def serve_static(file_path: str):
-
-    return FileResponse(F"./static/{file_path}")
+def serve_static(file_path: str, request: Request):
+    return static_files.response(request, file_path)
 
 @app.get("/dynamic/{file_path}/song/{song_id}")
 def serve_dynamic_song(file_path: str, song_id: int):
-    #load js file
-    #inject song data into "song_data_placeholder"
-    
-    js_str = ""
-    with open(F"./static/{file_path}", "r") as f:
-        js_str = f.read()
+    #js file with the song data injected into "song_data_placeholder"
+    path = F"./static/{file_path}"
+    if not os.path.isfile(path):
+        return JSONResponse({"error": "File not found"}, status_code=404)
     
     song = db.get_song_by_id(song_id)
+    if song is None:
+        return JSONResponse({"error": "Song not found"}, status_code=404)
     
-    js_str = js_str.replace(
-        '"song_data_placeholder"',
-        str(song.to_json())
-    )
-    
-    header = {
-        "Content-Type": "application/javascript"
-    }
-    
-    return HTMLResponse(js_str, headers=header)
+    js = DYNAMIC_SONG_FILES.get(path).render(song_data=ftemplates.script_json(song.to_json()))
+    return Response(js, media_type="application/javascript")
 
 
 #favicon and robot stuff
 
 @app.get("/favicon.ico")
-def serve_favicon():
-    return FileResponse("./static/music.png")
+def serve_favicon(request: Request):
+    return static_files.response(request, "music.png")
 
 
 
 @app.get("/robots.txt")
-def serve_robots():
-    return FileResponse("./static/robots.txt")
+def serve_robots(request: Request):
+    return static_files.response(request, "robots.txt")
 
 @app.get("/license.txt")
-def serve_license():
-    return FileResponse("./static/license.txt")
+def serve_license(request: Request):
+    return static_files.response(request, "license.txt")
 
 @app.get("/manifest.json")
-def serve_manifest():
-    return FileResponse("./static/manifest.json")
+def serve_manifest(request: Request):
+    return static_files.response(request, "manifest.json")
 
 
 @app.get("/sitemap.xml")
-def serve_sitemap():
-    return FileResponse("./static/sitemap.xml")
+def serve_sitemap(request: Request):
+    return static_files.response(request, "sitemap.xml")
+
+@app.get("/sitemap_{shard}.xml")
+def serve_sitemap_shard(shard: str, request: Request):
+    #shards of the sitemap index, see fmusic_sitemap
+    if not (shard.isdigit() or shard == "pages"):
+        return JSONResponse({"error": "File not found"}, status_code=404)
+    return static_files.response(request, fsitemap.shard_name(shard))
 
 
 
@@ -203,6 +258,7 @@ async def search(**params):
     #artist: str
     #album: str
     #name: str
+    #tempo, loudness, duration: float or tuple (min, max), musical_key: str (e.g. "A minor"), see update_index.py --analyze
     
 
     params = params["params"] #str
@@ -221,37 +277,124 @@ async def search(**params):
     else:
         mode = "AND"
 
-    songs = db.get_songs(**new_params, limit=limit, mode=mode)
+    songs = await adb.get_songs(**new_params, limit=limit, mode=mode)
     print(len(songs))
     return JSONResponse([song.to_json() for song in songs])
 
 
 @app.get("/api/full_search")
-async def full_text_search(q:str) -> list[fcore.SongEntry]:
-    #url = /api/full_search?q=hello
+async def full_text_search(q:str, limit: int = fcore.PAGE_SIZE, after: str = None):
+    #url = /api/full_search?q=hello&limit=100
     
-    #searches all columns for q
-    #returns a list of SongEntry objects
+    #searches name, artist, album, genre and path for q (prefix match per word)
+    #returns {"songs": [...], "total": int, "next": cursor}, best match first
+    #the next page is /api/full_search?q=hello&limit=100&after={next}, next is null on the last page
     
-    songs = db.full_text_search(q)
-    return JSONResponse([song.to_json() for song in songs])
+    try:
+        page = await adb.full_text_search_page(q, page_limit(limit), after)
+    except ValueError:
+        return JSONResponse({"error": "Invalid cursor"}, status_code=400)
+    return JSONResponse(page.to_json())
 
 ## Songs
 
-@app.get("/api/song/{song_id}")
-async def get_song(song_id: int):
-    song = db.get_song_by_id(song_id)
-    return FileResponse(song.abs_path)
+def art_response(request: Request, art_hash: str, load_art, cache_control: str, size: int = None) -> Response:
+    #serves an image with its content hash as ETag
+    #with size set, a thumbnail in the best format the client accepts is served instead of the original
+    #load_art() -> (mime, data) is only called if neither the client nor the thumbnail cache has the image
+    etag = f'"{art_hash}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": cache_control
+    }
+    
+    if size is not None:
+        fmt = fart.pick_format(request.headers.get("accept"))
+        etag = f'"{art_hash}-{fart.pick_size(size)}-{fmt}"'
+        headers["ETag"] = etag
+        headers["Vary"] = "Accept"
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and fhttp.etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    
+    if size is not None:
+        mime, data = thumbnails.get(art_hash, size, fmt, lambda: load_art()[1])
+    else:
+        mime, data = load_art()
+    
+    return Response(data, media_type=mime, headers=headers)
+
+@app.get("/api/art/{art_hash}")
+def get_art(art_hash: str, request: Request, size: int = None):
+    #content addressed, the image behind a hash never changes
+    art = db.get_art(art_hash)
+    if art is None:
+        return JSONResponse({"error": "No album art"}, status_code=404)
+    
+    return art_response(request, art_hash, lambda: art, "public, max-age=31536000, immutable", size)
+
+@app.api_route("/api/song/{song_id}", methods=["GET", "HEAD"])
+async def get_song(song_id: int, request: Request, format: str = None, bitrate: int = None):
+    #seeking in <audio> sends Range requests, only the requested bytes are sent
+    #revalidation (If-None-Match / If-Modified-Since) is answered with 304
+    #format=opus|mp3 (&bitrate=kbps) transcodes with ffmpeg, finished transcodes are cached and served like the original
+    song = await adb.get_song_by_id(song_id)
+    if song is None or not os.path.isfile(song.abs_path):
+        return JSONResponse({"error": "Song not found"}, status_code=404)
+
+    if format is None:
+        return fhttp.file_response(request, song.abs_path)
+
+    if format not in ftranscode.PROFILES:
+        return JSONResponse({"error": f"Unknown format, use one of {list(ftranscode.PROFILES)}"}, status_code=400)
+    bitrate = ftranscode.pick_bitrate(format, bitrate)
+
+    name = transcodes.file_name(song_id, song.abs_path, format, bitrate)
+    cached_path = transcodes.lookup(name)
+    if cached_path is not None:
+        return fhttp.file_response(request, cached_path, ftranscode.PROFILES[format][0])
+
+    if not ftranscode.has_ffmpeg():
+        return JSONResponse({"error": "Transcoding needs ffmpeg"}, status_code=501)
+    if request.method == "HEAD":
+        #only a cached transcode has a length, a HEAD request does not start ffmpeg
+        return transcodes.head(format)
+    return transcodes.stream(song.abs_path, name, format, bitrate)
 
 @app.get("/api/song/{song_id}/info")
 async def get_song_info(song_id: int):
-    song = db.get_song_by_id(song_id)
+    song = await adb.get_song_by_id(song_id)
     return JSONResponse(song.to_json())
 
+@app.get("/api/song/{song_id}/similar")
+async def get_similar_songs(song_id: int, k: int = 10):
+    #url = /api/song/1/similar?k=10
+    #returns {"songs": [...], "scores": [...]}, the k songs that sound most alike (cosine similarity), best first
+    #404 if the song has no embedding yet (update_index.py calculates them)
+    k = min(max(k, 1), 100)
+    
+    #a few more, rows of deleted songs are only cleared by the next update_index run
+    similar = await adb.run(embeddings.similar, song_id, k + 10)
+    if similar is None:
+        return JSONResponse({"error": "No embedding for this song"}, status_code=404)
+    
+    songs = await adb.get_songs_by_ids([similar_id for similar_id, _ in similar])
+    similar = [(songs[similar_id], score) for similar_id, score in similar if similar_id in songs][:k]
+    
+    return JSONResponse({
+        "songs": [song.to_json() for song, _ in similar],
+        "scores": [round(score, 4) for _, score in similar]
+    })
+
 @app.get("/api/song/{song_id}/art")
-async def get_song_art(song_id: int):
+def get_song_art(song_id: int, request: Request, size: int = None):
+    #size: 64, 256 or 512 px thumbnail, the original image if not set
     song = db.get_song_by_id(song_id)
-    return FileResponse(song.album_art)
+    if song is None or song.art_hash is None:
+        return JSONResponse({"error": "No album art"}, status_code=404)
+    
+    return art_response(request, song.art_hash, lambda: db.get_art(song.art_hash), "public, max-age=604800", size)
 
 @app.post("/api/song/upload")
 async def upload_song(request: Request) -> JSONResponse:
@@ -278,7 +421,7 @@ async def upload_song(request: Request) -> JSONResponse:
     
     abs_path = os.path.abspath(file_path)
     
-    data = fcore.get_metadata(abs_path) #dict
+    data = await adb.run(fcore.get_metadata, abs_path) #dict
     
     song = fcore.SongEntry(
         id=0,
@@ -294,10 +437,14 @@ async def upload_song(request: Request) -> JSONResponse:
     )
     
     try:
-        db.add_song(song)
+        await adb.add_song(song)
     except:
         #song already exists
         return JSONResponse({"success": False})
+    
+    #so the next rescan / the watcher know this file is up to date
+    fingerprint = await adb.run(fcore.get_fingerprint, abs_path, with_hash=True)
+    await adb.set_fingerprint(song.id, fingerprint)
     return JSONResponse({"success": True})
     
     
@@ -307,255 +454,263 @@ async def upload_song(request: Request) -> JSONResponse:
 
 @app.get("/api/playlist/{playlist_id}")
 async def get_playlist(playlist_id: int):
-    playlist = db.get_playlist(playlist_id)
+    playlist = await adb.get_playlist(playlist_id)
+    if playlist is None:
+        return JSONResponse({"error": "Playlist not found"}, status_code=404)
     return JSONResponse(playlist.to_json())
 
 @app.get("/api/playlist/{playlist_id}/art")
-async def get_playlist_art(playlist_id: int):
+def get_playlist_art(playlist_id: int, request: Request, size: int = None):
     playlist = db.get_playlist(playlist_id)
-    return FileResponse(playlist.playlist_art)
+    if playlist is None:
+        return JSONResponse({"error": "Playlist not found"}, status_code=404)
+    
+    if playlist.playlist_art not in [None, b"", b"NULL"]:
+        art = (fcore.get_image_mime(playlist.playlist_art), playlist.playlist_art)
+        art_hash = hashlib.sha256(playlist.playlist_art).hexdigest()
+        return art_response(request, art_hash, lambda: art, "public, max-age=604800", size)
+    
+    #no own art, use the cover of the first song that has one
+    for song in playlist.songs:
+        if song is not None and song.art_hash is not None:
+            return art_response(request, song.art_hash, lambda: db.get_art(song.art_hash), "public, max-age=604800", size)
+    
+    return JSONResponse({"error": "No playlist art"}, status_code=404)
 
 @app.get("/api/playlist/{playlist_id}/songs")
-async def get_playlist_songs(playlist_id: int):
-    playlist = db.get_playlist(playlist_id)
-    return JSONResponse([song.to_json() for song in playlist.songs])
+async def get_playlist_songs(playlist_id: int, limit: int = fcore.PAGE_SIZE, after: str = None):
+    #one page of tracks, same envelope and cursor as /api/full_search
+    if await adb.get_playlist_name(playlist_id) is None:
+        return JSONResponse({"error": "Playlist not found"}, status_code=404)
+    
+    try:
+        page = await adb.get_playlist_page(playlist_id, page_limit(limit), after)
+    except ValueError:
+        return JSONResponse({"error": "Invalid cursor"}, status_code=400)
+    return JSONResponse(page.to_json())
+
+#track positions are 0 based indices into the playlist
+@app.get("/api/playlist/{playlist_id}/add/{song_id}")
+async def add_to_playlist(playlist_id: int, song_id: int):
+    if await adb.get_song_by_id(song_id) is None:
+        return JSONResponse({"error": "Song not found"}, status_code=404)
+    return JSONResponse({"success": await adb.append_to_playlist(playlist_id, [song_id])})
+
+@app.get("/api/playlist/{playlist_id}/remove/{index}")
+async def remove_from_playlist(playlist_id: int, index: int):
+    return JSONResponse({"success": await adb.remove_from_playlist(playlist_id, index)})
+
+@app.get("/api/playlist/{playlist_id}/move/{index}/{new_index}")
+async def move_in_playlist(playlist_id: int, index: int, new_index: int):
+    return JSONResponse({"success": await adb.move_in_playlist(playlist_id, index, new_index)})
 
 ## favorites
 
 @app.get("/api/favorites")
-async def get_favorites():
-    favorites = db.get_favorites()
-    return JSONResponse([song.to_json() for song in favorites])
+async def get_favorites(limit: int = fcore.PAGE_SIZE, after: str = None):
+    #one page of favorites, same envelope and cursor as /api/full_search
+    try:
+        page = await adb.get_favorites_page(page_limit(limit), after)
+    except ValueError:
+        return JSONResponse({"error": "Invalid cursor"}, status_code=400)
+    return JSONResponse(page.to_json())
 
 @app.get("/api/favorites/add/{song_id}")
 async def add_to_favorites(song_id: int):
-    db.add_to_favorite(song_id)
+    await adb.add_to_favorite(song_id)
     return JSONResponse({"success": True})
 
 @app.get("/api/favorites/remove/{song_id}")
 async def remove_from_favorites(song_id: int):
-    db.remove_from_favorite(song_id)
+    await adb.remove_from_favorite(song_id)
     return JSONResponse({"success": True})
 
 @app.get("/api/favorites/is_favorite/{song_id}")
 async def is_favorite(song_id: int):
-    return JSONResponse({"is_favorite": db.is_favorite(song_id)})
+    return JSONResponse({"is_favorite": await adb.is_favorite(song_id)})
+
+@app.get("/api/favorites/is_favorite")
+async def are_favorites(ids: str):
+    #url = /api/favorites/is_favorite?ids=1,2,3
+    #returns {"is_favorite": {"1": true, "2": false, "3": false}}, at most MAX_PAGE_SIZE ids per request
+    try:
+        song_ids = [int(song_id) for song_id in ids.split(",") if song_id.strip() != ""]
+    except ValueError:
+        return JSONResponse({"error": "ids must be a comma separated list of song ids"}, status_code=400)
+    
+    if len(song_ids) > fcore.MAX_PAGE_SIZE:
+        return JSONResponse({"error": F"At most {fcore.MAX_PAGE_SIZE} ids per request"}, status_code=400)
+    
+    return JSONResponse({"is_favorite": await adb.are_favorites(song_ids)})
 
 
 
 @app.get("/api/spectrogram/{song_id}")
-def get_spectrogram(song_id: int) -> FileResponse:
-    #calculate spectrogram image
+def get_spectrogram(song_id: int) -> Response:
+    #cached images are served directly
+    #a missing image is queued in the background and answered with 202 + a placeholder,
+    #the client polls until it gets the 200 (see update_spectrogram in song_player.js)
+    image_path = fcore.get_spectrogram_path(song_id)
+    if os.path.exists(image_path):
+        return FileResponse(image_path)
+
     song = db.get_song_by_id(song_id)
-    image_path = fcore.calculate_spectrogram(song)
-    return FileResponse(image_path)
+    if song is None:
+        return JSONResponse({"error": "Song not found"}, status_code=404)
+
+    job = jobs.submit(("spectrogram", song_id), fcore.calculate_spectrogram, song)
+    if job.done():
+        if job.exception() is not None:
+            return JSONResponse({"error": f"Could not calculate the spectrogram: {job.exception()}"}, status_code=500)
+        return FileResponse(image_path)
+
+    return Response(
+        SPECTROGRAM_PLACEHOLDER,
+        status_code=202,
+        media_type="image/png",
+        headers={"Retry-After": "1", "Cache-Control": "no-store"}
+    )
+
+
+@app.get("/api/waveform/{song_id}")
+def get_waveform(song_id: int, request: Request, width: int = None, samples_per_pixel: int = None, bits: int = 8) -> Response:
+    #min/max peaks in the audiowaveform .dat format (version 2, mono)
+    #the zoom level is picked by width (pixels the client wants to draw) or samples_per_pixel
+    #bits=8 (default) or 16
+    #like the spectrogram, a missing sidecar is calculated in the background and answered with 202
+    waveform_path = fcore.get_waveform_path(song_id)
+
+    if not os.path.exists(waveform_path):
+        song = db.get_song_by_id(song_id)
+        if song is None:
+            return JSONResponse({"error": "Song not found"}, status_code=404)
+
+        job = jobs.submit(("waveform", song_id), fcore.calculate_waveform, song)
+        if not job.done():
+            return Response(status_code=202, headers={"Retry-After": "1", "Cache-Control": "no-store"})
+        if job.exception() is not None:
+            return JSONResponse({"error": f"Could not calculate the waveform: {job.exception()}"}, status_code=500)
+
+    sample_rate, level_samples_per_pixel, peaks = fwaveform.pick_level(fwaveform.read_levels(waveform_path), width, samples_per_pixel)
+    bits = 16 if bits == 16 else 8
+
+    stat = os.stat(waveform_path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}-{level_samples_per_pixel}-{bits}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "no-cache" #revalidate, the sidecar is replaced when the file changes
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and fhttp.etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+
+    data = fwaveform.encode_level(peaks, sample_rate, level_samples_per_pixel, bits)
+    return Response(data, media_type="application/octet-stream", headers=headers)
 
 
 ## general
 
 @app.get("/api/get_num_songs")
 async def get_num_songs():
-    return JSONResponse({"num_songs": db.get_num_entries()})
+    return JSONResponse({"num_songs": await adb.get_num_entries()})
 
 
 @app.get("/api/get_options")
 async def get_options_for_columns(column_name: str):
-    #return a set of all values for a column
-    #except for id, abs_path, name and album_art
-    if column_name in ["id", "abs_path", "name", "album_art"]:
-        return JSONResponse({"options": []})
-    
-    #other colums:
-    #bpm, length, kbps, genre, artist, album
-    
-    options = set()
-    songs = db.get_all_songs()
-    
-    for song in songs:
-        options.add(song.__dict__[column_name])
-    
-    return JSONResponse({"options": list(options)})
+    #return a list of all values for a column, most common first
+    #only for bpm, length, kbps, genre, artist and album (DataBase.facet_columns)
+    facets = await adb.get_facets([column_name])
+    return JSONResponse({"options": list(facets.get(column_name, {}))})
 
 @app.get("/api/get_options_new")
 async def get_options_for_columns_new(column_name: str):
-    #return a set of all values for a column
-    #except for id, abs_path, name and album_art
-    if column_name in ["id", "abs_path", "name", "album_art"]:
-        return JSONResponse({"options": []})
-    
-    #other colums:
-    #bpm, length, kbps, genre, artist, album
-    
-    options = set()
-    
-    max_id = db.get_num_entries()
-    
-    for i in range(0, max_id, 100):
-        songs = db.get_songs_by_id(i, 100, i+100)
-        for song in songs:
-            options.add(song.__dict__[column_name])
-    
-    return JSONResponse({"options": list(options)})
+    #same as /api/get_options
+    return await get_options_for_columns(column_name)
 
 @app.get("/api/get_option_frequency")
 async def get_option_frequency(column_name: str):
     #return a dict of all values for a column and their frequency
-    #except for id, abs_path, name and album_art
-    if column_name in ["id", "abs_path", "name", "album_art"]:
+    #only for the facet columns, see /api/get_options
+    facets = await adb.get_facets([column_name])
+    if column_name not in facets:
         return JSONResponse({"options": []})
-    
-    #other colums:
-    #bpm, length, kbps, genre, artist, album
-    
-    options = {} #option: count
-    songs = db.get_all_songs()
-    
-    for song in songs:
-        value = song.__dict__[column_name]
-        if value not in options:
-            options[value] = 0
-        options[value] += 1
-    
-    return JSONResponse(options)
+    return JSONResponse(facets[column_name])
+
+@app.get("/api/facets")
+async def get_facets(columns: str, limit: int = None):
+    #url = /api/facets?columns=genre,artist&limit=50
+    #returns {"genre": {value: count}, "artist": {value: count}}, most common values first
+    #limit keeps only the most common values of every column, unknown columns are left out
+    facets = await adb.get_facets(columns.split(","), limit)
+    return JSONResponse(facets)
 
 
 @app.get("/api/generate_sitemap")
 def generate_sitemap():
-    #generate sitemap and save it to disk
-    #return success
-    
-    #generate sitemap
-    songs = db.get_all_songs()
-    
-    sitemap = ""
-    sitemap += "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
-    sitemap += "<urlset xmlns=\"http://www.sitemaps.org/schemas/sitemap/0.9\">\n"
-    
-    current_timestamp = datetime.datetime.now().strftime("%Y-%m-%d")
-    
-    #add index page
-    url = "https://fmusic.linushorn.dev/"
-    
-    sitemap += f"""
-    <url>
-        <loc>{url}</loc>
-        <lastmod>{current_timestamp}</lastmod>
-    </url>
-    """
+    #brings ./static/sitemap.xml (an index) and its shards up to date, see fmusic_sitemap
+    #only the shards whose songs changed are written
+    written = fsitemap.generate(db)
+    return JSONResponse({"success": True, "written": written})
 
-    routes = [
-        "/manifest.json", "/robots.txt", "/license.txt"
-    ]
-    
-    for song in songs:
-        routes.append(f"/song/{song.id}")
 
-    for route in routes:
-        url = f"https://fmusic.linushorn.dev{route}"
-        sitemap += f"""
-        <url>
-            <loc>{url}</loc>
-            <lastmod>{current_timestamp}</lastmod>
-        </url>
-        """
-    
-    sitemap += "</urlset>"
-    
-    #save sitemap
-    with open("./static/sitemap.xml", "w") as f:
-        f.write(sitemap)
+def export_files(songs: list[fcore.SongEntry]) -> list[tuple[str, str]]:
+    #(name in the archive, path) for every song once, in the given order, songs whose file is gone are left out
+    #the names are {id}.{extension} like in the old dump
+    files = []
+    seen = set()
+    for song in songs:
+        if song.id in seen or not os.path.isfile(song.abs_path):
+            continue
+        seen.add(song.id)
+        file_ending = song.abs_path.split(".")[-1]
+        files.append((F"{song.id}.{file_ending}", song.abs_path))
+    return files
+
+@app.api_route("/api/export.zip", methods=["GET", "HEAD"])
+def export_zip(request: Request, playlist: int = None, favorites: bool = False, q: str = None, filename: str = None) -> Response:
+    #url = /api/export.zip                 the whole library
+    #      /api/export.zip?playlist=3      a playlist
+    #      /api/export.zip?favorites=true  the favorites
+    #      /api/export.zip?q=hello         the results of a full text search
+    #
+    #streamed from the audio files (see fmusic_zip), the same songs always give the same archive,
+    #so an interrupted download can be resumed with a Range request
+    if playlist is not None:
+        entry = db.get_playlist(playlist)
+        if entry is None:
+            return JSONResponse({"error": "Playlist not found"}, status_code=404)
+        songs = entry.songs
+        default_filename = F"playlist_{playlist}.zip"
+    elif favorites:
+        songs = db.get_favorites()
+        default_filename = "favorites.zip"
+    elif q is not None:
+        #every match, MAX(id) is at least the number of songs
+        songs = db.full_text_search(q, max(db.get_num_entries() or 0, 1))
+        default_filename = "search.zip"
+    else:
+        songs = db.get_all_songs()
+        default_filename = "library.zip"
     
-    return JSONResponse({"success": True})
-
-
-last_dump_timestamp = 0
+    layout = fzip.ZipLayout(export_files(songs))
+    return exporter.response(request, layout, filename or default_filename)
 
 @app.get("/api/generate_zip_dump")
 def generate_zip_dump() -> JSONResponse:
-    # Generate a zip dump of all songs
-    # package all songs into a zip file
-    
-    global var_dict
-    t_start = time.time()
-    
-    #check if a zip dump has been created in the last minute
-    if abs(time.time() - var_dict["zip_dump_timestamp"]) < 60:
-        return JSONResponse({
-            "success": False,
-            "error": "Too many requests!",
-            "message": "A zip dump has been created in the last minute. The next zip dump can be created in 60 seconds.",
-            "download_link": "/api/download/dump.zip",
-            "time": 0
-            },
-            status_code=429 #too many requests
-        )
-    else:
-        var_dict["zip_dump_timestamp"] = time.time()
-    
-    os.mkdir("./temp/zip_temp")
-    
-    songs = db.get_all_songs()
-    
-    for song in tqdm(songs):
-        file_ending = song.abs_path.split(".")[-1]
-        new_file_name = f"{song.id}.{file_ending}"
-        new_file_path = os.path.join("./temp/zip_temp", new_file_name)
-        
-        #copy over
-        with open(song.abs_path, "rb") as f:
-            audio = f.read()
-        
-        with open(new_file_path, "wb") as f:
-            f.write(audio)
-    
-    # put contents of ./temp/zip_temp into a zip file
-    zip_file_path = "./temp/dump.zip"
-    
-    
-    
-    with zipfile.ZipFile(zip_file_path, "w") as zip_file:
-        for file in tqdm(os.listdir("./temp/zip_temp")):
-            zip_file.write(os.path.join("./temp/zip_temp", file), file)
-    
-    # delete ./temp/zip_temp
-    for file in os.listdir("./temp/zip_temp"):
-        os.remove(os.path.join("./temp/zip_temp", file))
-    os.rmdir("./temp/zip_temp")
-    
-    t_end = time.time()
-    
-    if os.path.exists(zip_file_path):
-        return JSONResponse({
-            "success": True,
-            "error": "",
-            "message": "The zip file has been created.",
-            "download_link": "/api/download/dump.zip",
-            "time": t_end - t_start
-            })
-    else:
-        return JSONResponse({
-            "success": False,
-            "error": "Something went wrong! The zip file has not been created.",
-            "message": "The zip file has not been created.",
-            "download_link": "",
-            "time": t_end - t_start
-            })
-
+    #the dump is streamed when it is downloaded, there is nothing to prepare anymore
+    return JSONResponse({
+        "success": True,
+        "error": "",
+        "message": "The zip file is created while it is downloaded.",
+        "download_link": "/api/download/dump.zip",
+        "time": 0
+        })
 
-
-@app.get("/api/download/dump.zip")
-def download_zip_dump() -> FileResponse:
-    # Download the zip dump
-    
-    file_path = "./temp/dump.zip"
-    return FileResponse(file_path, filename="dump.zip")
+@app.api_route("/api/download/dump.zip", methods=["GET", "HEAD"])
+def download_zip_dump(request: Request) -> Response:
+    #the whole library, same as /api/export.zip
+    return export_zip(request, filename="dump.zip")
 
 
 if __name__ == "__main__":
-    global var_dict
-    var_dict = {
-        "zip_dump_timestamp": 0
-    }
-    
-    
     uvicorn.run(app, host="0.0.0.0", port=8675)
@@ -16,6 +16,8 @@ let song_url = ""
 let audio = null;
 let shuffle = null;
 let is_favorite = null;
+//song id -> is favorite, for pages that looked up many songs at once (see playlist_player.html)
+let known_favorites = new Map();
 
 function var_setup(song_data) {
 
@@ -51,6 +53,7 @@ function onload_song() {
 
     //set src in <img id = "spectrogram"> to /api/specogram/<song_id>
     update_spectrogram();
+    update_waveform();
 
 
     //Event Listeners and setIntervals
@@ -76,6 +79,15 @@ function onload_song() {
         skip_to_percentage(percentage);
     });
 
+    //clickable waveform
+    document.getElementById("waveform").addEventListener("click", function (e) {
+        const container = this;
+        const offsetX = e.clientX - container.getBoundingClientRect().left;
+        const percentage = offsetX / container.clientWidth;
+    
+        skip_to_percentage(percentage);
+    });
+
     //check if browser supports mediaSession APi
     if ("mediaSession" in navigator) {
         navigator.mediaSession.setActionHandler("play", playSong);
@@ -119,9 +131,93 @@ function playSong() {
 
 function update_spectrogram() {
     //update the spectrogram
+    //202 means the image is still being calculated, show the placeholder and ask again after Retry-After
+
+    let song_id = song_data.id;
+    let url = "/api/spectrogram/" + song_id;
+
+    fetch(url).then(function (response) {
+        if (song_data.id != song_id) {
+            //another song was loaded in the meantime
+            return;
+        }
+
+        if (response.status == 202) {
+            let retry_after = parseFloat(response.headers.get("Retry-After")) || 1;
+            setTimeout(update_spectrogram, retry_after * 1000);
+        }
+
+        if (response.ok) {
+            response.blob().then(function (blob) {
+                let elem = document.getElementById("spectrogram");
+                if (elem.src.startsWith("blob:")) {
+                    URL.revokeObjectURL(elem.src);
+                }
+                elem.src = URL.createObjectURL(blob);
+            });
+        }
+    });
+}
 
-    let url = "/api/spectrogram/" + song_data.id;
-    document.getElementById("spectrogram").src = url;
+function update_waveform() {
+    //fetch the min/max peaks (audiowaveform .dat, 8 bit) for the width of the canvas and draw them
+    //202 means the peaks are still being calculated, same as for the spectrogram
+
+    let song_id = song_data.id;
+    let canvas = document.getElementById("waveform");
+    let width = canvas.clientWidth * (window.devicePixelRatio || 1);
+    let url = "/api/waveform/" + song_id + "?width=" + Math.round(width);
+
+    fetch(url).then(function (response) {
+        if (song_data.id != song_id) {
+            return;
+        }
+
+        if (response.status == 202) {
+            let retry_after = parseFloat(response.headers.get("Retry-After")) || 1;
+            setTimeout(update_waveform, retry_after * 1000);
+        }
+
+        if (response.status == 200) {
+            response.arrayBuffer().then(function (buffer) {
+                draw_waveform(canvas, buffer);
+            });
+        }
+    });
+}
+
+function draw_waveform(canvas, buffer) {
+    //header: version, flags, sample rate, samples per pixel, length, channels (int32 little endian)
+    let view = new DataView(buffer);
+    let is_8_bit = view.getUint32(4, true) & 1;
+    let length = view.getUint32(16, true);
+    let peaks = is_8_bit ? new Int8Array(buffer, 24) : new Int16Array(buffer, 24);
+    let scale = is_8_bit ? 128 : 32768;
+
+    canvas.width = canvas.clientWidth * (window.devicePixelRatio || 1);
+    canvas.height = canvas.clientHeight * (window.devicePixelRatio || 1);
+
+    let ctx = canvas.getContext("2d");
+    let middle = canvas.height / 2;
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    ctx.fillStyle = "white";
+
+    //each canvas column covers one or more peak pairs
+    for (let x = 0; x < canvas.width; x++) {
+        let start = Math.floor(x * length / canvas.width);
+        let end = Math.max(Math.floor((x + 1) * length / canvas.width), start + 1);
+
+        let min = 0;
+        let max = 0;
+        for (let i = start; i < end && i < length; i++) {
+            min = Math.min(min, peaks[2 * i]);
+            max = Math.max(max, peaks[2 * i + 1]);
+        }
+
+        let top = middle - max / scale * middle;
+        let bottom = middle - min / scale * middle;
+        ctx.fillRect(x, top, 1, Math.max(bottom - top, 1));
+    }
 }
 
 function update_spectrogram_bar() {
@@ -238,6 +334,10 @@ function restart_song() {
 }
 
 async function check_if_favorite() {
+    if (known_favorites.has(song_data.id)) {
+        return known_favorites.get(song_data.id);
+    }
+
     let url = "/api/favorites/is_favorite/" + song_data.id;
 
     try {
@@ -263,6 +363,7 @@ async function toggle_favorite() {
     }
 
     is_favorite = !is_favorite;
+    known_favorites.set(song_data.id, is_favorite);
 
     try {
         let response = await fetch(url);
@@ -0,0 +1,32 @@
+#fmusic Tests
+#run from the repository root: python -m pytest -q
+
+import pytest
+
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fmusic_core as fcore
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = fcore.DataBase(str(tmp_path / "music.db"))
+    yield db
+    db.close()
+
+@pytest.fixture
+def add_songs(db):
+    #add_songs(n, **columns) adds n songs named "song 0", "song 1", ... and returns their ids
+    #columns are set on every song, e.g. add_songs(3, artist="AC/DC")
+    def add(n: int, start: int = 0, **columns) -> list[int]:
+        songs = []
+        for idx in range(start, start + n):
+            song = fcore.SongEntry(None, F"song {idx}", F"/music/song {idx}.mp3", 120, 180, 320, "Rock", "Artist", "Album")
+            for column, value in columns.items():
+                setattr(song, column, value)
+            songs.append(song)
+        return [song.id for song in db.add_songs(songs)]
+    return add
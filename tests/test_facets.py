@@ -0,0 +1,46 @@
+
+def counted(db, column: str) -> dict:
+    #the counts the way rebuild_facet_counts would compute them
+    db.cursor.execute(F"SELECT {column}, COUNT(*) FROM songs WHERE {column} IS NOT NULL GROUP BY {column}")
+    return dict(db.cursor.fetchall())
+
+
+def test_counts_follow_writes(db, add_songs):
+    ids = add_songs(3, genre="Rock")
+    add_songs(2, start=3, genre="Jazz", artist=None)
+    assert db.get_facets(["genre"]) == {"genre": {"Rock": 3, "Jazz": 2}}
+
+    song = db.get_song_by_id(ids[0])
+    song.genre = "Jazz"
+    db.update_song(song)
+    db.delete_song(ids[1])
+    #raw sql on the same file, e.g. from update_index.py
+    db.cursor.execute("UPDATE songs SET genre=NULL WHERE id=?", (ids[2],))
+    db.conn.commit()
+
+    facets = db.get_facets(db.facet_columns)
+    assert facets["genre"] == {"Jazz": 3}
+    for column in db.facet_columns:
+        assert facets[column] == counted(db, column)
+
+def test_most_common_first(db, add_songs):
+    add_songs(1, artist="B")
+    add_songs(3, start=1, artist="A")
+    add_songs(2, start=4, artist="C")
+
+    assert list(db.get_facets(["artist"])["artist"]) == ["A", "C", "B"]
+    assert db.get_facets(["artist"], limit=2) == {"artist": {"A": 3, "C": 2}}
+
+def test_unknown_columns_are_left_out(db, add_songs):
+    add_songs(2)
+    assert db.get_facets(["name", "abs_path", "genre"]) == {"genre": {"Rock": 2}}
+
+def test_rebuild(db, add_songs):
+    add_songs(4, bpm=100)
+    add_songs(2, start=4, bpm=128)
+    before = db.get_facets(db.facet_columns)
+
+    db.rebuild_facet_counts()
+    db.conn.commit()
+    assert db.get_facets(db.facet_columns) == before
+    assert before["bpm"] == {100: 4, 128: 2}
@@ -0,0 +1,102 @@
+from fastapi import FastAPI
+from fastapi.requests import Request
+from fastapi.testclient import TestClient
+import pytest
+
+import fmusic_http as fhttp
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 100)),
+    ("bytes=10-19", (10, 20)),
+    ("bytes=10-", (10, 100)),
+    ("bytes=90-500", (90, 100)),
+    ("bytes=99-99", (99, 100)),
+    ("bytes=-10", (90, 100)),
+    ("bytes=-500", (0, 100)),
+    ("BYTES = 5-6", (5, 7)),
+    #ignored, the whole file is sent
+    ("bytes=20-10", None),
+    ("bytes=0-5,10-15", None),
+    ("items=0-5", None),
+    ("bytes=a-5", None),
+    ("bytes=+1-5", None),
+    ("bytes=-a", None),
+    ("bytes=-", None),
+])
+def test_parse_range(header, expected):
+    assert fhttp.parse_range(header, 100) == expected
+
+@pytest.mark.parametrize("header, file_size", [
+    ("bytes=100-", 100),
+    ("bytes=150-200", 100),
+    ("bytes=-0", 100),
+    ("bytes=0-", 0),
+    ("bytes=-5", 0),
+])
+def test_parse_range_unsatisfiable(header, file_size):
+    with pytest.raises(ValueError):
+        fhttp.parse_range(header, file_size)
+
+def test_etag_matches():
+    etag = '"abc-10"'
+    assert fhttp.etag_matches(etag, '"abc-10"')
+    assert fhttp.etag_matches(etag, 'W/"abc-10"')
+    assert fhttp.etag_matches(etag, '"other", "abc-10"')
+    assert fhttp.etag_matches(etag, "*")
+    assert not fhttp.etag_matches(etag, '"abc-1"')
+
+def test_content_disposition():
+    header = fhttp.content_disposition("../My Mix\r\n.zip")
+    assert "\r" not in header and "\n" not in header and "/" not in header
+    assert header.startswith('attachment; filename="')
+    assert fhttp.content_disposition("..", "export.zip") == "attachment; filename=\"export.zip\"; filename*=UTF-8''export.zip"
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / "song.mp3"
+    path.write_bytes(bytes(range(256)) * 4)
+
+    app = FastAPI()
+    @app.api_route("/song", methods=["GET", "HEAD"])
+    def song(request: Request):
+        return fhttp.file_response(request, str(path))
+    return TestClient(app)
+
+def test_file_response(client):
+    response = client.get("/song")
+    assert response.status_code == 200
+    assert response.content == bytes(range(256)) * 4
+    assert response.headers["accept-ranges"] == "bytes"
+
+    response = client.get("/song", headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+
+def test_file_response_ranges(client):
+    response = client.get("/song", headers={"Range": "bytes=256-259"})
+    assert response.status_code == 206
+    assert response.content == bytes([0, 1, 2, 3])
+    assert response.headers["content-range"] == "bytes 256-259/1024"
+
+    response = client.get("/song", headers={"Range": "bytes=-2"})
+    assert response.status_code == 206
+    assert response.content == bytes([254, 255])
+
+    response = client.get("/song", headers={"Range": "bytes=2048-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */1024"
+
+    response = client.get("/song", headers={"Range": "bytes=20-10"})
+    assert response.status_code == 200
+    assert len(response.content) == 1024
+
+def test_file_response_if_range(client):
+    etag = client.head("/song").headers["etag"]
+
+    response = client.get("/song", headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert response.status_code == 206
+    #a changed file is sent whole
+    response = client.get("/song", headers={"Range": "bytes=0-9", "If-Range": '"old"'})
+    assert response.status_code == 200
+    assert len(response.content) == 1024
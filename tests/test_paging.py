@@ -0,0 +1,69 @@
+import pytest
+
+import fmusic_core as fcore
+
+
+def all_pages(get_page, limit: int) -> tuple[list[fcore.SongPage], list[int]]:
+    #follows the next cursors until the last page
+    pages = [get_page(limit, None)]
+    while pages[-1].next is not None:
+        pages.append(get_page(limit, pages[-1].next))
+    return pages, [song.id for page in pages for song in page.songs]
+
+
+def test_playlist_pages(db, add_songs):
+    ids = add_songs(250)
+    playlist = fcore.PlaylistEntry(None, "playlist", None, [fcore.SongEntry(song_id, *[None] * 8) for song_id in reversed(ids)])
+    db.add_playlist(playlist)
+    #a moved track shows up once, at its new place
+    db.move_in_playlist(playlist.id, 0, 120)
+
+    pages, song_ids = all_pages(lambda limit, after: db.get_playlist_page(playlist.id, limit, after), 100)
+    assert [len(page.songs) for page in pages] == [100, 100, 50]
+    assert all(page.total == 250 for page in pages)
+    assert song_ids == [song.id for song in db.get_playlist(playlist.id).songs]
+
+def test_exact_last_page(db, add_songs):
+    ids = add_songs(20)
+    playlist = fcore.PlaylistEntry(None, "playlist", None, [fcore.SongEntry(song_id, *[None] * 8) for song_id in ids])
+    db.add_playlist(playlist)
+
+    pages, song_ids = all_pages(lambda limit, after: db.get_playlist_page(playlist.id, limit, after), 10)
+    assert len(pages) == 2
+    assert song_ids == ids
+
+def test_favorite_pages(db, add_songs):
+    ids = add_songs(30)
+    for song_id in reversed(ids):
+        db.add_to_favorite(song_id)
+    #a removed favorite is not on any page
+    db.remove_from_favorite(ids[10])
+
+    pages, song_ids = all_pages(db.get_favorites_page, 7)
+    assert song_ids == [song_id for song_id in reversed(ids) if song_id != ids[10]]
+    assert pages[0].total == 29
+
+@pytest.mark.parametrize("fts", [True, False])
+def test_search_pages(db, add_songs, fts):
+    #same name length, so many matches share a bm25 score
+    ids = add_songs(90, artist="Searched Band")
+    add_songs(10, start=90, artist="Other")
+    if not fts:
+        db.has_fts = False
+    elif not db.has_fts:
+        pytest.skip("sqlite without FTS5")
+
+    pages, song_ids = all_pages(lambda limit, after: db.full_text_search_page("searched ba", limit, after), 25)
+    assert sorted(song_ids) == ids
+    assert len(pages) == 4
+    assert pages[0].total == 90
+
+def test_invalid_cursor(db, add_songs):
+    add_songs(3)
+    with pytest.raises(ValueError):
+        db.get_favorites_page(10, "not a cursor")
+    with pytest.raises(ValueError):
+        db.full_text_search_page("song", 10, fcore.encode_cursor([1])[:-2] + "!!")
+
+def test_cursor_round_trip():
+    assert fcore.decode_cursor(fcore.encode_cursor((-3.25, 17))) == [-3.25, 17]
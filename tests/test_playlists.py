@@ -0,0 +1,123 @@
+import pytest
+
+import fmusic_core as fcore
+
+
+def make_playlist(db, song_ids: list[int]) -> int:
+    playlist = fcore.PlaylistEntry(None, "playlist", None, [fcore.SongEntry(song_id, *[None] * 8) for song_id in song_ids])
+    db.add_playlist(playlist)
+    return playlist.id
+
+def track_ids(db, playlist_id: int) -> list[int]:
+    return [song.id for song in db.get_playlist(playlist_id).songs]
+
+def positions(db, playlist_id: int) -> list[float]:
+    db.cursor.execute("SELECT position FROM playlist_songs WHERE playlist_id=? ORDER BY position", (playlist_id,))
+    return [row[0] for row in db.cursor.fetchall()]
+
+def move(tracks: list[int], index: int, new_index: int) -> None:
+    tracks.insert(new_index, tracks.pop(index))
+
+
+def test_move_to_front_and_back(db, add_songs):
+    ids = add_songs(5)
+    playlist_id = make_playlist(db, ids)
+    expected = list(ids)
+
+    for index, new_index in [(4, 0), (0, 4), (2, 1), (1, 3), (3, 10)]:
+        assert db.move_in_playlist(playlist_id, index, new_index)
+        move(expected, index, min(new_index, len(expected) - 1))
+        assert track_ids(db, playlist_id) == expected
+
+def test_move_missing_track(db, add_songs):
+    playlist_id = make_playlist(db, add_songs(3))
+    assert not db.move_in_playlist(playlist_id, 3, 0)
+    assert not db.move_in_playlist(playlist_id + 1, 0, 1)
+
+def test_repeated_moves_renumber(db, add_songs):
+    #moves to the front leave zero and negative positions, moves between the same two tracks run out of midpoints
+    ids = add_songs(80)
+    playlist_id = make_playlist(db, ids)
+    expected = list(ids)
+
+    for _ in range(3):
+        assert db.move_in_playlist(playlist_id, 79, 0)
+        move(expected, 79, 0)
+    for _ in range(200):
+        assert db.move_in_playlist(playlist_id, 79, 1)
+        move(expected, 79, 1)
+
+    assert track_ids(db, playlist_id) == expected
+
+def test_renumber(db, add_songs):
+    ids = add_songs(10)
+    playlist_id = make_playlist(db, ids)
+    for _ in range(5):
+        db.move_in_playlist(playlist_id, 9, 0)
+    assert min(positions(db, playlist_id)) <= 0
+
+    expected = track_ids(db, playlist_id)
+    db.renumber_playlist(playlist_id)
+    assert track_ids(db, playlist_id) == expected
+    assert positions(db, playlist_id) == list(range(1, 11))
+
+def test_failed_move_rolls_back(db, add_songs, monkeypatch):
+    ids = add_songs(5)
+    playlist_id = make_playlist(db, ids)
+    for _ in range(3):
+        db.move_in_playlist(playlist_id, 4, 0)
+    before = positions(db, playlist_id)
+
+    #no room at new_index, the renumber runs, then the move fails
+    calls = []
+    def free_position(*args):
+        calls.append(args)
+        if len(calls) > 1:
+            raise RuntimeError("failed after the renumber")
+        return None
+    monkeypatch.setattr(db, "free_position", free_position)
+
+    with pytest.raises(RuntimeError):
+        db.move_in_playlist(playlist_id, 0, 2)
+    assert positions(db, playlist_id) == before
+    assert not db.conn.in_transaction
+
+
+def test_append_and_remove(db, add_songs):
+    ids = add_songs(4)
+    playlist_id = make_playlist(db, ids[:2])
+
+    assert db.append_to_playlist(playlist_id, ids[2:])
+    assert track_ids(db, playlist_id) == ids
+
+    assert db.remove_from_playlist(playlist_id, 1)
+    assert track_ids(db, playlist_id) == [ids[0], ids[2], ids[3]]
+    assert not db.remove_from_playlist(playlist_id, 3)
+
+def test_append_rejects_unknown_songs(db, add_songs):
+    ids = add_songs(2)
+    playlist_id = make_playlist(db, ids[:1])
+
+    assert not db.append_to_playlist(playlist_id, [ids[1], 1000])
+    assert not db.append_to_playlist(playlist_id + 1, [ids[1]])
+    assert track_ids(db, playlist_id) == ids[:1]
+
+def test_deleted_song_leaves_playlists(db, add_songs):
+    ids = add_songs(4)
+    playlist_id = make_playlist(db, ids)
+
+    db.delete_song(ids[1])
+    #without delete_song, e.g. another tool on the same database
+    db.cursor.execute("DELETE FROM songs WHERE id=?", (ids[2],))
+    db.conn.commit()
+
+    assert track_ids(db, playlist_id) == [ids[0], ids[3]]
+    assert db.get_playlist_page(playlist_id).total == 2
+    db.cursor.execute("SELECT COUNT(*) FROM playlist_songs")
+    assert db.cursor.fetchone()[0] == 2
+
+    #indices count the tracks that are shown
+    assert db.move_in_playlist(playlist_id, 1, 0)
+    assert track_ids(db, playlist_id) == [ids[3], ids[0]]
+    assert db.remove_from_playlist(playlist_id, 1)
+    assert track_ids(db, playlist_id) == [ids[3]]
@@ -0,0 +1,72 @@
+import pytest
+
+import fmusic_zip as fzip
+
+import zipfile
+import zlib
+import io
+import os
+
+
+@pytest.fixture
+def files(tmp_path):
+    #(name in the archive, path on disk)
+    files = []
+    for idx, size in enumerate([0, 1, 1000, 3 * fzip.CHUNK_SIZE + 7]):
+        path = tmp_path / F"song {idx}.mp3"
+        path.write_bytes(os.urandom(size))
+        files.append((F"Artist/song {idx}.mp3", str(path)))
+    return files
+
+def archive(exporter: fzip.ZipExporter, layout: fzip.ZipLayout, start: int = 0, end: int = None) -> bytes:
+    return b"".join(exporter.iter_range(layout, start, layout.size if end is None else end))
+
+
+def test_archive_is_valid(files):
+    layout = fzip.ZipLayout(files)
+    data = archive(fzip.ZipExporter(), layout)
+    assert len(data) == layout.size
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == [name for name, path in files]
+        for name, path in files:
+            with open(path, "rb") as f:
+                assert zf.read(name) == f.read()
+
+def test_ranges_add_up(files):
+    layout = fzip.ZipLayout(files)
+    whole = archive(fzip.ZipExporter(), layout)
+
+    #a fresh exporter for the ranges, so descriptors and the central directory read the files for their CRCs
+    exporter = fzip.ZipExporter()
+    cuts = [0, 1, 100, layout.size // 3, layout.size // 2, layout.size - 30, layout.size]
+    parts = [archive(exporter, layout, start, end) for start, end in zip(reversed(cuts[:-1]), reversed(cuts[1:]))]
+    assert b"".join(reversed(parts)) == whole
+
+def test_same_files_same_layout(files):
+    assert fzip.ZipLayout(files).etag == fzip.ZipLayout(files).etag
+    assert fzip.ZipLayout(files).etag != fzip.ZipLayout(files[:-1]).etag
+
+
+def test_crc_cache_is_bounded(files):
+    exporter = fzip.ZipExporter(max_crcs=2)
+    for name, path in files:
+        entry = fzip.ZipEntry(name, path)
+        with open(path, "rb") as f:
+            assert exporter.crc(entry) == zlib.crc32(f.read())
+
+    assert list(exporter.crcs) == [path for name, path in files[-2:]]
+
+def test_crc_of_changed_file(files):
+    exporter = fzip.ZipExporter()
+    name, path = files[2]
+    exporter.crc(fzip.ZipEntry(name, path))
+
+    with open(path, "ab") as f:
+        f.write(b"more")
+    entry = fzip.ZipEntry(name, path)
+    with open(path, "rb") as f:
+        assert exporter.crc(entry) == zlib.crc32(f.read())
+    #the CRC of the old version is replaced, not kept next to it
+    assert list(exporter.crcs) == [path]
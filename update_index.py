@@ -1,19 +1,50 @@
-import tensorflow as tf
-import tensorflow_hub as tf_hub
 import numpy as np
-import librosa
-
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams, PointStruct
 
 import fmusic_core as fcore
+import fmusic_audio as faudio
+import fmusic_recommend as frecommend
+import fmusic_analysis as fanalysis
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import deque
+import argparse
 import sqlite3
 import os
 
 MUSIC_DIR = fcore.MUSIC_DIR
 
-db = fcore.DataBase()
+#songs per insert transaction of the writer
+BATCH_SIZE = 250
+
+#seconds of audio per embedding model call, several songs are packed into one call
+EMBEDDING_BATCH_SECONDS = 600
+
+#worker processes re-import this module, so nothing heavy may happen at import time
+#the database is opened on first use and tensorflow is only imported by the embedding stage
+db: fcore.DataBase = None
+embedding_index: frecommend.EmbeddingIndex = None
+model = None
+
+def get_db() -> fcore.DataBase:
+    global db
+    if db is None:
+        db = fcore.DataBase()
+    return db
+
+def get_embedding_index() -> frecommend.EmbeddingIndex:
+    global embedding_index
+    if embedding_index is None:
+        embedding_index = frecommend.EmbeddingIndex()
+    return embedding_index
+
+def get_model():
+    #YAMNet, loaded once per process on first use
+    #processes must not be forked after this, a fork while tensorflow's threads are running can hang
+    global model
+    if model is None:
+        import tensorflow_hub as tf_hub
+        model = tf_hub.load("https://tfhub.dev/google/yamnet/1")
+    return model
 
 def add_song_to_index(song_path):
     song_path = os.path.abspath(song_path)
@@ -32,9 +63,9 @@ def add_song_to_index(song_path):
     #if not found, add to db
     
     try:
-        db.add_song(song)
+        get_db().add_song(song)
         
-        song = db.get_song_by_name(song.name)
+        song = get_db().get_song_by_name(song.name)
         
         fcore.calculate_spectrogram(song)
         return True, song
@@ -42,100 +73,483 @@ def add_song_to_index(song_path):
         return False, song
 
 
-def get_embeddings(file_path: str) -> list[float]:
-    audio, sr = librosa.load(file_path, sr=None, mono=True)
-    embeddings = model(audio)
-    #embeddings: [tensorflow.python.framework.ops.EagerTensor, tensorflow.python.framework.ops.EagerTensor, tensorflow.python.framework.ops.EagerTensor]
-    #first tensor is the embeddings
-    #second tensor is the spectrogram
-    #third tensor is the log mel spectrogram
-    
-    #convert embeddings to numpy array
-    embeddings = np.array(embeddings[0])
-    
-    #convert numpy array to list
-    embeddings = embeddings.tolist()
-    return embeddings
+def decode_for_embedding(file_path: str) -> np.ndarray:
+    #runs in the embedding worker processes, 16 kHz mono float32 or None
+    try:
+        stream = faudio.AudioStream(file_path, sr=frecommend.SAMPLE_RATE)
+        audio = np.concatenate([np.zeros(0, dtype=np.float32)] + list(stream))
+    except Exception as e:
+        print(f"Could not decode {file_path}: {e}")
+        return None
+    return audio if len(audio) > 0 else None
 
-def add_song_to_vector_db(song: fcore.SongEntry):
-    embeddings = get_embeddings(song.abs_path)
-    
-    for vector in embeddings:
-        point = PointStruct(id = song.id, vector=vector, payload=song.to_json())
-        op = client.upsert(
-            collection_name="fmusic",
-            points=[point]
-        )
-
-def song_is_in_vector_db(song: fcore.SongEntry):
-    idx = song.id
-    
-    res = client.retrieve(
-        collection_name="fmusic",
-        ids=[idx]
-    ) #-> [PointStruct]
-    
-    return len(res) > 0
-        
+def embed_batch(waveforms: list[np.ndarray]) -> list[np.ndarray]:
+    #the frame embeddings of each waveform from a single model call
+    waveform, spans = frecommend.pack_waveforms(waveforms)
+    #outputs: [scores (n, 521), embeddings (n, 1024), log mel spectrogram], one row per patch
+    frames = np.array(get_model()(waveform)[1])
+    return [frames[first:first + count] for first, count in spans]
 
-def update_index():
-    
-    
-    print("(0/2) counting songs to index")
-    
-    num_songs_to_index = 0
-    for root, dirs, files in os.walk(MUSIC_DIR):
+def get_embeddings(file_path: str) -> np.ndarray:
+    audio = decode_for_embedding(file_path)
+    if audio is None:
+        return np.zeros((0, frecommend.EMBEDDING_SIZE), dtype=np.float32)
+    return embed_batch([audio])[0]
+
+
+def find_music_files(music_dir: str) -> list[str]:
+    #single walk over the library, returns the absolute path of every music file
+    paths = []
+    for root, dirs, files in os.walk(music_dir):
         for file in files:
             if fcore.is_music(file):
-                num_songs_to_index += 1
-    
-    
-    print("(1/2) Adding songs to database")
-    
+                paths.append(os.path.abspath(os.path.join(root, file)))
+    return paths
+
+def read_metadata(song_path: str) -> dict:
+    #runs in the metadata worker processes
+    try:
+        metadata = fcore.get_metadata(song_path)
+        metadata["fingerprint"] = fcore.get_fingerprint(song_path, with_hash=True)
+        return metadata
+    except Exception:
+        return None
+
+def render_spectrogram(song: fcore.SongEntry) -> int:
+    #runs in the spectrogram worker processes
+    try:
+        fcore.calculate_spectrogram(song)
+    except Exception as e:
+        print(f"Could not calculate the spectrogram of {song.abs_path}: {e}")
+    return song.id
+
+def remove_spectrogram(song_id: int):
+    #also drops the waveform peaks, both are recalculated on the next request
+    #and the embedding, which is recalculated by the next update_index run
+    for path in [fcore.get_spectrogram_path(song_id), fcore.get_waveform_path(song_id)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    get_embedding_index().remove(song_id)
+
+
+def precompute_spectrograms(workers: int = None):
+    #calculates every missing spectrogram, one song per core
+    #the server does the same on demand, this fills the cache ahead of time
+    workers = workers or os.cpu_count()
+
+    songs = [song for song in get_db().get_all_songs() if not os.path.exists(fcore.get_spectrogram_path(song.id))]
+    print(f"Calculating {len(songs)} missing spectrograms with {workers} workers")
+
+    with ProcessPoolExecutor(workers) as pool:
+        for done, _ in enumerate(pool.map(render_spectrogram, songs, chunksize=4), 1):
+            print(f"Calculated {done}/{len(songs)} spectrograms", end="\r")
+    print()
+
+
+def precompute_embeddings(workers: int = None):
+    #embeds every song that has no embedding yet (new, changed, or failed last time)
+    #worker processes decode and resample to 16 kHz, this process packs about EMBEDDING_BATCH_SECONDS of audio
+    #into each model call and writes the vectors of a call together, an interrupted run continues where it stopped
+    workers = workers or os.cpu_count()
+    index = get_embedding_index()
+
+    songs = get_db().get_all_songs()
+    missing = set(index.missing([song.id for song in songs]))
+    songs = [song for song in songs if song.id in missing]
+    print(f"Calculating {len(songs)} missing embeddings with {workers} workers")
+    if len(songs) == 0:
+        return
+
+    batch_samples = EMBEDDING_BATCH_SECONDS * frecommend.SAMPLE_RATE
+    done = 0
+    embedded = 0
+
+    def flush(batch: list[tuple[int, np.ndarray]]) -> int:
+        try:
+            frames = embed_batch([audio for _, audio in batch])
+        except Exception as e:
+            print(f"Could not calculate {len(batch)} embeddings: {e}")
+            return 0
+        return index.set_many({song_id: song_frames for (song_id, _), song_frames in zip(batch, frames)})
+
+    #at most 2 decoded songs per worker wait for the model, so memory stays bounded when decoding is faster
+    with ProcessPoolExecutor(workers) as pool:
+        queue = iter(songs)
+        pending = deque()
+
+        def refill():
+            while len(pending) < workers * 2:
+                song = next(queue, None)
+                if song is None:
+                    break
+                pending.append((song, pool.submit(decode_for_embedding, song.abs_path)))
+
+        #the pool forks its processes on the first submit, before get_model() loads tensorflow
+        refill()
+
+        batch = []
+        while len(pending) > 0:
+            song, future = pending.popleft()
+            audio = future.result()
+            refill()
+
+            done += 1
+            if audio is not None:
+                batch.append((song.id, audio))
+
+            if sum([len(audio) for _, audio in batch]) >= batch_samples:
+                embedded += flush(batch)
+                batch = []
+
+            print(f"Calculated {done}/{len(songs)} embeddings", end="\r")
+
+        if len(batch) > 0:
+            embedded += flush(batch)
+    print()
+    print(f"Calculated {embedded} embeddings")
+
+
+def analyze_song(song: tuple[int, str, float]) -> tuple[int, float, dict]:
+    #runs in the analysis worker processes, song: (id, abs_path, mtime) from get_songs_to_analyze
+    song_id, path, mtime = song
+    try:
+        return song_id, mtime, fanalysis.analyze(path)
+    except Exception as e:
+        print(f"Could not analyze {path}: {e}")
+        return song_id, mtime, None
+
+def precompute_analysis(workers: int = None):
+    #tempo, key, loudness and duration of every song that was not analyzed yet or changed since, one song per core
+    #the results are written in transactions of BATCH_SIZE songs, an interrupted run continues where it stopped
+    workers = workers or os.cpu_count()
+    db = get_db()
+
+    songs = db.get_songs_to_analyze()
+    print(f"Analyzing {len(songs)} songs with {workers} workers")
+
+    def flush(batch: list[tuple[int, float, dict]]):
+        with db.transaction() as transaction:
+            for song_id, mtime, analysis in batch:
+                transaction.set_analysis(song_id, analysis, mtime, commit=False)
+
+    batch = []
+    with ProcessPoolExecutor(workers) as pool:
+        for done, (song_id, mtime, analysis) in enumerate(pool.map(analyze_song, songs, chunksize=4), 1):
+            #failed songs are tried again on the next run
+            if analysis is not None:
+                batch.append((song_id, mtime, analysis))
+            if len(batch) >= BATCH_SIZE:
+                flush(batch)
+                batch = []
+            print(f"Analyzed {done}/{len(songs)} songs", end="\r")
+    flush(batch)
+    print()
+
+
+def is_inside(path: str, directory: str) -> bool:
+    try:
+        return os.path.commonpath([directory, path]) == directory
+    except ValueError:
+        #different drives on windows
+        return False
+
+def plan_scan(music_dir: str, paths: list[str], known: dict, full: bool = False) -> tuple[list, list, list]:
+    #compares the files on disk with the fingerprints stored in the db
+    #returns (to_parse, moved, removed)
+    #to_parse: [(song_id or None, path)] new or changed files that have to go through mutagen
+    #moved: [(song_id, path, fingerprint)] renamed files, they keep their id and metadata
+    #removed: [song_id] songs whose file is gone
+
+    music_dir = os.path.abspath(music_dir)
+
+    #only songs below the scanned directory can go missing
+    on_disk = set(paths)
+    missing = {}
+    for path, stored in known.items():
+        if path not in on_disk and is_inside(path, music_dir):
+            missing[path] = stored
+
+    to_parse = []
+    new_paths = []
+    for path in paths:
+        stored = known.get(path)
+        if stored is None:
+            new_paths.append(path)
+            continue
+
+        song_id, mtime, size, inode, file_hash = stored
+        stat = os.stat(path)
+        if full or (stat.st_mtime, stat.st_size, stat.st_ino) != (mtime, size, inode):
+            to_parse.append((song_id, path))
+
+    #a new path is a rename if it has the inode and size of a missing file,
+    #or the size and partial hash (moves across file systems change the inode)
+    missing_by_inode = {(stored[3], stored[2]): path for path, stored in missing.items()}
+    missing_sizes = {stored[2] for stored in missing.values()}
+
+    moved = []
+    for path in new_paths:
+        mtime, size, inode, file_hash = fcore.get_fingerprint(path)
+        old_path = missing_by_inode.get((inode, size))
+
+        if size in missing_sizes:
+            fingerprint = fcore.get_fingerprint(path, with_hash=True)
+            file_hash = fingerprint[3]
+            if old_path is None:
+                for missing_path, stored in missing.items():
+                    if stored[2] == size and stored[4] == file_hash:
+                        old_path = missing_path
+                        break
+
+        if old_path not in missing:
+            to_parse.append((None, path))
+            continue
+
+        song_id, old_mtime = missing.pop(old_path)[:2]
+        moved.append((song_id, path, (mtime, size, inode, file_hash)))
+        if full or mtime != old_mtime:
+            #moved and edited
+            to_parse.append((song_id, path))
+
+    removed = [stored[0] for stored in missing.values()]
+    return to_parse, moved, removed
+
+
+def drop_skipped(music_dir: str, paths: list[str], skipped: dict, full: bool = False) -> tuple[list, list]:
+    #skipped: abs_path -> fingerprint of the files that could not be added, see DataBase.get_skipped_files
+    #returns (paths without the skipped files that did not change since, skipped files that are gone)
+    music_dir = os.path.abspath(music_dir)
+    on_disk = set(paths)
+    gone = [path for path in skipped if path not in on_disk and is_inside(path, music_dir)]
+
+    if full:
+        return paths, gone
+
+    remaining = []
+    for path in paths:
+        stored = skipped.get(path)
+        if stored is not None:
+            stat = os.stat(path)
+            if (stat.st_mtime, stat.st_size, stat.st_ino) == tuple(stored[:3]):
+                continue
+        remaining.append(path)
+    return remaining, gone
+
+def apply_moves(moved: list, removed: list, gone: list = None):
+    #writes the renames and removals found by plan_scan in one transaction
+    #gone: skipped files that were deleted, see drop_skipped
+    with get_db().transaction() as db:
+        for song_id, path, fingerprint in moved:
+            db.move_song(song_id, path, fingerprint, commit=False)
+        for song_id in removed:
+            db.delete_song(song_id, commit=False)
+            remove_spectrogram(song_id)
+
+        if len(removed) > 0:
+            #the names of the removed songs are free again, the skipped files are tried on the next scan
+            db.remove_skipped_files(commit=False)
+        elif gone:
+            db.remove_skipped_files(gone, commit=False)
+
+def write_batch(batch: list[tuple[int, dict]]) -> tuple[list, list]:
+    #writes parsed files in one transaction
+    #batch: [(song_id or None, metadata)], song_id is set for files that are already in the db
+    #returns (added, changed) songs
+    new = [fcore.dict_to_SongEntry(metadata) for song_id, metadata in batch if song_id is None]
+    fingerprints = {metadata["abs_path"]: metadata["fingerprint"] for song_id, metadata in batch}
+
+    with get_db().transaction() as db:
+        added = db.add_songs(new, commit=False)
+        for song in added:
+            db.set_fingerprint(song.id, fingerprints[song.abs_path], commit=False)
+        db.remove_skipped_files([song.abs_path for song in added], commit=False)
+
+        #the name of the others is taken by another song, they are remembered so a rescan does not parse them again
+        added_paths = {song.abs_path for song in added}
+        for song in new:
+            if song.abs_path not in added_paths:
+                db.set_skipped_file(song.abs_path, fingerprints[song.abs_path], commit=False)
+
+        changed = []
+        for song_id, metadata in batch:
+            if song_id is None:
+                continue
+
+            song = fcore.dict_to_SongEntry(metadata)
+            song.id = song_id
+            try:
+                db.update_song(song, commit=False)
+            except sqlite3.IntegrityError:
+                #the new name is taken by another song, the song keeps its old metadata
+                #the fingerprint is still updated, so the file is not parsed again until it changes
+                db.set_fingerprint(song_id, metadata["fingerprint"], commit=False)
+                remove_spectrogram(song_id)
+                continue
+            db.set_fingerprint(song_id, metadata["fingerprint"], commit=False)
+            remove_spectrogram(song_id)
+            changed.append(song)
+
+    return added, changed
+
+
+def sync_paths(paths: list[str], music_dir: str = MUSIC_DIR):
+    #applies a few changed files or directories to the db, used by the watcher
+    #same rules as an incremental scan, but only for these paths and without worker pools
+    db = get_db()
+
+    on_disk = set()
+    known = {}
+    skipped = {}
+    for path in set(os.path.abspath(path) for path in paths):
+        if os.path.isdir(path):
+            on_disk.update(find_music_files(path))
+        elif os.path.isfile(path) and fcore.is_music(path):
+            on_disk.add(path)
+
+        known.update(db.get_fingerprints(path))
+        skipped.update(db.get_skipped_files(path))
+
+    scan_paths, gone = drop_skipped(music_dir, sorted(on_disk), skipped)
+    to_parse, moved, removed = plan_scan(music_dir, scan_paths, known)
+    apply_moves(moved, removed, gone)
+
+    batch = []
+    for song_id, path in to_parse:
+        metadata = read_metadata(path)
+        if metadata is not None:
+            batch.append((song_id, metadata))
+
+    added, changed = write_batch(batch)
+    for song in added + changed:
+        render_spectrogram(song)
+
+    if len(added) + len(changed) + len(moved) + len(removed) > 0:
+        print(f"Synced {len(paths)} paths: {len(added)} added, {len(changed)} changed, {len(moved)} moved, {len(removed)} removed")
+
+
+def update_index(music_dir: str = MUSIC_DIR, workers: int = None, full: bool = False, analyze: bool = False):
+    #incremental by default: only new or changed files (by mtime, size and inode) are parsed,
+    #renamed files keep their song id and songs whose file is gone are removed
+    #full=True parses every file again
+    #analyze=True also runs the audio analysis (tempo, key, loudness) on every song that was not analyzed yet
+
+    #metadata parsing is fanned out over a process pool
+    #this process is the only writer and inserts the results in transactions of BATCH_SIZE songs
+    #new songs are handed to a second pool for their spectrograms while the scan continues
+
+    workers = workers or os.cpu_count()
+    db = get_db()
+    stages = 4 if analyze else 3
+
+    print(f"(0/{stages}) Scanning music directory")
+
+    paths = find_music_files(music_dir)
+    known = db.get_fingerprints()
+
+    scan_paths, gone = drop_skipped(music_dir, paths, db.get_skipped_files(), full)
+    to_parse, moved, removed = plan_scan(music_dir, scan_paths, known, full)
+
+    if len(paths) == 0 and len(known) > 0:
+        #an unmounted drive looks exactly like a library where every file was deleted
+        print(f"No music files found in {music_dir}, not removing any songs")
+        removed = []
+        gone = []
+
+    apply_moves(moved, removed, gone)
+
+    print(f"Found {len(paths)} songs: {len(to_parse)} new or changed, {len(moved)} moved, {len(removed)} removed")
+
+
+    print(f"(1/{stages}) Adding songs to database")
+
+    num_songs_to_index = len(to_parse)
     idx = 0
     new_songs = 0
-    for root, dirs, files in os.walk(MUSIC_DIR):
-        for file in files:
-             if fcore.is_music(file):
-                is_new, song = add_song_to_index(os.path.join(root, file))
-                idx += 1
-                
-                
-                if is_new:
-                    new_songs += 1
-                
-                
-                print(f"Indexed {idx}/{num_songs_to_index} songs", end="\r")
-
-    print(f"Indexed {idx} songs")
-    print(f"Added {new_songs} new songs")
-    
-    
-    
-    
-    print("(2/2) Adding songs to vector database for similarity search")
-    
-    
-    num_songs = len(db.get_all_songs())
-    for idx, song in enumerate(db.get_all_songs()):
-        if not song_is_in_vector_db(song):
-            print(f"Adding {song.name} to vector database ({idx}/{num_songs})", end="\r")
-            add_song_to_vector_db(song)
-        else:
-            print(f"Indexed {idx}/{num_songs} songs", end="\r")
-            
-    
-    
-    
-    
+    spectrogram_jobs = []
+
+    with ProcessPoolExecutor(workers) as metadata_pool, ProcessPoolExecutor(workers) as spectrogram_pool:
+
+        def flush(batch: list[tuple[int, dict]]) -> int:
+            added, changed = write_batch(batch)
+            for song in added + changed:
+                spectrogram_jobs.append(spectrogram_pool.submit(render_spectrogram, song))
+            return len(added)
+
+        batch = []
+        song_paths = [path for song_id, path in to_parse]
+        for (song_id, path), metadata in zip(to_parse, metadata_pool.map(read_metadata, song_paths, chunksize=16)):
+            idx += 1
+
+            if metadata is not None:
+                batch.append((song_id, metadata))
+
+            if len(batch) >= BATCH_SIZE:
+                new_songs += flush(batch)
+                batch = []
+
+            print(f"Indexed {idx}/{num_songs_to_index} songs", end="\r")
+
+        new_songs += flush(batch)
+
+        print(f"Indexed {idx} songs")
+        print(f"Added {new_songs} new songs")
+
+
+        print(f"(2/{stages}) Calculating spectrograms")
+
+        for done, _ in enumerate(as_completed(spectrogram_jobs), 1):
+            print(f"Calculated {done}/{len(spectrogram_jobs)} spectrograms", end="\r")
+        print()
+
+
+
+
+    #the analysis forks its pool, so it has to run before the embedding stage loads tensorflow (see get_model)
+    if analyze:
+        print(f"(3/{stages}) Analyzing tempo, key and loudness")
+
+        precompute_analysis(workers)
+
+
+    print(f"({stages}/{stages}) Calculating embeddings for similar song recommendations")
+
+    precompute_embeddings(workers)
+
+
+
+
+
 
 if __name__ == "__main__":
-    host = "192.168.178.68:6333"
-    client = QdrantClient(host=host)
-    
-    vector_config = VectorParams(size=521, distance=Distance.COSINE)
-    
-    model_url = "https://tfhub.dev/google/yamnet/1"
-    model = tf_hub.load(model_url)
-    
-    update_index()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Add the songs in a music directory to the fmusic database")
+    parser.add_argument("path", nargs="?", default=MUSIC_DIR, help="music directory to index")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes per stage (default: number of cores)")
+    parser.add_argument("--full", action="store_true", help="parse every file again instead of only new and changed ones")
+    parser.add_argument("--watch", action="store_true", help="keep running after the scan and apply file changes as they happen")
+    parser.add_argument("--spectrograms", action="store_true", help="only calculate the missing spectrograms of the songs in the database")
+    parser.add_argument("--embeddings", action="store_true", help="only calculate the missing embeddings of the songs in the database")
+    parser.add_argument("--analyze", action="store_true", help="also estimate tempo (fills missing bpm), key, loudness and duration from the audio")
+    args = parser.parse_args()
+
+    if args.spectrograms:
+        precompute_spectrograms(args.workers)
+        raise SystemExit()
+
+    if args.embeddings:
+        precompute_embeddings(args.workers)
+        raise SystemExit()
+
+    update_index(args.path, args.workers, args.full, args.analyze)
+
+    if args.watch:
+        import fmusic_watch as fwatch
+
+        print(f"Watching {args.path} for changes")
+        watcher = fwatch.LibraryWatcher(args.path, lambda paths: sync_paths(paths, args.path))
+        watcher.start()
+        try:
+            watcher.join()
+        except KeyboardInterrupt:
+            watcher.stop()